@@ -39,6 +39,26 @@ def create_app(config_class=Config):
     from app.prediction import bp as prediction_bp
     app.register_blueprint(prediction_bp, url_prefix='/api/predictions')
     
+    # 预加载推理模型（使用进程池时由工作进程各自加载）
+    if app.config['PREDICTION_PRELOAD']:
+        with app.app_context():
+            from app.prediction.registry import get_runner
+            get_runner()
+    
+    # 将上次运行中断的入库与预测任务标记为失败，入库任务同时释放其占用的序列名称；尚未执行数据库迁移时跳过
+    with app.app_context():
+        from app.mri.jobs import recover_jobs as recover_ingest_jobs
+        from app.prediction.jobs import recover_jobs as recover_prediction_jobs
+        for kind, recover in (('ingest', recover_ingest_jobs), ('prediction', recover_prediction_jobs)):
+            try:
+                recovered = recover()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.warning(f"Skip recovering {kind} jobs: {str(e)}")
+            else:
+                if recovered:
+                    app.logger.info(f"Marked {recovered} interrupted {kind} jobs as failed")
+    
     @app.route('/test')
     def test():
         return 'Hello, World!'
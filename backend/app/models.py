@@ -71,9 +71,52 @@ class MRISeqItem(db.Model):
     
     item_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     item_name = db.Column(db.String(255), nullable=False)  # 图像文件名
-    file_path = db.Column(db.String(255), nullable=False)  # 图像文件路径
+    file_path = db.Column(db.String(255), nullable=False)  # 图像文件路径（内容寻址存储中的路径）
+    content_hash = db.Column(db.String(64), index=True)  # 文件内容的SHA-256
     seq_id = db.Column(db.Integer, db.ForeignKey('mri_sequences.seq_id'), nullable=False)
     uploaded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # 上传时间
+    
+    # 关联关系
+    header = db.relationship('MRIItemHeader', backref='item', uselist=False, lazy=True)
+
+# 入库时提取的DICOM头信息索引
+class MRIItemHeader(db.Model):
+    __tablename__ = 'mri_item_headers'
+    __table_args__ = (
+        db.Index('ix_mri_item_headers_series_order', 'series_uid', 'slice_location', 'instance_number'),
+    )
+    
+    item_id = db.Column(db.Integer, db.ForeignKey('mri_seq_items.item_id'), primary_key=True)
+    series_uid = db.Column(db.String(64))  # SeriesInstanceUID
+    instance_number = db.Column(db.Integer)  # InstanceNumber
+    slice_location = db.Column(db.Float)  # 沿层面法向的位置(mm)
+    pixel_spacing_row = db.Column(db.Float)  # PixelSpacing 行间距(mm)
+    pixel_spacing_col = db.Column(db.Float)  # PixelSpacing 列间距(mm)
+    slice_thickness = db.Column(db.Float)  # SliceThickness(mm)
+    rows = db.Column(db.Integer)
+    cols = db.Column(db.Integer)
+    orientation = db.Column(db.String(128))  # ImageOrientationPatient，逗号分隔
+
+# 异步入库任务
+class IngestJob(db.Model):
+    __tablename__ = 'ingest_jobs'
+    
+    job_id = db.Column(db.String(32), primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patients.patient_id'), nullable=False)
+    seq_name = db.Column(db.String(255), nullable=False)
+    seq_id = db.Column(db.Integer, db.ForeignKey('mri_sequences.seq_id'))  # 完成后生成的序列
+    status = db.Column(db.String(16), nullable=False, default='pending')  # pending/running/succeeded/failed
+    total = db.Column(db.Integer, nullable=False, default=0)  # 切片总数
+    processed = db.Column(db.Integer, nullable=False, default=0)  # 已处理切片数（含失败）
+    failed = db.Column(db.Integer, nullable=False, default=0)  # 失败切片数
+    slices = db.Column(db.Text(length=2 ** 24))  # 每个切片的状态（JSON），MySQL 中为 MEDIUMTEXT，TEXT 的 64KB 容纳不下大序列
+    message = db.Column(db.String(255))
+    # 任务进行中时占用的 "患者ID/序列名称"，唯一约束保证同名序列不会被并发提交，结束后清空
+    reserved_name = db.Column(db.String(300), unique=True)
+    worker = db.Column(db.String(128))  # 执行任务的进程（主机名:进程号），重启后据此识别中断的任务
+    created_by = db.Column(db.String(64))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
 
 class Patient(db.Model):
     __tablename__ = 'patients'
@@ -90,17 +133,66 @@ class PredRecord(db.Model):
     
     pred_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     pred_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    result_name = db.Column(db.String(255), nullable=False)
+    result_name = db.Column(db.String(255), nullable=False, index=True)  # 结果文件相对路径，批量写入后据此取回ID
+    model_version = db.Column(db.String(64), index=True)  # 产生该结果的模型版本（含推理后端）
+    
+    # 关联关系（pred_mri_item 含冗余列，由 service.link_items 写入，此处只读）
+    items = db.relationship('MRISeqItem', secondary='pred_mri_item', lazy=True, viewonly=True,
+                            backref=db.backref('predictions', lazy=True, viewonly=True))
+    doctors = db.relationship('Doctor', secondary='pred_doctor', lazy=True,
+                              backref=db.backref('predictions', lazy='dynamic'))
+
+# 异步预测任务
+class PredJob(db.Model):
+    __tablename__ = 'pred_jobs'
+    
+    job_id = db.Column(db.String(32), primary_key=True)
+    status = db.Column(db.String(16), nullable=False, default='pending')  # pending/running/succeeded/failed
+    progress = db.Column(db.Float, nullable=False, default=0.0)  # 0-1
+    stage = db.Column(db.String(32))  # 当前阶段
+    params = db.Column(db.Text, nullable=False)  # 请求参数（JSON）
+    pred_id = db.Column(db.Integer, db.ForeignKey('pred_records.pred_id'))  # 完成后的预测记录
+    message = db.Column(db.String(255))
+    worker = db.Column(db.String(128))  # 执行任务的进程（主机名:进程号），重启后据此识别中断的任务
+    created_by = db.Column(db.String(64))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    
+    # 关联关系
+    prediction = db.relationship('PredRecord', lazy=True)
+
+# 预测结果缓存：输入内容与参数相同的预测直接返回已有记录
+class PredCacheEntry(db.Model):
+    __tablename__ = 'pred_cache'
+    
+    cache_key = db.Column(db.String(64), primary_key=True)  # 图像内容、模型版本与参数的SHA-256
+    pred_id = db.Column(db.Integer, db.ForeignKey('pred_records.pred_id'), nullable=False)
+    model_version = db.Column(db.String(64), nullable=False, index=True)
+    size_bytes = db.Column(db.Integer, nullable=False, default=0)  # 结果文件大小
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_hit_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
 
 # 关联表
 pred_doctor = db.Table('pred_doctor',
     db.Column('pred_id', db.Integer, db.ForeignKey('pred_records.pred_id'), primary_key=True),
-    db.Column('doctor_id', db.String(64), db.ForeignKey('doctors.doctor_id'), primary_key=True)
+    db.Column('doctor_id', db.String(64), db.ForeignKey('doctors.doctor_id'), primary_key=True),
+    # 医生发起该预测的时间（命中缓存时为请求时间），冗余保存以便历史记录只扫描索引
+    db.Column('pred_time', db.DateTime, nullable=False, default=datetime.utcnow),
+    # 覆盖索引：按医生与时间范围游标分页时无需回表
+    db.Index('ix_pred_doctor_doctor_time', 'doctor_id', 'pred_time', 'pred_id')
 )
 
 pred_mri_item = db.Table('pred_mri_item',
     db.Column('pred_id', db.Integer, db.ForeignKey('pred_records.pred_id'), primary_key=True),
-    db.Column('item_id', db.Integer, db.ForeignKey('mri_seq_items.item_id'), primary_key=True)
+    db.Column('item_id', db.Integer, db.ForeignKey('mri_seq_items.item_id'), primary_key=True),
+    # 切片所属序列与预测记录的时间，冗余保存以便按序列分页只扫描索引
+    db.Column('seq_id', db.Integer, db.ForeignKey('mri_sequences.seq_id'), nullable=False),
+    db.Column('pred_time', db.DateTime, nullable=False, default=datetime.utcnow),
+    # 主键 (pred_id, item_id) 用于由预测查切片，反向索引用于由切片查预测
+    db.Index('ix_pred_mri_item_item_pred', 'item_id', 'pred_id'),
+    # 按序列与时间游标分页，同一预测可关联多个切片，item_id 参与排序保证游标唯一
+    db.Index('ix_pred_mri_item_seq_time', 'seq_id', 'pred_time', 'pred_id', 'item_id')
 )
 
 sequence_item = db.Table('sequence_item',
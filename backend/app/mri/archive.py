@@ -0,0 +1,99 @@
+import os
+import tarfile
+import zipfile
+
+# 每次从源文件读取并向客户端输出的字节数
+ARCHIVE_BLOCK_SIZE = 256 * 1024
+
+# 本身已压缩的图像格式，再次压缩只会浪费CPU
+COMPRESSED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
+
+ARCHIVE_FORMATS = {
+    'zip': 'application/zip',
+    'tar': 'application/x-tar'
+}
+
+COMPRESSION_MODES = ('auto', 'store', 'deflate')
+
+class _StreamBuffer:
+    """只追加、不可回退的输出缓冲，zipfile 据此按流式模式写入（使用数据描述符）"""
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _compress_type(name, mode):
+    if mode == 'store':
+        return zipfile.ZIP_STORED
+    if mode == 'deflate':
+        return zipfile.ZIP_DEFLATED
+    extension = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+    return zipfile.ZIP_STORED if extension in COMPRESSED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+def iter_zip(entries, mode='auto'):
+    """边构建边输出 ZIP，内存占用与文件大小无关，entries 为 (归档内名称, 文件路径)"""
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True) as archive:
+        for name, path in entries:
+            info = zipfile.ZipInfo.from_file(path, arcname=name)
+            info.compress_type = _compress_type(name, mode)
+            with open(path, 'rb') as src, archive.open(info, 'w', force_zip64=True) as dst:
+                for block in iter(lambda: src.read(ARCHIVE_BLOCK_SIZE), b''):
+                    dst.write(block)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            data = buffer.drain()
+            if data:
+                yield data
+    yield buffer.drain()
+
+def iter_tar(entries):
+    """边构建边输出 tar（pax 格式），逐块复制文件内容"""
+    written = 0
+    for name, path in entries:
+        stat = os.stat(path)
+        info = tarfile.TarInfo(name)
+        info.size = stat.st_size
+        info.mtime = int(stat.st_mtime)
+        info.mode = 0o644
+        header = info.tobuf(format=tarfile.PAX_FORMAT)
+        written += len(header)
+        yield header
+
+        with open(path, 'rb') as src:
+            for block in iter(lambda: src.read(ARCHIVE_BLOCK_SIZE), b''):
+                written += len(block)
+                yield block
+
+        remainder = stat.st_size % tarfile.BLOCKSIZE
+        if remainder:
+            padding = tarfile.BLOCKSIZE - remainder
+            written += padding
+            yield tarfile.NUL * padding
+
+    # 归档结束标记：两个全零块，并与 tarfile 一样补齐到记录大小
+    written += tarfile.BLOCKSIZE * 2
+    remainder = written % tarfile.RECORDSIZE
+    padding = tarfile.RECORDSIZE - remainder if remainder else 0
+    yield tarfile.NUL * (tarfile.BLOCKSIZE * 2 + padding)
+
+def iter_archive(entries, archive_format='zip', mode='auto'):
+    if archive_format == 'tar':
+        return iter_tar(entries)
+    return iter_zip(entries, mode)
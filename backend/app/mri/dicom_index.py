@@ -0,0 +1,160 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+import pydicom
+from pydicom.errors import InvalidDicomError
+from flask import current_app
+from app.models import MRISeqItem, MRIItemHeader
+from app import db
+
+# 只读取建立索引需要的标签
+HEADER_TAGS = [
+    'SeriesInstanceUID', 'InstanceNumber', 'SliceLocation', 'PixelSpacing',
+    'SliceThickness', 'Rows', 'Columns', 'ImageOrientationPatient', 'ImagePositionPatient'
+]
+
+DICOM_EXTENSIONS = {'dcm', 'dicom'}
+
+# 文件数少于该值时直接在当前进程解析，避免进程间通信开销
+MIN_PARALLEL_FILES = 16
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_process_pool():
+    """获取入库使用的进程池（每个工作进程只创建一次）
+
+    使用 spawn 启动子进程，不从多线程的 Web 进程 fork。
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=current_app.config['DICOM_INDEX_WORKERS'],
+                mp_context=get_context('spawn')
+            )
+        return _pool
+
+def reset_process_pool(pool):
+    """子进程异常退出（如内存不足、解码器崩溃）后进程池不再可用，丢弃它，下次使用时重新创建
+
+    其他线程已经替换过时不重复处理。
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+def is_dicom_name(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in DICOM_EXTENSIONS
+
+def _float_or_none(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def _floats_or_none(value, count):
+    """多值字段转换为 count 个浮点数，缺失、个数不符或任一值无法转换时返回 None"""
+    try:
+        values = [float(v) for v in value]
+    except (TypeError, ValueError):
+        return None
+    return values if len(values) == count else None
+
+def _slice_position(ds):
+    """层面位置：优先按 ImagePositionPatient 投影到层面法向，其次使用 SliceLocation"""
+    orientation = _floats_or_none(ds.get('ImageOrientationPatient'), 6)
+    position = _floats_or_none(ds.get('ImagePositionPatient'), 3)
+    if orientation is not None and position is not None:
+        row, col = orientation[:3], orientation[3:]
+        normal = (
+            row[1] * col[2] - row[2] * col[1],
+            row[2] * col[0] - row[0] * col[2],
+            row[0] * col[1] - row[1] * col[0]
+        )
+        return sum(n * p for n, p in zip(normal, position))
+    return _float_or_none(ds.get('SliceLocation'))
+
+def read_header(path):
+    """只读取DICOM头（不读取像素数据），非DICOM文件返回None
+
+    字段取值格式错误时该字段记为 None，不影响其他字段与整个序列的入库。
+    """
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+    except (InvalidDicomError, OSError):
+        return None
+
+    spacing = _floats_or_none(ds.get('PixelSpacing'), 2) or (None, None)
+    orientation = _floats_or_none(ds.get('ImageOrientationPatient'), 6)
+    return {
+        'series_uid': str(ds.get('SeriesInstanceUID', '')) or None,
+        'instance_number': _int_or_none(ds.get('InstanceNumber')),
+        'slice_location': _slice_position(ds),
+        'pixel_spacing_row': spacing[0],
+        'pixel_spacing_col': spacing[1],
+        'slice_thickness': _float_or_none(ds.get('SliceThickness')),
+        'rows': _int_or_none(ds.get('Rows')),
+        'cols': _int_or_none(ds.get('Columns')),
+        'orientation': ','.join(f'{v:g}' for v in orientation) if orientation is not None else None
+    }
+
+def read_headers(paths):
+    """批量读取DICOM头，文件较多时使用进程池并行解析"""
+    if len(paths) < MIN_PARALLEL_FILES:
+        return [read_header(path) for path in paths]
+    workers = current_app.config['DICOM_INDEX_WORKERS']
+    chunksize = max(1, len(paths) // (workers * 4))
+    pool = get_process_pool()
+    try:
+        return list(pool.map(read_header, paths, chunksize=chunksize))
+    except BrokenProcessPool:
+        # 进程池已损坏时换一个新的进程池重试一次
+        reset_process_pool(pool)
+        return list(get_process_pool().map(read_header, paths, chunksize=chunksize))
+
+def index_sequence(seq_id, parsed=None):
+    """为序列中的DICOM切片建立头信息索引（在调用方的事务中批量插入）
+
+    parsed 为已解析好的 {item_name: 头信息}，提供时不再读取文件。
+    """
+    items = db.session.query(MRISeqItem.item_id, MRISeqItem.item_name, MRISeqItem.file_path).filter(
+        MRISeqItem.seq_id == seq_id
+    ).all()
+    if parsed is not None:
+        headers = [parsed.get(item.item_name) for item in items]
+    else:
+        items = [item for item in items if is_dicom_name(item.item_name)]
+        headers = read_headers([item.file_path for item in items])
+    if not items:
+        return 0
+
+    rows = [
+        dict(header, item_id=item.item_id)
+        for item, header in zip(items, headers) if header is not None
+    ]
+    if rows:
+        db.session.execute(db.insert(MRIItemHeader), rows)
+    return len(rows)
+
+def ordered_items(seq_id):
+    """按解剖顺序返回序列项及其头信息，只查询索引，不读取文件"""
+    return db.session.query(MRISeqItem, MRIItemHeader).outerjoin(
+        MRIItemHeader, MRIItemHeader.item_id == MRISeqItem.item_id
+    ).filter(
+        MRISeqItem.seq_id == seq_id
+    ).order_by(
+        MRIItemHeader.series_uid,
+        MRIItemHeader.slice_location,
+        MRIItemHeader.instance_number,
+        MRISeqItem.item_id
+    ).all()
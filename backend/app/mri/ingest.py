@@ -0,0 +1,124 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import current_app
+from werkzeug.utils import secure_filename
+from app.models import MRISeqItem
+from app.mri.store import store_stream, blob_path, link_blob
+from app import db
+
+class PhaseTimer:
+    """记录各阶段耗时（毫秒）"""
+    def __init__(self):
+        self.timings = {}
+        self._start = time.perf_counter()
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def as_dict(self):
+        result = dict(self.timings)
+        result['total_ms'] = round((time.perf_counter() - self._start) * 1000, 2)
+        return result
+
+class _Phase:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = (time.perf_counter() - self._start) * 1000
+        key = f'{self.name}_ms'
+        self.timer.timings[key] = round(self.timer.timings.get(key, 0) + elapsed, 2)
+        return False
+
+def create_sequence_directory(patient_id, seq_name):
+    """创建序列文件夹"""
+    base_dir = current_app.config['UPLOAD_FOLDER']
+    patient_dir = os.path.join(base_dir, f'patient_{patient_id}')
+    seq_dir = os.path.join(patient_dir, secure_filename(seq_name))
+    
+    # 确保目录存在
+    os.makedirs(seq_dir, exist_ok=True)
+    return seq_dir
+
+def assign_unique_names(filenames, existing=()):
+    """在内存中为文件分配唯一的安全文件名"""
+    taken = set(existing)
+    names = []
+    for filename in filenames:
+        name = secure_filename(filename)
+        base, ext = os.path.splitext(name)
+        counter = 1
+        while name in taken:
+            name = f"{base}_{counter}{ext}"
+            counter += 1
+        taken.add(name)
+        names.append(name)
+    return names
+
+def _store_file(app, file, seq_dir, name):
+    """将单个文件存入内容寻址存储，并在序列目录中建立同名链接"""
+    with app.app_context():
+        digest, written = store_stream(file.stream)
+        path = blob_path(digest)
+        link_blob(digest, os.path.join(seq_dir, name))
+    return {
+        'name': name,
+        'path': path,
+        'content_hash': digest,
+        'written': written
+    }
+
+def _fsync_dir(path):
+    """目录项落盘，保证新文件名在崩溃后仍然可见"""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def persist_files(files, seq_dir):
+    """使用有界线程池并行存储文件，内容已存在的文件不会重复写盘"""
+    existing = os.listdir(seq_dir) if os.path.isdir(seq_dir) else []
+    names = assign_unique_names([file.filename for file in files], existing)
+
+    app = current_app._get_current_object()
+    max_workers = app.config['INGEST_WORKERS']
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_store_file, app, file, seq_dir, name)
+            for file, name in zip(files, names)
+        ]
+        errors = [future.exception() for future in futures]
+
+    if any(errors):
+        # 任一文件失败则清理本次在序列目录中创建的链接，存储中的文件交给垃圾回收
+        for name in names:
+            path = os.path.join(seq_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+        raise next(e for e in errors if e)
+
+    _fsync_dir(seq_dir)
+    return [future.result() for future in futures]
+
+def bulk_insert_items(seq_id, saved_files):
+    """一条批量语句插入所有序列项记录"""
+    if not saved_files:
+        return
+    now = datetime.utcnow()
+    db.session.execute(db.insert(MRISeqItem), [{
+        'item_name': saved['name'],
+        'file_path': saved['path'],
+        'content_hash': saved['content_hash'],
+        'seq_id': seq_id,
+        'uploaded_at': now
+    } for saved in saved_files])
@@ -0,0 +1,247 @@
+import os
+import json
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from app.models import IngestJob, MRISequence
+from app import db
+from app.utils.workers import worker_id, is_orphaned
+from app.mri.dicom_index import get_process_pool, reset_process_pool, is_dicom_name, read_header, index_sequence
+from app.mri.ingest import assign_unique_names, create_sequence_directory, bulk_insert_items
+from app.mri.pixels import load_pixels
+from app.mri.preview import schedule_previews
+from app.mri.store import store_file, blob_path, link_blob
+
+# 进度写入数据库的最小间隔（秒）
+PROGRESS_INTERVAL = 0.5
+ACTIVE_STATUSES = ('pending', 'running')
+
+class IngestJobError(Exception):
+    """入库任务提交错误"""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+_coordinators = None
+_coordinators_lock = threading.Lock()
+
+def _get_coordinators():
+    """调度入库任务的线程池，每个任务占用一个线程，切片处理交给进程池"""
+    global _coordinators
+    with _coordinators_lock:
+        if _coordinators is None:
+            _coordinators = ThreadPoolExecutor(
+                max_workers=current_app.config['INGEST_JOB_WORKERS'],
+                thread_name_prefix='ingest-job'
+            )
+        return _coordinators
+
+def _staging_dir(job_id):
+    return os.path.join(current_app.config['INGEST_STAGING_FOLDER'], job_id)
+
+def stage_files(job_id, files):
+    """将上传的文件原样暂存，返回 [(文件名, 暂存路径)]"""
+    staging_dir = _staging_dir(job_id)
+    os.makedirs(staging_dir, exist_ok=True)
+
+    names = assign_unique_names([file.filename for file in files])
+    staged = []
+    for file, name in zip(files, names):
+        path = os.path.join(staging_dir, name)
+        file.save(path)
+        staged.append((name, path))
+    return staged
+
+def process_slice(name, path, blob_dir):
+    """在子进程中处理单个切片：解码校验、读取DICOM头、移入内容寻址存储"""
+    try:
+        load_pixels(path)
+        header = read_header(path) if is_dicom_name(name) else None
+        digest, written = store_file(path, blob_dir=blob_dir)
+        return {'name': name, 'content_hash': digest, 'written': written, 'header': header}
+    except Exception as e:
+        return {'name': name, 'error': (str(e) or e.__class__.__name__)[:255]}
+
+def job_to_dict(job):
+    return {
+        'job_id': job.job_id,
+        'status': job.status,
+        'patient_id': job.patient_id,
+        'seq_name': job.seq_name,
+        'seq_id': job.seq_id,
+        'total': job.total,
+        'processed': job.processed,
+        'failed': job.failed,
+        'message': job.message,
+        'slices': json.loads(job.slices) if job.slices else [],
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    }
+
+def reservation(patient_id, seq_name):
+    return f'{patient_id}/{seq_name}'
+
+def name_reserved(patient_id, seq_name):
+    """是否有进行中的入库任务占用了该序列名称"""
+    return IngestJob.query.filter_by(reserved_name=reservation(patient_id, seq_name)).first() is not None
+
+def submit_job(patient_id, seq_name, files, user_id):
+    """占用序列名称、暂存文件、记录任务并提交后台处理
+
+    序列名称在提交时即由唯一约束占用，同名的并发任务在这里失败，而不是处理完所有切片后才冲突。
+    """
+    if MRISequence.query.filter_by(patient_id=patient_id, seq_name=seq_name).first():
+        raise IngestJobError('序列名称已存在')
+    job = IngestJob(
+        job_id=uuid.uuid4().hex,
+        patient_id=patient_id,
+        seq_name=seq_name,
+        reserved_name=reservation(patient_id, seq_name),
+        worker=worker_id(),
+        created_by=user_id
+    )
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise IngestJobError('同名序列正在处理中', 409)
+
+    try:
+        staged = stage_files(job.job_id, files)
+    except Exception:
+        shutil.rmtree(_staging_dir(job.job_id), ignore_errors=True)
+        db.session.delete(job)
+        db.session.commit()
+        raise
+    job.total = len(staged)
+    job.slices = json.dumps([{'name': name, 'status': 'pending'} for name, _ in staged], ensure_ascii=False)
+    db.session.commit()
+
+    job_id = job.job_id
+    app = current_app._get_current_object()
+    _get_coordinators().submit(_run_job, app, job_id, staged)
+    return job
+
+def _save_progress(job, slices):
+    job.slices = json.dumps(slices, ensure_ascii=False)
+    db.session.commit()
+
+def _run_job(app, job_id, staged):
+    with app.app_context():
+        job = IngestJob.query.get(job_id)
+        try:
+            _process_job(job, staged)
+        except Exception as e:
+            db.session.rollback()
+            job = IngestJob.query.get(job_id)
+            job.status = 'failed'
+            job.message = str(e)[:255]
+            job.reserved_name = None
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+            app.logger.error(f"Error in ingest job {job_id}: {str(e)}")
+        finally:
+            shutil.rmtree(_staging_dir(job_id), ignore_errors=True)
+            db.session.remove()
+
+def _process_job(job, staged):
+    job.status = 'running'
+    db.session.commit()
+
+    slices = json.loads(job.slices)
+    index_by_name = {entry['name']: i for i, entry in enumerate(slices)}
+    blob_dir = current_app.config['BLOB_FOLDER']
+
+    results = []
+    last_saved = time.monotonic()
+    pending = staged
+    # 进程池中的子进程异常退出时，换一个新的进程池重试尚未完成的切片一次
+    for attempt in range(2):
+        pool = get_process_pool()
+        broken = []
+        try:
+            futures = {pool.submit(process_slice, name, path, blob_dir): (name, path) for name, path in pending}
+        except BrokenProcessPool:
+            futures, broken = {}, list(pending)
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                broken.append(futures[future])
+                continue
+            entry = slices[index_by_name[result['name']]]
+            if 'error' in result:
+                entry.update(status='failed', error=result['error'])
+                job.failed += 1
+            else:
+                entry['status'] = 'done'
+                results.append(result)
+            job.processed += 1
+
+            if time.monotonic() - last_saved >= PROGRESS_INTERVAL:
+                _save_progress(job, slices)
+                last_saved = time.monotonic()
+
+        if not broken:
+            break
+        reset_process_pool(pool)
+        if attempt:
+            raise RuntimeError('切片处理进程异常退出')
+        pending = broken
+
+    if not results:
+        raise ValueError('没有可入库的有效切片')
+
+    if MRISequence.query.filter_by(patient_id=job.patient_id, seq_name=job.seq_name).first():
+        raise ValueError('序列名称已存在')
+
+    seq_dir = create_sequence_directory(job.patient_id, job.seq_name)
+
+    # 保持上传顺序
+    results.sort(key=lambda result: index_by_name[result['name']])
+    saved_files = []
+    for result in results:
+        link_blob(result['content_hash'], os.path.join(seq_dir, result['name']))
+        saved_files.append(dict(result, path=blob_path(result['content_hash'])))
+
+    sequence = MRISequence(seq_name=job.seq_name, seq_dir=seq_dir, patient_id=job.patient_id)
+    db.session.add(sequence)
+    db.session.flush()
+    bulk_insert_items(sequence.seq_id, saved_files)
+    index_sequence(sequence.seq_id, {result['name']: result['header'] for result in results})
+
+    job.seq_id = sequence.seq_id
+    job.status = 'succeeded'
+    job.reserved_name = None
+    job.finished_at = datetime.utcnow()
+    _save_progress(job, slices)
+
+    schedule_previews([
+        (item.item_id, item.file_path, item.content_hash) for item in sequence.items
+    ])
+
+def recover_jobs():
+    """将执行进程已不存在的 pending/running 任务标记为失败，释放其序列名称并删除暂存文件
+
+    在应用启动时调用；同一主机上其他仍在运行的工作进程的任务不受影响。
+    """
+    recovered = 0
+    for job in IngestJob.query.filter(IngestJob.status.in_(ACTIVE_STATUSES)):
+        if not is_orphaned(job.worker):
+            continue
+        job.status = 'failed'
+        job.message = '服务重启，任务已中断，请重新上传'
+        job.reserved_name = None
+        job.finished_at = datetime.utcnow()
+        shutil.rmtree(_staging_dir(job.job_id), ignore_errors=True)
+        recovered += 1
+    db.session.commit()
+    return recovered
@@ -0,0 +1,66 @@
+import cv2
+import numpy as np
+import pydicom
+
+def is_dicom_file(path):
+    """根据 128 字节前导后的 DICM 标记判断是否为DICOM文件"""
+    with open(path, 'rb') as f:
+        preamble = f.read(132)
+    return preamble[128:132] == b'DICM'
+
+def read_dicom(path):
+    """读取DICOM数据集，兼容没有前导的文件"""
+    return pydicom.dcmread(path, force=not is_dicom_file(path))
+
+def dicom_pixels(ds):
+    """DICOM像素数据，已应用 RescaleSlope / RescaleIntercept"""
+    pixels = ds.pixel_array.astype(np.float32)
+    slope = float(ds.get('RescaleSlope', 1) or 1)
+    intercept = float(ds.get('RescaleIntercept', 0) or 0)
+    if slope != 1 or intercept != 0:
+        pixels = pixels * slope + intercept
+    return pixels
+
+def _first_value(value):
+    # WindowCenter / WindowWidth 可能是多值
+    if isinstance(value, pydicom.multival.MultiValue):
+        value = value[0]
+    return float(value)
+
+def default_window(pixels, ds=None):
+    """默认窗位窗宽 (level, window)：优先使用DICOM中的 WindowCenter / WindowWidth"""
+    if ds is not None and 'WindowCenter' in ds and 'WindowWidth' in ds:
+        try:
+            return _first_value(ds.WindowCenter), _first_value(ds.WindowWidth)
+        except (TypeError, ValueError):
+            pass
+    low, high = float(pixels.min()), float(pixels.max())
+    return (low + high) / 2, max(high - low, 1.0)
+
+def load_slice(path):
+    """解码切片，返回 (二维 float32 数组, 默认窗位窗宽)
+
+    存储中的文件没有扩展名，按内容判断格式。
+    """
+    if not is_dicom_file(path):
+        image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if image is not None:
+            if image.ndim == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY if image.shape[2] == 3 else cv2.COLOR_BGRA2GRAY)
+            pixels = image.astype(np.float32)
+            return pixels, default_window(pixels)
+
+    # 标准DICOM文件，或没有前导的DICOM文件
+    ds = read_dicom(path)
+    pixels = dicom_pixels(ds)
+    return pixels, default_window(pixels, ds)
+
+def load_pixels(path):
+    """解码切片为二维 float32 数组"""
+    return load_slice(path)[0]
+
+def apply_window(pixels, level, window):
+    """窗位窗宽映射到 0-255"""
+    low = level - window / 2
+    scale = 255.0 / window if window > 0 else 0.0
+    return np.clip((pixels - low) * scale, 0, 255).astype(np.uint8)
@@ -0,0 +1,95 @@
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+from flask import current_app
+from app.mri.pixels import load_slice, apply_window
+
+# 预览金字塔层级：(名称, 最长边像素数, 扩展名)，None 表示原始分辨率
+PREVIEW_LEVELS = [
+    ('thumb', 128, '.webp'),
+    ('medium', 512, '.webp'),
+    ('full', None, '.png')
+]
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    """后台生成预览的线程池（每个工作进程只创建一次）"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=current_app.config['PREVIEW_WORKERS'],
+                thread_name_prefix='preview'
+            )
+        return _executor
+
+def _preview_key(item_id, content_hash):
+    # 内容相同的切片共用一套预览
+    return content_hash or f'item_{item_id}'
+
+def _level_path(preview_dir, key, level):
+    name, _, extension = next(l for l in PREVIEW_LEVELS if l[0] == level)
+    return os.path.join(preview_dir, key[:2], f'{key}_{name}{extension}')
+
+def _write_image(path, image, extension):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ok, buffer = cv2.imencode(extension, image)
+    if not ok:
+        raise ValueError('图像编码失败')
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(buffer.tobytes())
+    os.replace(tmp_path, path)
+
+def build_pyramid(preview_dir, key, file_path):
+    """解码一次，由大到小逐级缩小生成各层预览"""
+    if all(os.path.exists(_level_path(preview_dir, key, level[0])) for level in PREVIEW_LEVELS):
+        return
+    pixels, (level, window) = load_slice(file_path)
+    image = apply_window(pixels, level, window)
+    for name, max_side, extension in reversed(PREVIEW_LEVELS):
+        if max_side is not None and max(image.shape) > max_side:
+            scale = max_side / max(image.shape)
+            size = (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale)))
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        _write_image(_level_path(preview_dir, key, name), image, extension)
+
+def _build_quietly(logger, preview_dir, key, file_path):
+    try:
+        build_pyramid(preview_dir, key, file_path)
+    except Exception as e:
+        logger.warning(f"Failed to build preview for {file_path}: {str(e)}")
+
+def schedule_previews(items):
+    """提交后台任务为序列项生成预览，items 为 (item_id, file_path, content_hash)"""
+    preview_dir = current_app.config['PREVIEW_FOLDER']
+    logger = current_app.logger
+    executor = _get_executor()
+    scheduled = set()
+    for item_id, file_path, content_hash in items:
+        key = _preview_key(item_id, content_hash)
+        if key in scheduled:
+            continue
+        scheduled.add(key)
+        executor.submit(_build_quietly, logger, preview_dir, key, file_path)
+
+def choose_level(size):
+    """选择最长边不小于请求尺寸的最小层级"""
+    if size:
+        for name, max_side, _ in PREVIEW_LEVELS:
+            if max_side is not None and max_side >= size:
+                return name
+    return PREVIEW_LEVELS[-1][0]
+
+def preview_path(item, size=None):
+    """返回最接近请求尺寸的预览文件路径，后台尚未生成时同步生成"""
+    preview_dir = current_app.config['PREVIEW_FOLDER']
+    key = _preview_key(item.item_id, item.content_hash)
+    path = _level_path(preview_dir, key, choose_level(size))
+    if not os.path.exists(path):
+        build_pyramid(preview_dir, key, item.file_path)
+    return path
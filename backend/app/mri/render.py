@@ -0,0 +1,84 @@
+import threading
+import cv2
+from flask import current_app
+from app.mri.pixels import load_slice, apply_window
+from app.utils.cache import LRUCache
+
+RENDER_FORMATS = {
+    'png': ('.png', 'image/png', [cv2.IMWRITE_PNG_COMPRESSION, 1]),
+    'webp': ('.webp', 'image/webp', [cv2.IMWRITE_WEBP_QUALITY, 90])
+}
+
+# 渲染尺寸上限，防止请求过大的输出
+MAX_RENDER_SIZE = 4096
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def _get_caches():
+    """解码像素缓存与编码结果缓存（每个工作进程一份）"""
+    with _caches_lock:
+        if not _caches:
+            config = current_app.config
+            _caches['pixels'] = LRUCache(config['PIXEL_CACHE_MAX_BYTES'], lambda value: value[0].nbytes)
+            _caches['renders'] = LRUCache(config['RENDER_CACHE_MAX_BYTES'], len)
+        return _caches['pixels'], _caches['renders']
+
+def _item_key(item):
+    # 内容寻址的切片以摘要为键，内容不变则缓存始终有效
+    return item.content_hash or f'{item.item_id}:{item.file_path}'
+
+def decoded_slice(item):
+    """获取解码后的像素及默认窗位窗宽，命中缓存时不再解码"""
+    pixel_cache, _ = _get_caches()
+    key = _item_key(item)
+    cached = pixel_cache.get(key)
+    if cached is None:
+        cached = load_slice(item.file_path)
+        pixel_cache.put(key, cached)
+    return cached
+
+def target_size(shape, width=None, height=None):
+    """计算输出尺寸，只给出一边时保持宽高比"""
+    rows, cols = shape
+    if width and height:
+        return width, height
+    if width:
+        return width, max(1, round(rows * width / cols))
+    if height:
+        return max(1, round(cols * height / rows)), height
+    return None
+
+def render_item(item, level=None, window=None, width=None, height=None, output_format='png'):
+    """按窗位窗宽渲染切片，返回 (编码后的字节, MIME类型)"""
+    extension, mimetype, params = RENDER_FORMATS[output_format]
+    _, render_cache = _get_caches()
+    key = (_item_key(item), level, window, width, height, output_format)
+    encoded = render_cache.get(key)
+    if encoded is not None:
+        return encoded, mimetype
+
+    pixels, (default_level, default_window) = decoded_slice(item)
+    image = apply_window(
+        pixels,
+        default_level if level is None else level,
+        default_window if window is None else window
+    )
+    size = target_size(pixels.shape, width, height)
+    if size and size != (pixels.shape[1], pixels.shape[0]):
+        shrinking = size[0] * size[1] < pixels.shape[0] * pixels.shape[1]
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR)
+
+    ok, buffer = cv2.imencode(extension, image, params)
+    if not ok:
+        raise ValueError('图像编码失败')
+    encoded = buffer.tobytes()
+    render_cache.put(key, encoded)
+    return encoded, mimetype
+
+def cache_stats():
+    pixel_cache, render_cache = _get_caches()
+    return {
+        'pixels': pixel_cache.stats(),
+        'renders': render_cache.stats()
+    }
@@ -1,27 +1,58 @@
 import os
-from flask import Blueprint, request, jsonify, current_app
+import io
+import mimetypes
+import cv2
+import numpy as np
+from flask import request, jsonify, current_app, send_file, Response
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from werkzeug.utils import secure_filename
-from app.models import Patient, MRISequence, MRISeqItem, Doctor, Administrator
+from app.models import Patient, MRISequence, MRISeqItem, IngestJob
 from app import db
-from datetime import datetime
-
-bp = Blueprint('mri', __name__)
+from app.mri import bp
+from app.mri.ingest import PhaseTimer, create_sequence_directory, persist_files, bulk_insert_items
+from app.mri.dicom_index import index_sequence, ordered_items
+from app.mri.volume import PLANES, VolumeError, get_volume, reslice
+from app.mri.pixels import apply_window
+from app.mri.render import RENDER_FORMATS, MAX_RENDER_SIZE, render_item
+from app.mri.preview import schedule_previews, preview_path
+from app.mri.archive import ARCHIVE_FORMATS, COMPRESSION_MODES, iter_archive
+from app.mri.jobs import IngestJobError, submit_job, job_to_dict, name_reserved
+from app.mri.upload import (
+    UploadError, create_session, load_session, delete_session,
+    session_status, write_chunk, finalize_files, expire_sessions
+)
 
 def allowed_file(filename):
     """检查文件类型是否允许"""
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'dcm', 'dicom'}
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def create_sequence_directory(patient_id, seq_name):
-    """创建序列文件夹"""
-    base_dir = current_app.config['UPLOAD_FOLDER']
-    patient_dir = os.path.join(base_dir, f'patient_{patient_id}')
-    seq_dir = os.path.join(patient_dir, secure_filename(seq_name))
-    
-    # 确保目录存在
-    os.makedirs(seq_dir, exist_ok=True)
-    return seq_dir
+def header_to_dict(header):
+    """DICOM头信息索引转换为字典"""
+    if header is None:
+        return None
+    return {
+        'series_uid': header.series_uid,
+        'instance_number': header.instance_number,
+        'slice_location': header.slice_location,
+        'pixel_spacing': [header.pixel_spacing_row, header.pixel_spacing_col],
+        'slice_thickness': header.slice_thickness,
+        'rows': header.rows,
+        'cols': header.cols,
+        'orientation': header.orientation
+    }
+
+def sequence_preview_items(seq_id):
+    """序列中需要生成预览的 (item_id, file_path, content_hash)"""
+    return db.session.query(
+        MRISeqItem.item_id, MRISeqItem.file_path, MRISeqItem.content_hash
+    ).filter(MRISeqItem.seq_id == seq_id).all()
+
+def guess_mimetype(filename):
+    """根据原始文件名推断MIME类型"""
+    if filename.rsplit('.', 1)[-1].lower() in ('dcm', 'dicom'):
+        return 'application/dicom'
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
 
 def get_user_type(user_id):
     """获取用户类型"""
@@ -29,29 +60,23 @@ def get_user_type(user_id):
         return 'admin', int(user_id.replace('admin_', ''))
     return 'doctor', user_id
 
-@bp.route('/patients/<int:patient_id>/sequences', methods=['POST'])
-@jwt_required()
-def create_sequence(patient_id):
-    """创建新的MRI序列"""
-    # 验证用户身份
-    current_user_id = get_jwt_identity()
-    user_type, user_id = get_user_type(current_user_id)
-    
+def validate_sequence_upload(patient_id):
+    """校验序列上传请求，返回 (序列名称, 文件列表, 错误响应)"""
     # 检查患者是否存在
     patient = Patient.query.get(patient_id)
     if not patient:
-        return jsonify({
+        return None, None, (jsonify({
             'success': False,
             'message': '患者不存在',
             'should_create_patient': True
-        }), 404
+        }), 404)
     
     # 获取序列名称
     if 'seq_name' not in request.form:
-        return jsonify({
+        return None, None, (jsonify({
             'success': False,
             'message': '缺少序列名称'
-        }), 400
+        }), 400)
     
     seq_name = request.form['seq_name']
     
@@ -62,24 +87,49 @@ def create_sequence(patient_id):
     ).first()
     
     if existing_sequence:
-        return jsonify({
+        return None, None, (jsonify({
             'success': False,
             'message': '序列名称已存在'
-        }), 400
+        }), 400)
+    
+    # 异步入库任务已占用该名称
+    if name_reserved(patient_id, seq_name):
+        return None, None, (jsonify({
+            'success': False,
+            'message': '同名序列正在处理中'
+        }), 409)
     
     # 检查是否上传了文件
     if 'files[]' not in request.files:
-        return jsonify({
+        return None, None, (jsonify({
             'success': False,
             'message': '未上传任何文件'
-        }), 400
+        }), 400)
     
     files = request.files.getlist('files[]')
     if not files or not any(file.filename for file in files):
-        return jsonify({
+        return None, None, (jsonify({
             'success': False,
             'message': '未选择任何文件'
-        }), 400
+        }), 400)
+    
+    return seq_name, files, None
+
+@bp.route('/patients/<int:patient_id>/sequences', methods=['POST'])
+@jwt_required()
+def create_sequence(patient_id):
+    """创建新的MRI序列"""
+    # 验证用户身份
+    current_user_id = get_jwt_identity()
+    user_type, user_id = get_user_type(current_user_id)
+    
+    seq_name, files, error = validate_sequence_upload(patient_id)
+    if error:
+        return error
+    
+    timer = PhaseTimer()
+    with timer.phase('validate'):
+        valid_files = [file for file in files if file and file.filename and allowed_file(file.filename)]
     
     try:
         # 创建序列目录
@@ -94,33 +144,28 @@ def create_sequence(patient_id):
         db.session.add(sequence)
         db.session.flush()  # 获取sequence_id
         
-        # 保存文件
-        uploaded_files = []
-        for file in files:
-            if file and file.filename and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                file_path = os.path.join(seq_dir, filename)
-                
-                # 确保文件名唯一
-                base, ext = os.path.splitext(filename)
-                counter = 1
-                while os.path.exists(file_path):
-                    filename = f"{base}_{counter}{ext}"
-                    file_path = os.path.join(seq_dir, filename)
-                    counter += 1
-                
-                file.save(file_path)
-                
-                # 创建��列项记录
-                seq_item = MRISeqItem(
-                    item_name=filename,
-                    file_path=file_path,
-                    seq_id=sequence.seq_id
-                )
-                db.session.add(seq_item)
-                uploaded_files.append(filename)
+        # 并行保存文件
+        with timer.phase('write'):
+            saved_files = persist_files(valid_files, seq_dir)
         
-        db.session.commit()
+        # 批量创建序列项记录
+        with timer.phase('db'):
+            bulk_insert_items(sequence.seq_id, saved_files)
+        
+        # 建立DICOM头信息索引
+        with timer.phase('index'):
+            index_sequence(sequence.seq_id)
+        
+        with timer.phase('db'):
+            db.session.commit()
+        
+        # 后台生成预览金字塔
+        schedule_previews(sequence_preview_items(sequence.seq_id))
+        
+        timings = timer.as_dict()
+        current_app.logger.info(
+            f"create_sequence {sequence.seq_id}: {len(saved_files)} files, timings={timings}"
+        )
         
         return jsonify({
             'success': True,
@@ -128,9 +173,11 @@ def create_sequence(patient_id):
             'sequence': {
                 'id': sequence.seq_id,
                 'name': sequence.seq_name,
-                'files': uploaded_files,
+                'files': [saved['name'] for saved in saved_files],
                 'created_at': sequence.created_at.isoformat()
-            }
+            },
+            'deduplicated': sum(1 for saved in saved_files if not saved['written']),
+            'timings': timings
         })
         
     except Exception as e:
@@ -141,6 +188,60 @@ def create_sequence(patient_id):
             'message': '序列创建失败，请稍后重试'
         }), 500
 
+@bp.route('/patients/<int:patient_id>/sequences/async', methods=['POST'])
+@jwt_required()
+def create_sequence_async(patient_id):
+    """异步创建MRI序列：暂存文件后立即返回任务ID，由后台完成校验、入库与索引"""
+    current_user_id = get_jwt_identity()
+    
+    seq_name, files, error = validate_sequence_upload(patient_id)
+    if error:
+        return error
+    
+    files = [file for file in files if file and file.filename and allowed_file(file.filename)]
+    if not files:
+        return jsonify({
+            'success': False,
+            'message': '文件类型不支持'
+        }), 400
+    
+    try:
+        job = submit_job(patient_id, seq_name, files, current_user_id)
+    except IngestJobError as e:
+        return jsonify({
+            'success': False,
+            'message': e.message
+        }), e.status_code
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error in create_sequence_async: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': '序列创建失败，请稍后重试'
+        }), 500
+    
+    return jsonify({
+        'success': True,
+        'message': '序列已提交处理',
+        'job': job_to_dict(job)
+    }), 202
+
+@bp.route('/ingest-jobs/<job_id>', methods=['GET'])
+@jwt_required()
+def get_ingest_job(job_id):
+    """查询异步入库任务进度"""
+    job = IngestJob.query.get(job_id)
+    if not job:
+        return jsonify({
+            'success': False,
+            'message': '任务不存在'
+        }), 404
+    
+    return jsonify({
+        'success': True,
+        'job': job_to_dict(job)
+    })
+
 @bp.route('/patients/<int:patient_id>/sequences/<int:seq_id>', methods=['GET'])
 @jwt_required()
 def get_sequence(patient_id, seq_id):
@@ -165,11 +266,51 @@ def get_sequence(patient_id, seq_id):
             'items': [{
                 'id': item.item_id,
                 'name': item.item_name,
-                'uploaded_at': item.uploaded_at.isoformat()
-            } for item in sequence.items]
+                'uploaded_at': item.uploaded_at.isoformat(),
+                'header': header_to_dict(header)
+            } for item, header in ordered_items(sequence.seq_id)]
         }
     })
 
+@bp.route('/patients/<int:patient_id>/sequences/<int:seq_id>/archive', methods=['GET'])
+@jwt_required()
+def export_sequence(patient_id, seq_id):
+    """流式导出整个序列为 ZIP 或 tar 归档"""
+    sequence = MRISequence.query.filter_by(
+        seq_id=seq_id,
+        patient_id=patient_id
+    ).first()
+    
+    if not sequence:
+        return jsonify({
+            'success': False,
+            'message': '序列不存在'
+        }), 404
+    
+    archive_format = request.args.get('format', 'zip')
+    compression = request.args.get('compression', 'auto')
+    if archive_format not in ARCHIVE_FORMATS or compression not in COMPRESSION_MODES:
+        return jsonify({
+            'success': False,
+            'message': 'format 须为 zip/tar，compression 须为 auto/store/deflate'
+        }), 400
+    
+    # 按解剖顺序排列，归档内使用原始文件名
+    folder = secure_filename(sequence.seq_name) or f'sequence_{seq_id}'
+    entries = [
+        (f'{folder}/{item.item_name}', item.file_path)
+        for item, _ in ordered_items(seq_id)
+    ]
+    
+    response = Response(
+        iter_archive(entries, archive_format, compression),
+        mimetype=ARCHIVE_FORMATS[archive_format]
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename="{folder}.{archive_format}"'
+    # 关闭反向代理缓冲，保证边生成边发送
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @bp.route('/patients/<int:patient_id>/sequences', methods=['GET'])
 @jwt_required()
 def list_sequences(patient_id):
@@ -191,4 +332,364 @@ def list_sequences(patient_id):
             'created_at': seq.created_at.isoformat(),
             'item_count': len(seq.items)
         } for seq in sequences]
-    }) 
\ No newline at end of file
+    }) 
+
+
+def upload_error_response(e):
+    """将分块上传错误转换为响应"""
+    return jsonify({
+        'success': False,
+        'message': e.message,
+        **e.extra
+    }), e.status_code
+
+@bp.route('/patients/<int:patient_id>/sequences/uploads', methods=['POST'])
+@jwt_required()
+def open_upload_session(patient_id):
+    """创建分块上传会话"""
+    current_user_id = get_jwt_identity()
+    
+    patient = Patient.query.get(patient_id)
+    if not patient:
+        return jsonify({
+            'success': False,
+            'message': '患者不存在',
+            'should_create_patient': True
+        }), 404
+    
+    data = request.get_json() or {}
+    seq_name = data.get('seq_name')
+    files = data.get('files')
+    if not seq_name:
+        return jsonify({
+            'success': False,
+            'message': '缺少序列名称'
+        }), 400
+    
+    if not files or not isinstance(files, list):
+        return jsonify({
+            'success': False,
+            'message': '未选择任何文件'
+        }), 400
+    
+    for file in files:
+        if not isinstance(file, dict) or not file.get('name') or not allowed_file(file['name']):
+            return jsonify({
+                'success': False,
+                'message': '文件类型不支持'
+            }), 400
+        if not isinstance(file.get('size'), int) or file['size'] < 0:
+            return jsonify({
+                'success': False,
+                'message': '文件大小无效'
+            }), 400
+    
+    if MRISequence.query.filter_by(patient_id=patient_id, seq_name=seq_name).first():
+        return jsonify({
+            'success': False,
+            'message': '序列名称已存在'
+        }), 400
+    
+    # 异步入库任务已占用该名称
+    if name_reserved(patient_id, seq_name):
+        return jsonify({
+            'success': False,
+            'message': '同名序列正在处理中'
+        }), 409
+    
+    # 顺带清理超时未完成的会话及其分块文件
+    try:
+        expire_sessions()
+    except Exception as e:
+        current_app.logger.error(f"Error expiring upload sessions: {str(e)}")
+    
+    try:
+        seq_dir = create_sequence_directory(patient_id, seq_name)
+        session = create_session(patient_id, seq_name, seq_dir, files, current_user_id)
+        return jsonify({
+            'success': True,
+            'upload': session_status(session)
+        }), 201
+    except UploadError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        current_app.logger.error(f"Error in open_upload_session: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': '创建上传会话失败，请稍后重试'
+        }), 500
+
+@bp.route('/uploads/<upload_id>', methods=['GET'])
+@jwt_required()
+def get_upload_session(upload_id):
+    """查询上传进度，用于断点续传"""
+    try:
+        session = load_session(upload_id, get_jwt_identity())
+    except UploadError as e:
+        return upload_error_response(e)
+    
+    return jsonify({
+        'success': True,
+        'upload': session_status(session)
+    })
+
+@bp.route('/uploads/<upload_id>/files/<int:file_index>/chunks/<int:chunk_index>', methods=['PUT'])
+@jwt_required()
+def upload_chunk(upload_id, file_index, chunk_index):
+    """上传单个分块，请求体为分块的原始字节"""
+    try:
+        session = load_session(upload_id, get_jwt_identity())
+        next_chunk = write_chunk(
+            session, file_index, chunk_index,
+            request.stream, request.content_length
+        )
+    except UploadError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        current_app.logger.error(f"Error in upload_chunk: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': '分块上传失败，请重试'
+        }), 500
+    
+    return jsonify({
+        'success': True,
+        'file_index': file_index,
+        'next_chunk': next_chunk
+    })
+
+@bp.route('/uploads/<upload_id>/commit', methods=['POST'])
+@jwt_required()
+def commit_upload_session(upload_id):
+    """提交上传会话，创建序列及序列项记录"""
+    try:
+        session = load_session(upload_id, get_jwt_identity())
+    except UploadError as e:
+        return upload_error_response(e)
+    
+    patient_id = session['patient_id']
+    seq_name = session['seq_name']
+    if MRISequence.query.filter_by(patient_id=patient_id, seq_name=seq_name).first():
+        return jsonify({
+            'success': False,
+            'message': '序列名称已存在'
+        }), 400
+    
+    if name_reserved(patient_id, seq_name):
+        return jsonify({
+            'success': False,
+            'message': '同名序列正在处理中'
+        }), 409
+    
+    try:
+        finalized = finalize_files(session)
+    except UploadError as e:
+        return upload_error_response(e)
+    
+    try:
+        sequence = MRISequence(
+            seq_name=seq_name,
+            seq_dir=session['seq_dir'],
+            patient_id=patient_id
+        )
+        db.session.add(sequence)
+        db.session.flush()  # 获取sequence_id
+        
+        bulk_insert_items(sequence.seq_id, finalized)
+        index_sequence(sequence.seq_id)
+        db.session.commit()
+        delete_session(session)
+        schedule_previews(sequence_preview_items(sequence.seq_id))
+        
+        return jsonify({
+            'success': True,
+            'message': '序列创建成功',
+            'sequence': {
+                'id': sequence.seq_id,
+                'name': sequence.seq_name,
+                'files': [saved['name'] for saved in finalized],
+                'created_at': sequence.created_at.isoformat()
+            },
+            'deduplicated': sum(1 for saved in finalized if not saved['written'])
+        })
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error in commit_upload_session: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': '序列创建失败，请稍后重试'
+        }), 500
+
+@bp.route('/uploads/<upload_id>', methods=['DELETE'])
+@jwt_required()
+def abort_upload_session(upload_id):
+    """取消上传会话并清理已上传的分块"""
+    try:
+        session = load_session(upload_id, get_jwt_identity())
+    except UploadError as e:
+        return upload_error_response(e)
+    
+    delete_session(session, remove_parts=True)
+    return jsonify({
+        'success': True,
+        'message': '上传已取消'
+    })
+
+@bp.route('/patients/<int:patient_id>/sequences/<int:seq_id>/reslice', methods=['GET'])
+@jwt_required()
+def reslice_sequence(patient_id, seq_id):
+    """多平面重建：按序号返回横断面、冠状面或矢状面"""
+    sequence = MRISequence.query.filter_by(
+        seq_id=seq_id,
+        patient_id=patient_id
+    ).first()
+    
+    if not sequence:
+        return jsonify({
+            'success': False,
+            'message': '序列不存在'
+        }), 404
+    
+    plane = request.args.get('plane', 'axial')
+    index = request.args.get('index', type=int)
+    output_format = request.args.get('format', 'png')
+    if plane not in PLANES or index is None or output_format not in ('png', 'npy'):
+        return jsonify({
+            'success': False,
+            'message': 'plane 须为 axial/coronal/sagittal，index 为整数，format 为 png/npy'
+        }), 400
+    
+    try:
+        volume, meta = get_volume(seq_id, request.args.get('series_uid'))
+        image = reslice(volume, plane, index)
+    except (VolumeError, IndexError) as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        current_app.logger.error(f"Error in reslice_sequence: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': '重建失败，请稍后重试'
+        }), 500
+    
+    if output_format == 'npy':
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(image))
+        buffer.seek(0)
+        response = send_file(buffer, mimetype='application/octet-stream')
+    else:
+        level = (meta['min'] + meta['max']) / 2
+        window = max(meta['max'] - meta['min'], 1.0)
+        _, encoded = cv2.imencode('.png', apply_window(image, level, window))
+        response = send_file(io.BytesIO(encoded.tobytes()), mimetype='image/png')
+    
+    response.headers['X-Volume-Shape'] = ','.join(str(n) for n in volume.shape)
+    return response
+
+@bp.route('/items/<int:item_id>/render', methods=['GET'])
+@jwt_required()
+def render_sequence_item(item_id):
+    """按窗位窗宽渲染序列项为 PNG/WebP"""
+    item = MRISeqItem.query.get(item_id)
+    if not item:
+        return jsonify({
+            'success': False,
+            'message': '序列项不存在'
+        }), 404
+    
+    level = request.args.get('level', type=float)
+    window = request.args.get('window', type=float)
+    width = request.args.get('width', type=int)
+    height = request.args.get('height', type=int)
+    output_format = request.args.get('format', 'png')
+    if output_format not in RENDER_FORMATS:
+        return jsonify({
+            'success': False,
+            'message': 'format 须为 png 或 webp'
+        }), 400
+    
+    if (window is not None and window <= 0) or any(
+        size is not None and not 0 < size <= MAX_RENDER_SIZE for size in (width, height)
+    ):
+        return jsonify({
+            'success': False,
+            'message': f'window 须大于 0，width/height 须在 1-{MAX_RENDER_SIZE} 之间'
+        }), 400
+    
+    try:
+        encoded, mimetype = render_item(item, level, window, width, height, output_format)
+    except Exception as e:
+        current_app.logger.error(f"Error in render_sequence_item: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': '图像渲染失败'
+        }), 500
+    
+    response = Response(encoded, mimetype=mimetype)
+    response.headers['Cache-Control'] = 'private, max-age=3600'
+    return response
+
+@bp.route('/items/<int:item_id>/preview', methods=['GET'])
+@jwt_required()
+def preview_sequence_item(item_id):
+    """返回最接近请求尺寸的预览图（缩略图/中等/原始分辨率）"""
+    item = MRISeqItem.query.get(item_id)
+    if not item:
+        return jsonify({
+            'success': False,
+            'message': '序列项不存在'
+        }), 404
+    
+    size = request.args.get('size', type=int)
+    if size is not None and size <= 0:
+        return jsonify({
+            'success': False,
+            'message': 'size 须为正整数'
+        }), 400
+    
+    try:
+        path = preview_path(item, size)
+    except Exception as e:
+        current_app.logger.error(f"Error in preview_sequence_item: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': '预览生成失败'
+        }), 500
+    
+    return send_file(path, conditional=True, max_age=86400)
+
+@bp.route('/items/<int:item_id>/file', methods=['GET'])
+@jwt_required()
+def download_sequence_item(item_id):
+    """下载序列项原始文件，支持 Range 断点续传与 ETag/Last-Modified 条件请求"""
+    item = MRISeqItem.query.get(item_id)
+    if not item:
+        return jsonify({
+            'success': False,
+            'message': '序列项不存在'
+        }), 404
+    
+    if not os.path.exists(item.file_path):
+        return jsonify({
+            'success': False,
+            'message': '文件不存在'
+        }), 404
+    
+    # conditional=True 时由 werkzeug 处理 Range、If-None-Match、If-Modified-Since，
+    # 文件对象交给 wsgi.file_wrapper，由服务器使用 sendfile 零拷贝发送
+    response = send_file(
+        item.file_path,
+        mimetype=guess_mimetype(item.item_name),
+        download_name=item.item_name,
+        conditional=True,
+        etag=item.content_hash or True,
+        max_age=current_app.config['ITEM_FILE_MAX_AGE']
+    )
+    # 内容寻址的文件不会改变，但需要认证，只允许浏览器私有缓存
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if item.content_hash:
+        response.cache_control.immutable = True
+    return response
@@ -0,0 +1,164 @@
+import os
+import hashlib
+import shutil
+import time
+import uuid
+from flask import current_app
+
+# 计算哈希及写入时的缓冲区大小
+HASH_BUFFER_SIZE = 1024 * 1024
+
+def get_blob_dir(blob_dir=None):
+    """获取内容寻址存储根目录，在没有应用上下文的子进程中需显式传入"""
+    blob_dir = blob_dir or current_app.config['BLOB_FOLDER']
+    os.makedirs(blob_dir, exist_ok=True)
+    return blob_dir
+
+def is_valid_digest(digest):
+    """检查是否为合法的 SHA-256 十六进制摘要"""
+    return isinstance(digest, str) and len(digest) == 64 and all(c in '0123456789abcdef' for c in digest)
+
+def blob_path(digest, blob_dir=None):
+    """摘要对应的存储路径，按前两级各两位十六进制分散到子目录"""
+    return os.path.join(get_blob_dir(blob_dir), digest[:2], digest[2:4], digest)
+
+def blob_exists(digest):
+    return os.path.exists(blob_path(digest))
+
+def touch_blob(digest):
+    """更新存储文件的修改时间并返回其是否存在
+
+    去重命中的旧文件由此重新进入垃圾回收的宽限期，不会在新的序列项提交之前被回收。
+    """
+    try:
+        os.utime(blob_path(digest))
+        return True
+    except FileNotFoundError:
+        return False
+
+def existing_digests(digests):
+    """返回已经存储过的摘要集合，命中的文件刷新修改时间"""
+    return {digest for digest in digests if is_valid_digest(digest) and touch_blob(digest)}
+
+def hash_stream(stream):
+    """计算流的 SHA-256"""
+    sha256 = hashlib.sha256()
+    for block in iter(lambda: stream.read(HASH_BUFFER_SIZE), b''):
+        sha256.update(block)
+    return sha256.hexdigest()
+
+def hash_file(path):
+    with open(path, 'rb') as f:
+        return hash_stream(f)
+
+def _tmp_path():
+    tmp_dir = os.path.join(get_blob_dir(), 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    return os.path.join(tmp_dir, uuid.uuid4().hex)
+
+def _install(tmp_path, digest):
+    """将临时文件原子地放入存储，已存在时丢弃临时文件，返回是否新写入"""
+    path = blob_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        # os.link 在目标已存在时失败，可安全处理并发写入同一内容
+        os.link(tmp_path, path)
+        return True
+    except FileExistsError:
+        touch_blob(digest)
+        return False
+    finally:
+        os.remove(tmp_path)
+
+def store_stream(stream):
+    """存储一个文件流，返回 (摘要, 是否新写入)
+
+    可回退的流先只计算哈希，内容已存在时完全跳过写盘。
+    """
+    if stream.seekable():
+        start = stream.tell()
+        digest = hash_stream(stream)
+        if touch_blob(digest):
+            return digest, False
+        stream.seek(start)
+
+    tmp_path = _tmp_path()
+    sha256 = hashlib.sha256()
+    with open(tmp_path, 'wb') as f:
+        for block in iter(lambda: stream.read(HASH_BUFFER_SIZE), b''):
+            sha256.update(block)
+            f.write(block)
+        f.flush()
+        os.fsync(f.fileno())
+    digest = sha256.hexdigest()
+    return digest, _install(tmp_path, digest)
+
+def store_file(path, digest=None, blob_dir=None):
+    """将磁盘上已有的文件移入存储（源文件会被移走），返回 (摘要, 是否新写入)"""
+    digest = digest or hash_file(path)
+    target = blob_path(digest, blob_dir)
+    try:
+        # 刷新修改时间，已有文件重新进入垃圾回收的宽限期
+        os.utime(target)
+    except FileNotFoundError:
+        pass
+    else:
+        os.remove(path)
+        return digest, False
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(path, target)
+    return digest, True
+
+def link_blob(digest, dest_path):
+    """在序列目录中以硬链接的形式提供可读的文件名，不额外占用空间"""
+    source = blob_path(digest)
+    if os.path.exists(dest_path):
+        if os.path.samefile(source, dest_path):
+            return dest_path
+        os.remove(dest_path)
+    try:
+        os.link(source, dest_path)
+    except OSError:
+        # 不支持硬链接的文件系统退化为复制
+        shutil.copy2(source, dest_path)
+    return dest_path
+
+def iter_blobs():
+    """遍历存储中的所有 (摘要, 路径)"""
+    blob_dir = get_blob_dir()
+    for first in os.listdir(blob_dir):
+        first_dir = os.path.join(blob_dir, first)
+        if first == 'tmp' or not os.path.isdir(first_dir):
+            continue
+        for second in os.listdir(first_dir):
+            second_dir = os.path.join(first_dir, second)
+            for digest in os.listdir(second_dir):
+                yield digest, os.path.join(second_dir, digest)
+
+def collect_garbage(referenced, grace_seconds=3600):
+    """删除未被引用的存储文件
+
+    referenced 接收一批摘要并返回其中仍被引用的集合，引用计数以数据库为准；
+    宽限期内新写入或刚被去重命中（touch_blob）的文件不删除，避免与正在进行的入库冲突。
+    """
+    now = time.time()
+    removed = 0
+    batch = []
+
+    def flush(batch):
+        count = 0
+        alive = referenced([digest for digest, _ in batch])
+        for digest, path in batch:
+            if digest not in alive and now - os.path.getmtime(path) > grace_seconds:
+                os.remove(path)
+                count += 1
+        return count
+
+    for entry in iter_blobs():
+        batch.append(entry)
+        if len(batch) >= 500:
+            removed += flush(batch)
+            batch = []
+    if batch:
+        removed += flush(batch)
+    return removed
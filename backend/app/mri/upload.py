@@ -0,0 +1,336 @@
+import os
+import json
+import math
+import time
+import uuid
+import hashlib
+import shutil
+from datetime import datetime
+from flask import current_app
+from werkzeug.utils import secure_filename
+from app.mri.ingest import assign_unique_names
+from app.mri.store import (
+    blob_path, existing_digests, touch_blob, hash_file, store_file, link_blob
+)
+
+# 流式写入时每次从请求体读取的字节数
+STREAM_BLOCK_SIZE = 64 * 1024
+# 序列名称占用文件创建后，会话清单应在该时间（秒）内写入，超时仍无清单的占用视为失效
+CLAIM_GRACE_SECONDS = 60
+
+class UploadError(Exception):
+    """分块上传错误"""
+    def __init__(self, message, status_code=400, **extra):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.extra = extra
+
+def get_session_dir():
+    """获取上传会话清单目录"""
+    session_dir = current_app.config['UPLOAD_SESSION_FOLDER']
+    os.makedirs(session_dir, exist_ok=True)
+    return session_dir
+
+def _manifest_path(upload_id):
+    # upload_id 由服务端生成，这里仍然过滤一次防止路径穿越
+    return os.path.join(get_session_dir(), f'{secure_filename(upload_id)}.json')
+
+def _parts_dir(upload_id):
+    """会话自己的分块文件目录，同名序列的不同会话互不干扰"""
+    return os.path.join(get_session_dir(), secure_filename(upload_id))
+
+def _part_path(session, file_info):
+    return os.path.join(_parts_dir(session['upload_id']), f"{file_info['name']}.part")
+
+def _claim_path(patient_id, seq_name):
+    """同一患者同一序列名称的占用文件，保证同时只有一个进行中的会话"""
+    digest = hashlib.sha256(f'{patient_id}/{seq_name}'.encode()).hexdigest()[:32]
+    return os.path.join(get_session_dir(), f'{digest}.claim')
+
+def _claim_name(patient_id, seq_name, upload_id):
+    """原子地占用序列名称，已被其他会话占用时返回 False
+
+    占用者的清单已不存在（会话已删除或创建失败）且超过 CLAIM_GRACE_SECONDS 的占用视为失效；
+    宽限期内清单可能尚未写入，仍视为占用。
+    """
+    path = _claim_path(patient_id, seq_name)
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                with open(path, encoding='utf-8') as f:
+                    holder = f.read().strip()
+                claimed_at = os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+            if holder and os.path.exists(_manifest_path(holder)):
+                return False
+            if time.time() - claimed_at < CLAIM_GRACE_SECONDS:
+                return False
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(upload_id)
+        return True
+    return False
+
+def _release_name(patient_id, seq_name, upload_id):
+    """释放会话占用的序列名称，已被其他会话重新占用时不做处理"""
+    path = _claim_path(patient_id, seq_name)
+    try:
+        with open(path, encoding='utf-8') as f:
+            holder = f.read().strip()
+        if holder == upload_id:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def chunk_count(size, chunk_size):
+    """文件的分块总数"""
+    return math.ceil(size / chunk_size)
+
+def create_session(patient_id, seq_name, seq_dir, files, user_id):
+    """创建上传会话并写入清单，同名序列已有进行中的会话时拒绝"""
+    upload_id = uuid.uuid4().hex
+    if not _claim_name(patient_id, seq_name, upload_id):
+        raise UploadError('同名序列正在上传中', 409)
+    try:
+        return _create_session(upload_id, patient_id, seq_name, seq_dir, files, user_id)
+    except Exception:
+        shutil.rmtree(_parts_dir(upload_id), ignore_errors=True)
+        try:
+            os.remove(_manifest_path(upload_id))
+        except FileNotFoundError:
+            pass
+        _release_name(patient_id, seq_name, upload_id)
+        raise
+
+def _create_session(upload_id, patient_id, seq_name, seq_dir, files, user_id):
+    chunk_size = current_app.config['UPLOAD_CHUNK_SIZE']
+    existing = os.listdir(seq_dir) if os.path.isdir(seq_dir) else []
+    names = assign_unique_names([f['name'] for f in files], existing)
+    # 客户端可提前声明 sha256，已存储过的内容无需再上传
+    declared = [(f.get('sha256') or '').lower() or None for f in files]
+    stored = existing_digests([digest for digest in declared if digest])
+
+    session = {
+        'upload_id': upload_id,
+        'patient_id': patient_id,
+        'seq_name': seq_name,
+        'seq_dir': seq_dir,
+        'chunk_size': chunk_size,
+        'created_by': user_id,
+        'created_at': datetime.utcnow().isoformat(),
+        'files': [{
+            'original_name': f['name'],
+            'name': name,
+            'size': int(f['size']),
+            'sha256': digest,
+            'deduplicated': digest in stored
+        } for f, name, digest in zip(files, names, declared)]
+    }
+
+    save_session(session)
+
+    # 预先创建分块文件，空文件无需上传即视为完成
+    os.makedirs(_parts_dir(upload_id), exist_ok=True)
+    for file_info in session['files']:
+        if not file_info['deduplicated']:
+            open(_part_path(session, file_info), 'ab').close()
+    return session
+
+def save_session(session):
+    """原子写入会话清单"""
+    path = _manifest_path(session['upload_id'])
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(session, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def load_session(upload_id, user_id=None):
+    """读取会话清单；给出 user_id 时只允许创建者或管理员访问"""
+    path = _manifest_path(upload_id)
+    if not os.path.exists(path):
+        raise UploadError('上传会话不存在', 404)
+    with open(path, encoding='utf-8') as f:
+        session = json.load(f)
+    if user_id is not None and user_id != session['created_by'] and not user_id.startswith('admin_'):
+        raise UploadError('无权访问该上传会话', 403)
+    return session
+
+def delete_session(session, remove_parts=False):
+    """删除会话清单并释放序列名称，可选删除未完成的分块文件"""
+    parts_dir = _parts_dir(session['upload_id'])
+    if remove_parts:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+    else:
+        try:
+            os.rmdir(parts_dir)
+        except OSError:
+            pass
+    path = _manifest_path(session['upload_id'])
+    if os.path.exists(path):
+        os.remove(path)
+    _release_name(session['patient_id'], session['seq_name'], session['upload_id'])
+
+def last_activity(session):
+    """会话最近一次活动的时间：清单与各分块文件的最近修改时间"""
+    paths = [_manifest_path(session['upload_id'])] + [_part_path(session, f) for f in session['files']]
+    times = []
+    for path in paths:
+        try:
+            times.append(os.path.getmtime(path))
+        except OSError:
+            continue
+    return max(times, default=0)
+
+def expire_sessions(ttl=None):
+    """删除超过 ttl 秒没有活动的会话及其分块文件，返回删除的会话数"""
+    ttl = current_app.config['UPLOAD_SESSION_TTL'] if ttl is None else ttl
+    now = time.time()
+    removed = 0
+    for name in os.listdir(get_session_dir()):
+        if not name.endswith('.json'):
+            continue
+        try:
+            session = load_session(name[:-len('.json')])
+        except (UploadError, OSError, ValueError):
+            continue
+        if now - last_activity(session) <= ttl:
+            continue
+        delete_session(session, remove_parts=True)
+        # 未提交的序列目录为空时一并删除
+        try:
+            os.rmdir(session['seq_dir'])
+        except OSError:
+            pass
+        removed += 1
+    return removed
+
+def acked_chunks(session, file_info):
+    """根据磁盘上的分块文件大小推算已确认的分块数"""
+    chunk_size = session['chunk_size']
+    total = chunk_count(file_info['size'], chunk_size)
+    if file_info.get('deduplicated') or file_info.get('content_hash'):
+        return total
+
+    part_path = _part_path(session, file_info)
+    if not os.path.exists(part_path):
+        return 0
+
+    size = os.path.getsize(part_path)
+    if size >= file_info['size']:
+        return total
+    return size // chunk_size
+
+def session_status(session):
+    """会话进度，客户端据此从 next_chunk 处续传"""
+    files = []
+    for index, file_info in enumerate(session['files']):
+        total = chunk_count(file_info['size'], session['chunk_size'])
+        acked = acked_chunks(session, file_info)
+        files.append({
+            'index': index,
+            'name': file_info['name'],
+            'size': file_info['size'],
+            'total_chunks': total,
+            'next_chunk': acked,
+            'complete': acked >= total,
+            'deduplicated': file_info.get('deduplicated', False)
+        })
+    return {
+        'upload_id': session['upload_id'],
+        'seq_name': session['seq_name'],
+        'chunk_size': session['chunk_size'],
+        'complete': all(f['complete'] for f in files),
+        'files': files
+    }
+
+def write_chunk(session, file_index, chunk_index, stream, content_length):
+    """将一个分块从请求流直接写入会话的分块文件"""
+    if not 0 <= file_index < len(session['files']):
+        raise UploadError('文件序号无效', 404)
+
+    file_info = session['files'][file_index]
+    chunk_size = session['chunk_size']
+    total = chunk_count(file_info['size'], chunk_size)
+    if file_info.get('deduplicated'):
+        raise UploadError('文件内容已存在，无需上传', 409, next_chunk=total)
+    if not 0 <= chunk_index < total:
+        raise UploadError('分块序号超出范围', 400)
+
+    # 分块必须按顺序上传，重传已确认的分块是幂等的
+    next_chunk = acked_chunks(session, file_info)
+    if chunk_index > next_chunk:
+        raise UploadError('分块不连续', 409, next_chunk=next_chunk)
+
+    offset = chunk_index * chunk_size
+    expected = min(chunk_size, file_info['size'] - offset)
+    if content_length != expected:
+        raise UploadError(f'分块大小应为 {expected} 字节', 400, next_chunk=next_chunk)
+
+    part_path = _part_path(session, file_info)
+    if not os.path.exists(part_path):
+        raise UploadError('文件已提交', 409)
+
+    written = 0
+    with open(part_path, 'r+b') as f:
+        f.seek(offset)
+        while written < expected:
+            block = stream.read(min(STREAM_BLOCK_SIZE, expected - written))
+            if not block:
+                break
+            f.write(block)
+            written += len(block)
+
+        if written != expected:
+            # 只回滚末尾的未完成分块，避免破坏后面已确认的数据
+            if chunk_index == next_chunk:
+                f.truncate(offset)
+            raise UploadError('分块数据不完整', 400, next_chunk=next_chunk)
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    return acked_chunks(session, file_info)
+
+def finalize_files(session):
+    """校验所有文件已上传完整，将其移入内容寻址存储并在序列目录中建立链接"""
+    incomplete = [f['name'] for f in session_status(session)['files'] if not f['complete']]
+    if incomplete:
+        raise UploadError('存在未上传完成的文件', 409, incomplete=incomplete)
+
+    finalized = []
+    for file_info in session['files']:
+        written = False
+        digest = file_info.get('content_hash')
+        if digest is None and file_info['deduplicated']:
+            digest = file_info['sha256']
+            if not touch_blob(digest):
+                raise UploadError('已存储的文件不存在，请重新上传', 409, incomplete=[file_info['name']])
+        elif digest is None:
+            part_path = _part_path(session, file_info)
+            digest = hash_file(part_path)
+            if file_info['sha256'] and digest != file_info['sha256']:
+                # 内容与声明不符，清空后要求重新上传
+                open(part_path, 'wb').close()
+                raise UploadError('文件校验失败', 422, incomplete=[file_info['name']])
+            _, written = store_file(part_path, digest)
+
+        # 记录已入库的文件，提交失败后重试时不再重复处理
+        file_info['content_hash'] = digest
+        save_session(session)
+
+        link_blob(digest, os.path.join(session['seq_dir'], file_info['name']))
+        finalized.append({
+            'name': file_info['name'],
+            'path': blob_path(digest),
+            'content_hash': digest,
+            'written': written
+        })
+    return finalized
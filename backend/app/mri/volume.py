@@ -0,0 +1,133 @@
+import os
+import json
+import hashlib
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from flask import current_app
+from app.mri.dicom_index import ordered_items
+from app.mri.pixels import load_pixels
+
+PLANES = ('axial', 'coronal', 'sagittal')
+
+class VolumeError(Exception):
+    """体数据构建错误"""
+
+# 每个工作进程内已打开的内存映射：seq_id -> (指纹, 数组, 元数据)
+_volumes = {}
+_locks = {}
+_locks_guard = threading.Lock()
+
+def _seq_lock(seq_id):
+    with _locks_guard:
+        return _locks.setdefault(seq_id, threading.Lock())
+
+def get_volume_dir():
+    volume_dir = current_app.config['VOLUME_CACHE_FOLDER']
+    os.makedirs(volume_dir, exist_ok=True)
+    return volume_dir
+
+def _cache_paths(seq_id):
+    volume_dir = get_volume_dir()
+    return (
+        os.path.join(volume_dir, f'seq_{seq_id}.npy'),
+        os.path.join(volume_dir, f'seq_{seq_id}.json')
+    )
+
+def volume_fingerprint(items):
+    """由切片顺序及内容计算指纹，序列变化时指纹随之变化"""
+    sha256 = hashlib.sha256()
+    for item in items:
+        sha256.update(f'{item.item_id}:{item.content_hash or item.file_path};'.encode())
+    return sha256.hexdigest()
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _build(items, fingerprint, npy_path, meta_path):
+    """逐片解码并写入磁盘上的内存映射数组，内存中不保留整个体数据"""
+    first = load_pixels(items[0].file_path)
+    shape = (len(items),) + first.shape
+    tmp_path = f'{npy_path}.{uuid.uuid4().hex}.tmp'
+    volume = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=shape)
+
+    def write_slice(index):
+        pixels = first if index == 0 else load_pixels(items[index].file_path)
+        if pixels.shape != first.shape:
+            raise VolumeError(f'切片尺寸不一致: {items[index].item_name}')
+        volume[index] = pixels
+        return float(pixels.min()), float(pixels.max())
+
+    try:
+        with ThreadPoolExecutor(max_workers=current_app.config['INGEST_WORKERS']) as executor:
+            ranges = list(executor.map(write_slice, range(len(items))))
+        volume.flush()
+        del volume
+        os.replace(tmp_path, npy_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    meta = {
+        'fingerprint': fingerprint,
+        'shape': list(shape),
+        'item_ids': [item.item_id for item in items],
+        'min': min(r[0] for r in ranges),
+        'max': max(r[1] for r in ranges)
+    }
+    tmp_meta = f'{meta_path}.tmp'
+    with open(tmp_meta, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp_meta, meta_path)
+    return meta
+
+def get_volume(seq_id, series_uid=None):
+    """获取序列的三维体数据（z, y, x），以只读内存映射的方式打开，仅在序列变化时重建"""
+    rows = ordered_items(seq_id)
+    if series_uid is None:
+        series = {header.series_uid for _, header in rows if header is not None}
+        if len(series) > 1:
+            raise VolumeError('序列包含多个 Series，请指定 series_uid')
+    else:
+        rows = [(item, header) for item, header in rows if header is not None and header.series_uid == series_uid]
+    items = [item for item, _ in rows]
+    if not items:
+        raise VolumeError('序列中没有切片')
+
+    fingerprint = volume_fingerprint(items)
+    cache_key = (seq_id, series_uid)
+    cached = _volumes.get(cache_key)
+    if cached and cached[0] == fingerprint:
+        return cached[1], cached[2]
+
+    with _seq_lock(cache_key):
+        cached = _volumes.get(cache_key)
+        if cached and cached[0] == fingerprint:
+            return cached[1], cached[2]
+
+        base = f'{seq_id}_{hashlib.sha1(series_uid.encode()).hexdigest()[:12]}' if series_uid else seq_id
+        npy_path, meta_path = _cache_paths(base)
+        meta = _read_meta(meta_path)
+        if not meta or meta['fingerprint'] != fingerprint or not os.path.exists(npy_path):
+            meta = _build(items, fingerprint, npy_path, meta_path)
+
+        volume = np.load(npy_path, mmap_mode='r')
+        _volumes[cache_key] = (fingerprint, volume, meta)
+        return volume, meta
+
+def reslice(volume, plane, index):
+    """按平面取切片，返回的是内存映射上的视图，不复制数据"""
+    axis = PLANES.index(plane)
+    if not 0 <= index < volume.shape[axis]:
+        raise IndexError(f'{plane} 层面序号超出范围 0-{volume.shape[axis] - 1}')
+    if axis == 0:
+        return volume[index]
+    if axis == 1:
+        return volume[:, index, :]
+    return volume[:, :, index]
@@ -0,0 +1,113 @@
+import os
+import numpy as np
+import torch
+from app.prediction.engine import INPUT_CHANNELS, load_model
+
+# 可选的推理后端
+BACKENDS = ('torch', 'torchscript', 'onnx', 'int8')
+
+# 各后端导出文件相对于 MODEL_PATH 的后缀
+ARTIFACT_SUFFIXES = {
+    'torchscript': '.ts.pt',
+    'onnx': '.onnx',
+    'int8': '.int8.pt'
+}
+
+def artifact_path(model_path, backend):
+    """后端导出文件路径，torch 后端直接使用原始模型"""
+    if backend == 'torch':
+        return model_path
+    stem = os.path.splitext(model_path)[0]
+    return stem + ARTIFACT_SUFFIXES[backend]
+
+def _example_input(input_size, batch_size=1):
+    return torch.zeros(batch_size, INPUT_CHANNELS, input_size, input_size)
+
+def export_torchscript(model, input_size, path):
+    """追踪导出 TorchScript，并冻结以便在加载时做算子融合"""
+    with torch.inference_mode():
+        traced = torch.jit.trace(model, _example_input(input_size))
+    frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+    torch.jit.save(frozen, path)
+    return path
+
+def export_onnx(model, input_size, path):
+    """导出 ONNX，批大小为动态维度"""
+    torch.onnx.export(
+        model,
+        _example_input(input_size),
+        path,
+        input_names=['input'],
+        output_names=['logits'],
+        dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}},
+        opset_version=17
+    )
+    return path
+
+def export_int8(model, input_size, path):
+    """动态 int8 量化并导出 TorchScript
+
+    动态量化只作用于 Linear/LSTM/GRU 层，卷积层保持 float。
+    """
+    quantized = torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear, torch.nn.LSTM, torch.nn.GRU}, dtype=torch.qint8
+    )
+    with torch.inference_mode():
+        traced = torch.jit.trace(quantized.eval(), _example_input(input_size))
+    torch.jit.save(torch.jit.freeze(traced), path)
+    return path
+
+EXPORTERS = {
+    'torchscript': export_torchscript,
+    'onnx': export_onnx,
+    'int8': export_int8
+}
+
+class OnnxModel:
+    """onnxruntime 推理会话，调用方式与 torch 模型一致"""
+    def __init__(self, path, num_threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def eval(self):
+        return self
+
+    def __call__(self, inputs):
+        logits = self.session.run(None, {'input': inputs.numpy()})[0]
+        return torch.from_numpy(logits)
+
+def load_backend(model_path, backend, num_threads=None):
+    """按后端加载模型"""
+    if backend not in BACKENDS:
+        raise ValueError(f'未知的推理后端: {backend}')
+    path = artifact_path(model_path, backend)
+    if backend == 'torch':
+        return load_model(path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'{backend} 模型文件不存在，请先运行 flask export-model: {path}')
+    if backend == 'onnx':
+        return OnnxModel(path, num_threads)
+    return torch.jit.load(path, map_location='cpu')
+
+def parity_check(reference, candidate, input_size, samples=4, batch_size=2, seed=0):
+    """用随机输入比较候选模型与 float 模型的输出（sigmoid 之后的概率）"""
+    generator = torch.Generator().manual_seed(seed)
+    max_diff = 0.0
+    mean_diffs = []
+    with torch.inference_mode():
+        for _ in range(samples):
+            inputs = torch.randn(batch_size, INPUT_CHANNELS, input_size, input_size, generator=generator)
+            expected = torch.sigmoid(reference(inputs)).numpy()
+            actual = torch.sigmoid(candidate(inputs)).numpy()
+            diff = np.abs(expected - actual)
+            max_diff = max(max_diff, float(diff.max()))
+            mean_diffs.append(float(diff.mean()))
+    return {
+        'max_abs_diff': max_diff,
+        'mean_abs_diff': float(np.mean(mean_diffs))
+    }
@@ -0,0 +1,207 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from flask import current_app
+from app.models import MRISequence, MRISeqItem, PredRecord
+from app import db
+from app.mri.dicom_index import ordered_items
+from app.mri.store import hash_file
+from app.prediction.registry import get_runner
+from app.prediction.cache import cache_key, invalidate_stale, lookup_many, store_many
+from app.prediction.preprocess import preprocess_item
+from app.prediction.service import validate_geometry, save_mask, result_location, infer, prediction_to_dict, record_doctors, link_items
+
+class BatchError(Exception):
+    """批量预测请求错误"""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    """批量预测的切片处理线程池，并发提交的切片由微批调度器合并推理"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=current_app.config['PREDICTION_BATCH_WORKERS'],
+                thread_name_prefix='prediction-batch'
+            )
+        return _executor
+
+def _geometry(spec, default):
+    """切片自带的区域与针位置优先，否则使用请求级别的默认值"""
+    region = spec.get('prostate_region', default[0])
+    needles = spec.get('needle_positions', default[1])
+    if region is None or needles is None:
+        raise BatchError('缺少前列腺区域或穿刺针位置')
+    region, needles = validate_geometry(region, needles)
+    if region is None:
+        raise BatchError('前列腺区域或穿刺针位置格式错误')
+    return region, needles
+
+def plan_batch(data):
+    """解析请求为待预测的切片列表 [(序列项, 区域, 针位置)]
+
+    sequence_ids 按解剖顺序展开整个序列；items 为 [{item_id, prostate_region?, needle_positions?}]。
+    序列项以一条 IN 查询加载。
+    """
+    default = (data.get('prostate_region'), data.get('needle_positions'))
+    sequence_ids = data.get('sequence_ids') or []
+    item_specs = data.get('items') or []
+    if not isinstance(sequence_ids, list) or not isinstance(item_specs, list):
+        raise BatchError('sequence_ids 与 items 必须为列表')
+    if not sequence_ids and not item_specs:
+        raise BatchError('缺少 sequence_ids 或 items')
+
+    slices = []
+    if sequence_ids:
+        found = {seq_id for seq_id, in db.session.query(MRISequence.seq_id).filter(MRISequence.seq_id.in_(sequence_ids))}
+        missing = [seq_id for seq_id in sequence_ids if seq_id not in found]
+        if missing:
+            raise BatchError(f'序列不存在: {missing}', 404)
+        region, needles = _geometry({}, default)
+        for seq_id in sequence_ids:
+            slices.extend((item, region, needles) for item, _ in ordered_items(seq_id))
+
+    if item_specs:
+        if not all(isinstance(spec, dict) and 'item_id' in spec for spec in item_specs):
+            raise BatchError('items 中的每一项都需要 item_id')
+        items = {
+            item.item_id: item
+            for item in MRISeqItem.query.filter(MRISeqItem.item_id.in_([spec['item_id'] for spec in item_specs]))
+        }
+        missing = [spec['item_id'] for spec in item_specs if spec['item_id'] not in items]
+        if missing:
+            raise BatchError(f'序列项不存在: {missing}', 404)
+        for spec in item_specs:
+            slices.append((items[spec['item_id']],) + _geometry(spec, default))
+
+    max_items = current_app.config['PREDICTION_BATCH_MAX_ITEMS']
+    if len(slices) > max_items:
+        raise BatchError(f'单次最多预测 {max_items} 个切片', 413)
+    return slices
+
+def _predict_slice(app, runner, task):
+    """在工作线程中预处理、推理并保存结果文件，不访问数据库"""
+    with app.app_context():
+        inputs, crop, shape, _ = preprocess_item(task['path'], task['digest'], task['region'], task['needles'])
+        probabilities = infer(inputs, runner)
+        # 相同内容的多个切片共用一个结果文件，以第一个切片命名
+        result_path, full_result_path = result_location(task['items'][0]['seq_id'], task['items'][0]['item_name'])
+        save_mask(probabilities, crop, shape, full_result_path)
+        return result_path, os.path.getsize(full_result_path)
+
+def _slice_line(item, **fields):
+    line = {'item_id': item['item_id'], 'sequence_id': item['seq_id']}
+    line.update(fields)
+    return line
+
+def run_batch(slices, doctor_id=None):
+    """逐个产出已完成切片的结果行，最后一次性写入所有预测记录、关联与缓存条目
+
+    缓存命中的切片立即返回；其余切片并发提交，由微批调度器合并为批推理。
+    doctor_id 为发起预测的医生，与所有结果（含命中缓存的）一起记录到 pred_doctor。
+    """
+    # 整批固定同一个模型，批处理期间发生热替换时缓存键、掩码与记录的版本仍然一致
+    with get_runner().acquire() as runner:
+        yield from _run_batch(slices, doctor_id, runner)
+
+def _run_batch(slices, doctor_id, runner):
+    model_version = runner.model_version
+    invalidate_stale(model_version)
+
+    tasks = {}
+    for item, region, needles in slices:
+        digest = item.content_hash or hash_file(item.file_path)
+        key = cache_key(digest, model_version, region, needles)
+        # 内容与参数相同的切片（如不同序列中的同一图像）只推理一次，结果行与关联按切片分别产出
+        task = tasks.setdefault(key, {
+            'key': key,
+            'path': item.file_path,
+            'digest': digest,
+            'region': region,
+            'needles': needles,
+            'items': []
+        })
+        task['items'].append({'item_id': item.item_id, 'item_name': item.item_name, 'seq_id': item.seq_id})
+
+    summary = {'type': 'summary', 'total': len(slices), 'cached': 0, 'predicted': 0, 'failed': 0}
+    cached = lookup_many(list(tasks))
+    for key, prediction in cached.items():
+        for item in tasks[key]['items']:
+            summary['cached'] += 1
+            yield _slice_line(item, type='slice', cached=True, prediction=prediction_to_dict(prediction))
+
+    app = current_app._get_current_object()
+    executor = _get_executor()
+    futures = {
+        executor.submit(_predict_slice, app, runner, task): task
+        for key, task in tasks.items() if key not in cached
+    }
+
+    finished = []
+    try:
+        for future in as_completed(futures):
+            task = futures[future]
+            error = future.exception()
+            if error is not None:
+                summary['failed'] += len(task['items'])
+                current_app.logger.error(f"Error in batch prediction for items {[item['item_id'] for item in task['items']]}: {str(error)}")
+                for item in task['items']:
+                    yield _slice_line(item, type='error', error='预测失败')
+                continue
+            result_path, size_bytes = future.result()
+            finished.append((task, result_path, size_bytes))
+            for item in task['items']:
+                summary['predicted'] += 1
+                yield _slice_line(item, type='slice', cached=False, result_name=result_path)
+    finally:
+        # 客户端中途断开时也写入已完成的切片
+        # 命中的缓存结果可能来自其他序列的相同切片，也关联到本次请求的切片
+        cached_links = [
+            (prediction.pred_id, prediction.pred_time, item['item_id'], item['seq_id'])
+            for key, prediction in cached.items() for item in tasks[key]['items']
+        ]
+        pred_ids = _bulk_save(finished, model_version, cached_links, doctor_id)
+
+    summary['predictions'] = [
+        {'item_id': item['item_id'], 'id': pred_ids[result_path], 'result_name': result_path}
+        for task, result_path, _ in finished for item in task['items']
+    ]
+    yield summary
+
+def _bulk_save(finished, model_version, cached_links, doctor_id):
+    """批量写入预测记录、序列项关联、医生关联与缓存条目，返回 {结果名: pred_id}
+
+    cached_links 为命中缓存的 [(pred_id, pred_time, item_id, seq_id)]。结果名唯一，插入后按结果名取回自增ID
+    （MySQL 不支持 INSERT ... RETURNING）。
+    """
+    link_items(cached_links)
+    record_doctors([(link[0], doctor_id) for link in cached_links])
+    if not finished:
+        db.session.commit()
+        return {}
+    now = datetime.utcnow()
+    db.session.execute(db.insert(PredRecord), [
+        {'result_name': result_path, 'pred_time': now, 'model_version': model_version}
+        for _, result_path, _ in finished
+    ])
+    pred_ids = dict(db.session.query(PredRecord.result_name, PredRecord.pred_id).filter(
+        PredRecord.result_name.in_([result_path for _, result_path, _ in finished])
+    ))
+    # 同一结果关联到所有内容相同的切片
+    link_items([
+        (pred_ids[result_path], now, item['item_id'], item['seq_id'])
+        for task, result_path, _ in finished for item in task['items']
+    ])
+    store_many([
+        (task['key'], pred_ids[result_path], size_bytes) for task, result_path, size_bytes in finished
+    ], model_version)
+    record_doctors([(pred_id, doctor_id) for pred_id in pred_ids.values()])
+    db.session.commit()
+    return pred_ids
@@ -0,0 +1,125 @@
+import queue
+import threading
+import time
+from collections import deque, defaultdict
+from concurrent.futures import Future
+from flask import current_app
+from app.prediction.engine import latency_summary
+from app.prediction.registry import get_runner
+
+# 统计时保留的最近批次数
+STATS_WINDOW = 1000
+
+class _Request:
+    __slots__ = ('inputs', 'runner', 'future', 'enqueued_at')
+
+    def __init__(self, inputs, runner):
+        self.inputs = inputs
+        self.runner = runner
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+class MicroBatcher:
+    """动态微批调度：收集并发请求，达到最大批大小或最长等待时间后合并为一批推理"""
+    def __init__(self, runner, max_batch_size, max_wait_ms, timeout=None):
+        self.runner = runner
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._batch_sizes = deque(maxlen=STATS_WINDOW)
+        self._queue_waits = deque(maxlen=STATS_WINDOW)
+        self._batch_latencies = deque(maxlen=STATS_WINDOW)
+        self._thread = threading.Thread(target=self._loop, name='prediction-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, inputs, runner=None):
+        """提交单个输入 (C, H, W)，返回 Future，结果为 (1, H, W) 概率图
+
+        runner 为调用方固定的推理后端（见 ModelHandle.acquire），默认使用调度器的后端。
+        """
+        request = _Request(inputs, runner or self.runner)
+        self._queue.put(request)
+        return request.future
+
+    def predict(self, inputs, timeout=None, runner=None):
+        return self.submit(inputs, runner).result(timeout or self.timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = batch[0].enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            # 不同尺寸的输入无法堆叠，按尺寸分组分别推理；模型替换期间新旧模型的请求也分开
+            groups = defaultdict(list)
+            for request in batch:
+                groups[(id(request.runner), request.inputs.shape)].append(request)
+            for requests in groups.values():
+                self._run(requests)
+
+    def _run(self, requests):
+        # 进程池返回的 Future 异步完成，调度线程可以继续收集下一批
+        start = time.perf_counter()
+        try:
+            future = requests[0].runner.submit_batch([request.inputs for request in requests])
+        except Exception as e:
+            for request in requests:
+                request.future.set_exception(e)
+            return
+        future.add_done_callback(lambda done: self._complete(requests, start, done))
+
+    def _complete(self, requests, start, done):
+        error = done.exception()
+        if error is not None:
+            for request in requests:
+                request.future.set_exception(error)
+            return
+
+        for request, output in zip(requests, done.result()):
+            request.future.set_result(output)
+
+        self._batch_sizes.append(len(requests))
+        self._queue_waits.extend((start - request.enqueued_at) * 1000 for request in requests)
+        self._batch_latencies.append((time.perf_counter() - start) * 1000)
+
+    def stats(self):
+        batch_sizes = list(self._batch_sizes)
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'queued': self._queue.qsize(),
+            'batches': len(batch_sizes),
+            'mean_batch_size': round(sum(batch_sizes) / len(batch_sizes), 2) if batch_sizes else None,
+            'queue_wait_ms': latency_summary(list(self._queue_waits)),
+            'batch_latency_ms': latency_summary(list(self._batch_latencies))
+        }
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+def get_batcher():
+    """获取当前工作进程的微批调度器单例"""
+    global _batcher
+    if _batcher is not None:
+        return _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            config = current_app.config
+            _batcher = MicroBatcher(
+                get_runner(),
+                config['PREDICTION_MAX_BATCH_SIZE'],
+                config['PREDICTION_MAX_WAIT_MS'],
+                config['PREDICTION_TIMEOUT']
+            )
+        return _batcher
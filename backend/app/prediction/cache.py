@@ -0,0 +1,148 @@
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime
+from flask import current_app
+from app.models import PredCacheEntry, PredRecord
+from app.prediction.preprocess import canonical_params, config_signature
+from app import db
+
+# 每个工作进程已清理过旧版本缓存的模型版本
+_invalidated_versions = set()
+# 每写入多少个缓存条目检查一次总条目数与总字节数
+EVICT_INTERVAL = 64
+
+_writes = 0
+_writes_lock = threading.Lock()
+
+def cache_key(image_digest, model_version, region, needles):
+    """由图像内容、模型版本、规范化参数及影响结果的配置计算缓存键"""
+    region, needles = canonical_params(region, needles)
+    config = current_app.config
+    payload = json.dumps({
+        'image': image_digest,
+        'model': model_version,
+        'region': region,
+        'needles': needles,
+        'preprocess': config_signature(),
+        'threshold': config['PREDICTION_THRESHOLD']
+    }, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def invalidate_stale(model_version):
+    """删除其他模型版本产生的缓存条目"""
+    if model_version in _invalidated_versions:
+        return
+    PredCacheEntry.query.filter(PredCacheEntry.model_version != model_version).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+    _invalidated_versions.add(model_version)
+
+def lookup(key):
+    """命中时返回已有的 PredRecord，结果文件已不存在的条目视为失效"""
+    entry = PredCacheEntry.query.get(key)
+    if entry is None:
+        return None
+
+    prediction = PredRecord.query.get(entry.pred_id)
+    full_result_path = os.path.join(current_app.config['UPLOAD_FOLDER'], prediction.result_name) if prediction else None
+    if prediction is None or not os.path.exists(full_result_path):
+        db.session.delete(entry)
+        return None
+
+    entry.hits += 1
+    entry.last_hit_at = datetime.utcnow()
+    return prediction
+
+def lookup_many(keys):
+    """批量查询缓存，返回 {缓存键: PredRecord}，只发出两条查询"""
+    if not keys:
+        return {}
+    entries = PredCacheEntry.query.filter(PredCacheEntry.cache_key.in_(keys)).all()
+    predictions = {
+        prediction.pred_id: prediction
+        for prediction in PredRecord.query.filter(
+            PredRecord.pred_id.in_([entry.pred_id for entry in entries])
+        )
+    } if entries else {}
+
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    now = datetime.utcnow()
+    hits = {}
+    for entry in entries:
+        prediction = predictions.get(entry.pred_id)
+        if prediction is None or not os.path.exists(os.path.join(upload_folder, prediction.result_name)):
+            db.session.delete(entry)
+            continue
+        entry.hits += 1
+        entry.last_hit_at = now
+        hits[entry.cache_key] = prediction
+    return hits
+
+def store(key, prediction, model_version, size_bytes):
+    """记录缓存条目（在调用方的事务中），每写入 EVICT_INTERVAL 个条目按条目数与总字节数淘汰一次"""
+    db.session.merge(PredCacheEntry(
+        cache_key=key,
+        pred_id=prediction.pred_id,
+        model_version=model_version,
+        size_bytes=size_bytes,
+        last_hit_at=datetime.utcnow()
+    ))
+    db.session.flush()
+    _count_writes(1)
+
+def store_many(entries, model_version):
+    """批量记录缓存条目 [(缓存键, pred_id, 字节数), ...]，一条语句写入后统一淘汰"""
+    if not entries:
+        return
+    now = datetime.utcnow()
+    PredCacheEntry.query.filter(
+        PredCacheEntry.cache_key.in_([key for key, _, _ in entries])
+    ).delete(synchronize_session=False)
+    db.session.execute(db.insert(PredCacheEntry), [{
+        'cache_key': key,
+        'pred_id': pred_id,
+        'model_version': model_version,
+        'size_bytes': size_bytes,
+        'hits': 0,
+        'created_at': now,
+        'last_hit_at': now
+    } for key, pred_id, size_bytes in entries])
+    _count_writes(len(entries))
+
+def _count_writes(count):
+    """累计写入条目数，达到间隔时淘汰；统计总量需要扫描整张表，不在每次未命中时执行"""
+    global _writes
+    with _writes_lock:
+        due = _writes // EVICT_INTERVAL != (_writes + count) // EVICT_INTERVAL
+        _writes += count
+    if due:
+        evict()
+
+def evict():
+    """条目数或总字节数超过上限时删除最久未命中的条目，返回删除的条目数（在调用方的事务中）"""
+    config = current_app.config
+    max_entries = config['PREDICTION_CACHE_MAX_ENTRIES']
+    max_bytes = config['PREDICTION_CACHE_MAX_BYTES']
+
+    count, total = db.session.query(
+        db.func.count(PredCacheEntry.cache_key),
+        db.func.coalesce(db.func.sum(PredCacheEntry.size_bytes), 0)
+    ).one()
+    if count <= max_entries and total <= max_bytes:
+        return 0
+
+    # 只删除缓存条目，预测记录与结果文件作为病历保留
+    evicted = []
+    for key, size in db.session.query(
+        PredCacheEntry.cache_key, PredCacheEntry.size_bytes
+    ).order_by(PredCacheEntry.last_hit_at).yield_per(500):
+        if count <= max_entries and total <= max_bytes:
+            break
+        evicted.append(key)
+        count -= 1
+        total -= size
+    PredCacheEntry.query.filter(PredCacheEntry.cache_key.in_(evicted)).delete(synchronize_session=False)
+    return len(evicted)
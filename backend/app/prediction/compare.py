@@ -0,0 +1,142 @@
+import os
+import json
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from flask import current_app
+from app.models import PredRecord
+from app.utils.cache import LRUCache
+from app.prediction.masks import read_mask
+from app.prediction.service import prediction_to_dict
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def _get_cache():
+    """比较结果缓存（每个工作进程一份），预测结果不会改变，以预测ID集合为键"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LRUCache(
+                current_app.config['COMPARE_CACHE_MAX_BYTES'],
+                lambda value: len(json.dumps(value))
+            )
+        return _cache
+
+def load_masks(predictions):
+    """并行读取并解码掩码，返回与 predictions 对应的列表，读取失败的为 None"""
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    logger = current_app.logger
+
+    def load(prediction):
+        try:
+            return read_mask(os.path.join(upload_folder, prediction.result_name)).astype(bool)
+        except Exception as e:
+            logger.error(f"Error loading mask for prediction {prediction.pred_id}: {str(e)}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=current_app.config['COMPARE_WORKERS']) as executor:
+        return list(executor.map(load, predictions))
+
+def overlap_metrics(masks):
+    """成对的 Dice 与 IoU：N 个掩码展平为 (N, P) 矩阵，交集为一次矩阵乘法"""
+    flat = np.stack([mask.ravel() for mask in masks]).astype(np.float32)
+    areas = flat.sum(axis=1)
+    intersection = flat @ flat.T
+    total = areas[:, None] + areas[None, :]
+    union = total - intersection
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # 两个都为空的掩码视为完全一致
+        dice = np.where(total > 0, 2 * intersection / total, 1.0)
+        iou = np.where(union > 0, intersection / union, 1.0)
+    return areas, dice, iou
+
+def hausdorff_matrix(masks):
+    """成对的边界 Hausdorff 距离（像素）
+
+    每个掩码只做一次距离变换；对每个掩码 j 取其边界点，在所有掩码的距离图上一次取值，
+    得到各掩码到 j 的有向距离，整体为 N 次向量化操作而不是 N² 次。
+    """
+    kernel = np.ones((3, 3), dtype=np.uint8)
+    boundaries, distances = [], []
+    for mask in masks:
+        mask = mask.astype(np.uint8)
+        boundary = mask - cv2.erode(mask, kernel)
+        boundaries.append(np.flatnonzero(boundary))
+        # 到最近边界点的距离：distanceTransform 计算到最近零值像素的距离
+        distances.append(cv2.distanceTransform((boundary == 0).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE).ravel())
+    distances = np.stack(distances)
+
+    count = len(masks)
+    directed = np.full((count, count), np.nan, dtype=np.float32)
+    for j, points in enumerate(boundaries):
+        if len(points):
+            # directed[i, j] = j 的边界点到 i 的边界的最大距离
+            directed[:, j] = distances[:, points].max(axis=1)
+    # 空掩码没有边界，与其相关的距离无定义
+    empty = np.array([len(points) == 0 for points in boundaries])
+    directed[empty, :] = np.nan
+    return np.maximum(directed, directed.T)
+
+def _metric(value):
+    value = float(value)
+    return None if np.isnan(value) else round(value, 4)
+
+def compare(predictions, masks):
+    """按掩码尺寸分组计算成对指标，尺寸不同或读取失败的组合指标为 None"""
+    ids = [prediction.pred_id for prediction in predictions]
+    areas = {}
+    pairs = {}
+
+    groups = defaultdict(list)
+    for index, mask in enumerate(masks):
+        if mask is not None:
+            groups[mask.shape].append(index)
+
+    for indices in groups.values():
+        group = [masks[index] for index in indices]
+        group_areas, dice, iou = overlap_metrics(group)
+        hausdorff = hausdorff_matrix(group)
+        for a, i in enumerate(indices):
+            areas[ids[i]] = int(group_areas[a])
+            for b in range(a + 1, len(indices)):
+                j = indices[b]
+                pairs[(i, j)] = {
+                    'dice': _metric(dice[a, b]),
+                    'iou': _metric(iou[a, b]),
+                    'area_difference': int(group_areas[b] - group_areas[a]),
+                    'hausdorff': _metric(hausdorff[a, b])
+                }
+
+    empty = {'dice': None, 'iou': None, 'area_difference': None, 'hausdorff': None}
+    return {
+        'predictions': [dict(prediction_to_dict(prediction), area_pixels=areas.get(prediction.pred_id))
+                        for prediction in predictions],
+        'pairs': [
+            dict({'a': ids[i], 'b': ids[j]}, **pairs.get((i, j), empty))
+            for i in range(len(ids)) for j in range(i + 1, len(ids))
+        ]
+    }
+
+def compare_predictions(prediction_ids):
+    """比较一组预测，返回 (结果, 未找到的ID)；一条 IN 查询取出所有记录，结果按ID集合缓存"""
+    ids = sorted(set(prediction_ids))
+    cache = _get_cache()
+    key = tuple(ids)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached, []
+
+    predictions = PredRecord.query.filter(PredRecord.pred_id.in_(ids)).order_by(PredRecord.pred_id).all()
+    missing = sorted(set(ids) - {prediction.pred_id for prediction in predictions})
+    if not predictions:
+        return None, missing
+
+    masks = load_masks(predictions)
+    result = compare(predictions, masks)
+    # 有记录缺失或掩码读取失败时不缓存，以免之后的请求仍得到不完整的结果
+    if not missing and all(mask is not None for mask in masks):
+        cache.put(key, result)
+    return result, missing
@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+import torch
+from app.mri.store import hash_file
+
+# 模型输入通道：0 归一化图像，1 前列腺区域掩膜，2 穿刺针位置热图
+INPUT_CHANNELS = 3
+
+# 统计稳态延迟时保留的最近请求数
+LATENCY_WINDOW = 1000
+
+def latency_summary(values):
+    """延迟统计（毫秒）：mean/p50/p95/max"""
+    if not values:
+        return None
+    values = np.asarray(values, dtype=np.float64)
+    return {
+        'mean': round(float(values.mean()), 2),
+        'p50': round(float(np.percentile(values, 50)), 2),
+        'p95': round(float(np.percentile(values, 95)), 2),
+        'max': round(float(values.max()), 2)
+    }
+
+def model_version_for(model_path, model_version=None, backend='torch'):
+    """模型版本：未指定时使用模型文件内容的哈希；非 float 后端的输出略有差异，版本中带上后端名"""
+    version = model_version or hash_file(model_path)[:16]
+    return version if backend == 'torch' else f'{version}-{backend}'
+
+def load_model(model_path):
+    """加载模型：优先按 TorchScript 加载，否则按完整的 nn.Module 反序列化"""
+    try:
+        return torch.jit.load(model_path, map_location='cpu')
+    except RuntimeError:
+        return torch.load(model_path, map_location='cpu')
+
+class InferenceEngine:
+    """CPU 推理引擎，每个工作进程只加载一次模型"""
+    def __init__(self, model_path, input_size, num_threads=None, model_version=None, backend='torch'):
+        self.model_path = model_path
+        self.backend = backend
+        self.model_version = model_version_for(model_path, model_version, backend)
+        self.input_size = input_size
+        self.num_threads = num_threads
+        self.model = None
+        self.cold_start_ms = None
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._count = 0
+        # 同一时刻只运行一次前向计算，避免多个请求线程争抢 torch 的计算线程
+        self._lock = threading.Lock()
+
+    def load(self):
+        """加载模型并用空输入预热，记录冷启动耗时"""
+        start = time.perf_counter()
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        from app.prediction.backends import load_backend
+        model = load_backend(self.model_path, self.backend, self.num_threads)
+        model.eval()
+        self.model = model
+        self.warmup()
+        self.cold_start_ms = round((time.perf_counter() - start) * 1000, 2)
+        return self
+
+    def warmup(self):
+        dummy = np.zeros((1, INPUT_CHANNELS, self.input_size, self.input_size), dtype=np.float32)
+        self._forward(dummy)
+
+    def _forward(self, batch):
+        with self._lock, torch.inference_mode():
+            logits = self.model(torch.from_numpy(batch))
+            return torch.sigmoid(logits).numpy()
+
+    def predict_batch(self, batch):
+        """batch 为 (N, C, H, W) float32，返回 (N, 1, H, W) 概率图"""
+        start = time.perf_counter()
+        output = self._forward(np.ascontiguousarray(batch, dtype=np.float32))
+        elapsed = (time.perf_counter() - start) * 1000
+        self._latencies.append(elapsed)
+        self._count += 1
+        return output
+
+    def submit_batch(self, inputs):
+        """同步执行一批输入 [(C, H, W), ...]，返回已完成的 Future（与进程池接口一致）"""
+        future = Future()
+        try:
+            future.set_result(self.predict_batch(np.stack(inputs)))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def predict(self, inputs):
+        """单个输入 (C, H, W)，返回 (1, H, W) 概率图"""
+        return self.predict_batch(inputs[np.newaxis])[0]
+
+    def stats(self):
+        return {
+            'model_path': self.model_path,
+            'model_version': self.model_version,
+            'backend': self.backend,
+            'num_threads': torch.get_num_threads(),
+            'cold_start_ms': self.cold_start_ms,
+            'requests': self._count,
+            'steady_state_ms': latency_summary(list(self._latencies))
+        }
@@ -0,0 +1,153 @@
+import base64
+import cv2
+import numpy as np
+
+# 计算网格的最大像素数，防止过大的区域或治疗半径导致网格过大
+MAX_GRID_PIXELS = 4096 * 4096
+
+class GeometryError(Exception):
+    """针覆盖计算错误"""
+
+def encode_array(array):
+    """以 base64 返回小端原始数组，客户端按 shape/dtype 还原"""
+    array = np.ascontiguousarray(array)
+    return {
+        'dtype': array.dtype.newbyteorder('<').str,
+        'shape': list(array.shape),
+        'data': base64.b64encode(array.astype(array.dtype.newbyteorder('<'), copy=False).tobytes()).decode()
+    }
+
+class CoverageGrid:
+    """前列腺区域的栅格化网格，所有候选布局共用，区域只栅格化一次
+
+    给出像素间距 (行, 列, mm) 时按较小的间距重采样为各向同性网格，距离与面积以 mm / mm² 计；
+    否则以原图像素计。网格只覆盖区域外接框向外扩展 radius 的范围，与针的位置无关；
+    网格外的针（不可能覆盖区域）到区域的距离直接计算，几十根针的开销很小。
+    """
+    def __init__(self, region, radius, spacing=None):
+        if spacing:
+            row_spacing, col_spacing = spacing
+            self.unit = min(row_spacing, col_spacing)
+            self.scale = np.array([col_spacing / self.unit, row_spacing / self.unit], dtype=np.float32)
+        else:
+            self.unit = 1.0
+            self.scale = np.ones(2, dtype=np.float32)
+
+        points = region * self.scale
+        pad = int(np.ceil(radius / self.unit)) + 1
+        self.origin = np.floor(points.min(axis=0)) - pad
+        width, height = (np.ceil(points.max(axis=0)) - self.origin + pad + 1).astype(int)
+        if width * height > MAX_GRID_PIXELS:
+            raise GeometryError('区域与治疗半径范围过大')
+        self.shape = (int(height), int(width))
+
+        mask = np.zeros(self.shape, dtype=np.uint8)
+        cv2.fillPoly(mask, [np.round(self.to_grid(region)).astype(np.int32)], 1)
+        # 统计与距离图只在区域外接框内计算
+        rows, cols = np.nonzero(mask)
+        if len(rows):
+            self.box = (int(rows.min()), int(rows.max()) + 1, int(cols.min()), int(cols.max()) + 1)
+        else:
+            self.box = (0, 0, 0, 0)
+        r0, r1, c0, c1 = self.box
+        self.mask = mask[r0:r1, c0:c1].astype(bool)
+        self.area = int(self.mask.sum())
+
+    @property
+    def box_pixels(self):
+        r0, r1, c0, c1 = self.box
+        return (r1 - r0) * (c1 - c0)
+
+    def to_grid(self, points):
+        """原图像素坐标 -> 网格坐标"""
+        return points * self.scale - self.origin
+
+    def distance_maps(self, needles):
+        """区域外接框内到最近针的距离图与最近针序号图
+
+        网格内的针所在像素置 0 后做一次精确距离变换；再做一次带标签的距离变换，
+        每个零值像素一个标签，经查找表映射为针的序号。网格外的针逐根直接计算距离后取较小者。
+        """
+        r0, r1, c0, c1 = self.box
+        points = self.to_grid(needles)
+        cols, rows = np.round(points).astype(int).T
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+
+        if inside.any():
+            seeds = np.ones(self.shape, dtype=np.uint8)
+            seeds[rows[inside], cols[inside]] = 0
+            distance = cv2.distanceTransform(seeds, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)[r0:r1, c0:c1]
+            _, labels = cv2.distanceTransformWithLabels(seeds, cv2.DIST_L2, cv2.DIST_MASK_5, labelType=cv2.DIST_LABEL_PIXEL)
+            lookup = np.full(labels.max() + 1, -1, dtype=np.int16)
+            lookup[labels[rows[inside], cols[inside]]] = np.flatnonzero(inside).astype(np.int16)
+            nearest = lookup[labels[r0:r1, c0:c1]]
+        else:
+            distance = np.full((r1 - r0, c1 - c0), np.inf, dtype=np.float32)
+            nearest = np.full((r1 - r0, c1 - c0), -1, dtype=np.int16)
+
+        grid_rows = np.arange(r0, r1, dtype=np.float32)[:, None]
+        grid_cols = np.arange(c0, c1, dtype=np.float32)[None, :]
+        for index in np.flatnonzero(~inside):
+            x, y = points[index]
+            direct = np.sqrt((grid_cols - x) ** 2 + (grid_rows - y) ** 2)
+            closer = direct < distance
+            distance[closer] = direct[closer]
+            nearest[closer] = index
+        return distance * np.float32(self.unit), nearest
+
+    def evaluate(self, needles, radius, include_maps=False):
+        """一个针布局的覆盖率：区域内距任一针不超过 radius 的比例，以及各针负责的覆盖面积"""
+        pixel_area = self.unit ** 2
+        if not len(needles) or not self.area:
+            return {
+                'needles': len(needles),
+                'coverage': 0.0,
+                'covered_area': 0.0,
+                'uncovered_area': round(self.area * pixel_area, 2),
+                'max_distance': None,
+                'mean_distance': None,
+                'per_needle_area': [0.0] * len(needles)
+            }
+
+        distance, nearest = self.distance_maps(needles)
+        inside = distance[self.mask]
+        covered = inside <= radius
+        covered_count = int(covered.sum())
+        per_needle = np.bincount(nearest[self.mask][covered], minlength=len(needles))
+
+        result = {
+            'needles': len(needles),
+            'coverage': round(covered_count / self.area, 4),
+            'covered_area': round(covered_count * pixel_area, 2),
+            'uncovered_area': round((self.area - covered_count) * pixel_area, 2),
+            # 区域内离针最远的点，即最大的覆盖空隙
+            'max_distance': round(float(inside.max()), 2),
+            'mean_distance': round(float(inside.mean()), 2),
+            'per_needle_area': [round(float(count) * pixel_area, 2) for count in per_needle]
+        }
+        if include_maps:
+            r0, _, c0, _ = self.box
+            result['maps'] = {
+                # 距离图左上角的网格坐标 (x, y)，原图坐标 = (网格坐标 + origin) / scale
+                'origin': (self.origin + np.array([c0, r0])).tolist(),
+                'scale': self.scale.tolist(),
+                'distance': encode_array(distance),
+                'nearest_needle': encode_array(nearest),
+                'region': encode_array(self.mask.astype(np.uint8))
+            }
+        return result
+
+def plan_coverage(region, layouts, radius, spacing=None, include_maps=False, max_map_pixels=None):
+    """批量评估多个候选针布局，区域栅格化与网格只构建一次
+
+    距离图裁剪到区域外接框；max_map_pixels 限制所有布局的距离图总像素数，避免响应过大。
+    """
+    grid = CoverageGrid(region, radius, spacing)
+    if include_maps and max_map_pixels is not None and grid.box_pixels * len(layouts) > max_map_pixels:
+        raise GeometryError('距离图过大，请减少布局数量或不返回距离图')
+    return {
+        'unit': 'mm' if spacing else 'pixel',
+        'radius': radius,
+        'region_area': round(grid.area * grid.unit ** 2, 2),
+        'layouts': [grid.evaluate(needles, radius, include_maps) for needles in layouts]
+    }
@@ -0,0 +1,113 @@
+import json
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import current_app
+from app.models import MRISequence, PredJob
+from app import db
+from app.prediction.service import validate_geometry, run_prediction, prediction_to_dict, doctor_id_for
+from app.utils.workers import worker_id, is_orphaned
+
+TERMINAL_STATUSES = ('succeeded', 'failed')
+ACTIVE_STATUSES = ('pending', 'running')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    """执行异步预测任务的线程池（每个工作进程只创建一次）"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=current_app.config['PREDICTION_JOB_WORKERS'],
+                thread_name_prefix='prediction-job'
+            )
+        return _executor
+
+def job_to_dict(job):
+    return {
+        'job_id': job.job_id,
+        'status': job.status,
+        'progress': job.progress,
+        'stage': job.stage,
+        'message': job.message,
+        'prediction': prediction_to_dict(job.prediction) if job.prediction else None,
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    }
+
+def submit_job(data, user_id):
+    """记录任务并提交后台执行，任务状态持久化在数据库中，断线重连后可继续查询"""
+    job = PredJob(
+        job_id=uuid.uuid4().hex,
+        params=json.dumps({
+            'sequence_id': data['sequence_id'],
+            'image_path': data['image_path'],
+            'prostate_region': data['prostate_region'],
+            'needle_positions': data['needle_positions']
+        }),
+        worker=worker_id(),
+        created_by=user_id
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    app = current_app._get_current_object()
+    _get_executor().submit(_run_job, app, job.job_id)
+    return job
+
+def _update(job, **fields):
+    for key, value in fields.items():
+        setattr(job, key, value)
+    db.session.commit()
+
+def _run_job(app, job_id):
+    with app.app_context():
+        job = PredJob.query.get(job_id)
+        try:
+            _update(job, status='running', stage='running', progress=0.05)
+            params = json.loads(job.params)
+            sequence = MRISequence.query.get(params['sequence_id'])
+            if not sequence:
+                raise ValueError('序列不存在')
+            region, needles = validate_geometry(params['prostate_region'], params['needle_positions'])
+
+            prediction, _ = run_prediction(
+                sequence, params['image_path'], region, needles,
+                progress=lambda fraction, stage: _update(job, progress=fraction, stage=stage),
+                doctor_id=doctor_id_for(job.created_by)
+            )
+            db.session.flush()
+            _update(
+                job,
+                status='succeeded',
+                stage='done',
+                progress=1.0,
+                pred_id=prediction.pred_id,
+                finished_at=datetime.utcnow()
+            )
+        except Exception as e:
+            db.session.rollback()
+            job = PredJob.query.get(job_id)
+            _update(job, status='failed', message=str(e)[:255], finished_at=datetime.utcnow())
+            app.logger.error(f"Error in prediction job {job_id}: {str(e)}")
+        finally:
+            db.session.remove()
+
+def recover_jobs():
+    """将执行进程已不存在的 pending/running 任务标记为失败，轮询与 SSE 的客户端随即收到结束状态
+
+    在应用启动时调用；同一主机上其他仍在运行的工作进程的任务不受影响。
+    """
+    recovered = 0
+    for job in PredJob.query.filter(PredJob.status.in_(ACTIVE_STATUSES)):
+        if not is_orphaned(job.worker):
+            continue
+        job.status = 'failed'
+        job.message = '服务重启，任务已中断，请重新提交'
+        job.finished_at = datetime.utcnow()
+        recovered += 1
+    db.session.commit()
+    return recovered
@@ -0,0 +1,115 @@
+import os
+import struct
+import cv2
+import numpy as np
+from app.mri.pixels import apply_window
+from app.mri.render import RENDER_FORMATS, decoded_slice
+
+# 掩码文件：魔数、编码方式、行数、列数，之后为编码数据
+MASK_MAGIC = b'MSK1'
+MASK_HEADER = struct.Struct('<4sBII')
+MASK_EXTENSION = '.mask'
+MASK_MIMETYPE = 'application/octet-stream'
+
+# 编码方式：按位打包（仅二值掩码）或游程编码（支持标签掩码）
+ENCODING_PACKBITS = 0
+ENCODING_RLE = 1
+ENCODING_NAMES = {ENCODING_PACKBITS: 'packbits', ENCODING_RLE: 'rle'}
+
+# 叠加显示的默认颜色（BGR）与不透明度
+OVERLAY_COLOR = (0, 0, 255)
+OVERLAY_ALPHA = 0.4
+
+def encode_rle(flat):
+    """游程编码：变化位置由一次 np.diff 得到，返回 (各段取值 uint8, 各段长度 uint32)"""
+    boundaries = np.concatenate(([0], np.flatnonzero(np.diff(flat)) + 1, [flat.size]))
+    return flat[boundaries[:-1]].astype(np.uint8), np.diff(boundaries).astype(np.uint32)
+
+def decode_rle(values, lengths):
+    return np.repeat(values, lengths)
+
+def encode_mask(mask):
+    """编码二维 uint8 掩码，二值掩码在按位打包与游程编码中取较小者"""
+    mask = np.ascontiguousarray(mask, dtype=np.uint8)
+    rows, cols = mask.shape
+    flat = mask.ravel()
+
+    values, lengths = encode_rle(flat)
+    candidates = [(ENCODING_RLE, struct.pack('<I', len(values)) + values.tobytes() + lengths.tobytes())]
+    if flat.max(initial=0) <= 1:
+        candidates.append((ENCODING_PACKBITS, np.packbits(flat).tobytes()))
+    encoding, payload = min(candidates, key=lambda candidate: len(candidate[1]))
+    return MASK_HEADER.pack(MASK_MAGIC, encoding, rows, cols) + payload
+
+def decode_mask(data):
+    """解码为二维 uint8 掩码（二值掩码取值 0/1）"""
+    magic, encoding, rows, cols = MASK_HEADER.unpack_from(data)
+    if magic != MASK_MAGIC:
+        raise ValueError('掩码文件格式错误')
+    payload = memoryview(data)[MASK_HEADER.size:]
+
+    if encoding == ENCODING_PACKBITS:
+        flat = np.unpackbits(np.frombuffer(payload, dtype=np.uint8), count=rows * cols)
+    elif encoding == ENCODING_RLE:
+        count, = struct.unpack_from('<I', payload)
+        values = np.frombuffer(payload, dtype=np.uint8, count=count, offset=4)
+        lengths = np.frombuffer(payload, dtype=np.uint32, count=count, offset=4 + count)
+        flat = decode_rle(values, lengths)
+    else:
+        raise ValueError(f'未知的掩码编码: {encoding}')
+    return flat.reshape(rows, cols)
+
+def mask_info(path):
+    """掩码文件的 (编码名称, 行数, 列数)，只读取文件头"""
+    with open(path, 'rb') as f:
+        _, encoding, rows, cols = MASK_HEADER.unpack(f.read(MASK_HEADER.size))
+    return ENCODING_NAMES.get(encoding), rows, cols
+
+def write_mask(mask, path):
+    """原子写入掩码文件"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(encode_mask(mask))
+    os.replace(tmp_path, path)
+
+def read_mask(path):
+    """读取掩码为 0/1 数组；兼容以 PNG 保存的旧结果"""
+    if not path.endswith(MASK_EXTENSION):
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise IOError(f'无法读取预测结果: {path}')
+        return (image > 0).astype(np.uint8)
+    with open(path, 'rb') as f:
+        return decode_mask(f.read())
+
+def render_mask(mask, output_format='png'):
+    """将掩码渲染为 0/255 的图像"""
+    extension, mimetype, params = RENDER_FORMATS[output_format]
+    ok, buffer = cv2.imencode(extension, mask * np.uint8(255), params)
+    if not ok:
+        raise ValueError('图像编码失败')
+    return buffer.tobytes(), mimetype
+
+def render_overlay(item, mask, level=None, window=None, alpha=OVERLAY_ALPHA, color=OVERLAY_COLOR, output_format='png'):
+    """按窗位窗宽渲染源切片，并将掩码区域以半透明颜色叠加、勾勒轮廓"""
+    extension, mimetype, params = RENDER_FORMATS[output_format]
+    pixels, (default_level, default_window) = decoded_slice(item)
+    gray = apply_window(
+        pixels,
+        default_level if level is None else level,
+        default_window if window is None else window
+    )
+    if mask.shape != gray.shape:
+        mask = cv2.resize(mask, (gray.shape[1], gray.shape[0]), interpolation=cv2.INTER_NEAREST)
+
+    image = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+    selected = mask > 0
+    # 只对掩码内的像素做加权混合
+    image[selected] = (image[selected] * (1 - alpha) + np.array(color, dtype=np.float32) * alpha).astype(np.uint8)
+    contours, _ = cv2.findContours(selected.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    cv2.drawContours(image, contours, -1, color, 1)
+
+    ok, buffer = cv2.imencode(extension, image, params)
+    if not ok:
+        raise ValueError('图像编码失败')
+    return buffer.tobytes(), mimetype
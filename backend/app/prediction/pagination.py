@@ -0,0 +1,58 @@
+import json
+import base64
+from datetime import datetime
+from app.models import PredRecord
+from app import db
+
+# 每页默认条数与上限
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(pred_time, *ids):
+    """以最后一条记录的 (pred_time, pred_id, …) 作为游标"""
+    payload = json.dumps([pred_time.isoformat(), *ids])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, size=2):
+    """解析由 size 个值组成的游标，格式错误时抛出 ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list) or len(values) != size:
+            raise ValueError
+        return (datetime.fromisoformat(values[0]),) + tuple(int(value) for value in values[1:])
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError('游标格式错误')
+
+def page_size(value):
+    if value is None:
+        return DEFAULT_PAGE_SIZE
+    if value <= 0:
+        raise ValueError('limit 须为正整数')
+    return min(value, MAX_PAGE_SIZE)
+
+def _record_key(row):
+    prediction = row if isinstance(row, PredRecord) else row[0]
+    return prediction.pred_time, prediction.pred_id
+
+def keyset_page(query, cursor, limit, columns=(PredRecord.pred_time, PredRecord.pred_id), key=_record_key):
+    """按 (时间, ID, …) 倒序做游标分页，返回 (本页行, 下一页游标)
+
+    条件展开为 OR/AND 形式，便于 MySQL 在 (…, 时间, ID, …) 索引上做范围扫描；
+    多取一条判断是否还有下一页，不使用 OFFSET，每页耗时与页码无关。
+    columns 为排序的时间列与一个或多个ID列，组合起来必须在结果中唯一，否则跨页时会漏掉键相同的行；
+    key 从一行中取出与 columns 对应的值，默认每一行为 PredRecord 或第一列为 PredRecord 的元组。
+    """
+    if cursor:
+        values = decode_cursor(cursor, len(columns))
+        query = query.filter(db.or_(*(
+            db.and_(*[column == value for column, value in zip(columns[:i], values[:i])], columns[i] < values[i])
+            for i in range(len(columns))
+        )))
+    rows = query.order_by(*[column.desc() for column in columns]).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(*key(rows[-1]))
+    return rows, next_cursor
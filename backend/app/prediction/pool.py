@@ -0,0 +1,217 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from app.prediction.engine import InferenceEngine, latency_summary, model_version_for
+
+# 统计时保留的最近任务数
+STATS_WINDOW = 1000
+
+def _attach(name):
+    """子进程附加到父进程创建的共享内存，只关闭不删除，由父进程负责释放
+
+    spawn 的子进程与父进程共用同一个 resource_tracker，子进程不能注销登记，
+    否则父进程 unlink 时 tracker 报错，父进程崩溃时共享内存也无法回收。
+    """
+    return SharedMemory(name=name)
+
+def _worker_main(task_queue, result_queue, current_task, model_path, model_version, input_size, num_threads, backend):
+    """推理工作进程：加载一次模型，从共享内存读取输入并把输出写回共享内存
+
+    current_task 为与父进程共享的整数，记录正在处理的任务ID（空闲时为 -1），
+    进程意外退出时父进程据此让该任务失败，而不是等到超时。
+    """
+    engine = InferenceEngine(model_path, input_size, num_threads, model_version, backend).load()
+    result_queue.put(('ready', os.getpid(), engine.cold_start_ms))
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        task_id, in_name, in_shape, out_name, out_shape = task
+        current_task.value = task_id
+        in_shm = out_shm = None
+        try:
+            in_shm = _attach(in_name)
+            out_shm = _attach(out_name)
+            # 直接在共享内存上构造数组视图，输入不经过 pickle
+            inputs = np.ndarray(in_shape, dtype=np.float32, buffer=in_shm.buf)
+            outputs = np.ndarray(out_shape, dtype=np.float32, buffer=out_shm.buf)
+            outputs[...] = engine.predict_batch(inputs)
+            del inputs, outputs
+            result_queue.put(('done', task_id, None))
+        except Exception as e:
+            result_queue.put(('done', task_id, str(e) or e.__class__.__name__))
+        finally:
+            current_task.value = -1
+            for shm in (in_shm, out_shm):
+                if shm is not None:
+                    shm.close()
+
+def _release(*segments):
+    for shm in segments:
+        shm.close()
+        shm.unlink()
+
+class InferencePool:
+    """多进程 CPU 推理池：每个进程分得一部分 torch 线程，张量经共享内存传递"""
+    def __init__(self, model_path, model_version, input_size, workers, num_threads, backend='torch'):
+        self.model_path = model_path
+        self.backend = backend
+        # 传给工作进程的是原始版本，由其按后端补全
+        self._base_version = model_version
+        self.model_version = model_version_for(model_path, model_version, backend)
+        self.input_size = input_size
+        self.workers = workers
+        self.threads_per_worker = max(1, num_threads // workers)
+        # spawn 避免在已启动多线程的 Web 进程中 fork
+        self._context = multiprocessing.get_context('spawn')
+        self._task_queue = self._context.Queue()
+        self._result_queue = self._context.Queue()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._task_ids = itertools.count()
+        # 进程 -> 共享的当前任务ID
+        self._processes = {}
+        self._ready = {}
+        self._latencies = deque(maxlen=STATS_WINDOW)
+        self._closed = False
+
+        for _ in range(workers):
+            self._spawn()
+        threading.Thread(target=self._dispatch, name='inference-pool', daemon=True).start()
+
+    def _spawn(self):
+        current_task = self._context.Value('q', -1, lock=False)
+        process = self._context.Process(
+            target=_worker_main,
+            args=(
+                self._task_queue, self._result_queue, current_task, self.model_path,
+                self._base_version, self.input_size, self.threads_per_worker, self.backend
+            ),
+            daemon=True
+        )
+        process.start()
+        self._processes[process] = current_task
+
+    def submit_batch(self, inputs):
+        """提交一批输入 [(C, H, W), ...]，返回 Future，结果为 (N, 1, H, W) 概率图"""
+        count = len(inputs)
+        in_shape = (count,) + inputs[0].shape
+        out_shape = (count, 1) + inputs[0].shape[1:]
+        in_shm = SharedMemory(create=True, size=int(np.prod(in_shape)) * 4)
+        out_shm = SharedMemory(create=True, size=int(np.prod(out_shape)) * 4)
+        # 直接堆叠到共享内存中，省去中间数组
+        np.stack(inputs, out=np.ndarray(in_shape, dtype=np.float32, buffer=in_shm.buf))
+
+        task_id = next(self._task_ids)
+        future = Future()
+        with self._pending_lock:
+            self._pending[task_id] = (future, in_shm, out_shm, out_shape, time.perf_counter())
+        self._task_queue.put((task_id, in_shm.name, in_shape, out_shm.name, out_shape))
+        return future
+
+    def predict_batch(self, batch):
+        return self.submit_batch(list(batch)).result()
+
+    def _dispatch(self):
+        """接收工作进程的完成通知，并重启意外退出的工作进程
+
+        每轮循环都检查工作进程是否存活，繁忙时也能及时发现崩溃的进程。
+        """
+        while not self._closed:
+            self._restart_dead()
+            try:
+                message = self._result_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            kind, key, payload = message
+            if kind == 'ready':
+                self._ready[key] = payload
+                continue
+
+            with self._pending_lock:
+                task = self._pending.pop(key, None)
+            # 任务已因进程退出或进程池关闭而失败
+            if task is None:
+                continue
+            future, in_shm, out_shm, out_shape, start = task
+            try:
+                if payload is None:
+                    output = np.ndarray(out_shape, dtype=np.float32, buffer=out_shm.buf).copy()
+                    self._latencies.append((time.perf_counter() - start) * 1000)
+                    future.set_result(output)
+                else:
+                    future.set_exception(RuntimeError(payload))
+            finally:
+                _release(in_shm, out_shm)
+
+    def _fail(self, task_ids, message):
+        """让指定任务失败并释放其共享内存"""
+        with self._pending_lock:
+            tasks = [self._pending.pop(task_id) for task_id in task_ids if task_id in self._pending]
+        for future, in_shm, out_shm, _, _ in tasks:
+            future.set_exception(RuntimeError(message))
+            _release(in_shm, out_shm)
+
+    def wait_ready(self, timeout):
+        """等待所有工作进程加载并预热完毕，超时则关闭进程池并抛出异常"""
+        deadline = time.monotonic() + timeout
+        while len(self._ready) < self.workers:
+            if time.monotonic() > deadline:
+                self.close(drain_timeout=0)
+                raise RuntimeError('推理进程加载模型超时')
+            time.sleep(0.1)
+        return self
+
+    def close(self, drain_timeout=None):
+        """等待进行中的任务完成后停止工作进程（模型热替换后释放旧进程池）
+
+        超时仍未完成的任务直接失败并释放共享内存，调用方不必等到推理超时。
+        """
+        deadline = None if drain_timeout is None else time.monotonic() + drain_timeout
+        while self._pending and (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.05)
+        self._closed = True
+        processes = list(self._processes)
+        for _ in processes:
+            self._task_queue.put(None)
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        with self._pending_lock:
+            leftover = list(self._pending)
+        self._fail(leftover, '推理进程池已关闭')
+
+    def _restart_dead(self):
+        """重启意外退出的工作进程，并让其正在处理的任务失败"""
+        for process, current_task in list(self._processes.items()):
+            if process.is_alive():
+                continue
+            del self._processes[process]
+            self._ready.pop(process.pid, None)
+            if current_task.value >= 0:
+                self._fail([current_task.value], f'推理进程意外退出 (exitcode={process.exitcode})')
+            if not self._closed:
+                self._spawn()
+
+    def stats(self):
+        return {
+            'model_path': self.model_path,
+            'model_version': self.model_version,
+            'backend': self.backend,
+            'workers': self.workers,
+            'threads_per_worker': self.threads_per_worker,
+            'ready_workers': len(self._ready),
+            'cold_start_ms': dict(self._ready),
+            'in_flight': len(self._pending),
+            'task_latency_ms': latency_summary(list(self._latencies))
+        }
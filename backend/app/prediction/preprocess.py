@@ -0,0 +1,249 @@
+import os
+import io
+import json
+import hashlib
+import threading
+import uuid
+import cv2
+import numpy as np
+from flask import current_app
+from app.mri.pixels import load_pixels
+
+# 穿刺针位置热图的高斯半径（像素，相对于模型输入尺寸）
+NEEDLE_SIGMA = 3.0
+# 预处理流程版本，算法或缓存格式变化时递增使旧缓存失效
+PREPROCESS_VERSION = 2
+# 每写入多少个缓存文件检查一次目录总大小
+PRUNE_INTERVAL = 64
+# 针热图一次广播计算的最大字节数，针较多或分块推理的大图时分组计算
+HEATMAP_CHUNK_BYTES = 64 * 1024 * 1024
+
+_writes = 0
+_writes_lock = threading.Lock()
+
+def preprocess_config():
+    """影响预处理结果的配置，参与缓存键"""
+    config = current_app.config
+    return {
+        'version': PREPROCESS_VERSION,
+        'input_size': config['PREDICTION_INPUT_SIZE'],
+        'tiled': config['PREDICTION_TILED'],
+        'crop_margin': config['PREPROCESS_CROP_MARGIN'],
+        'clip': [config['PREPROCESS_CLIP_LOW'], config['PREPROCESS_CLIP_HIGH']],
+        'needle_sigma': NEEDLE_SIGMA
+    }
+
+def config_signature():
+    """预处理配置的短摘要，也用于预测结果缓存键"""
+    payload = json.dumps(preprocess_config(), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+def crop_box(shape, region, margin):
+    """区域外接框按边距扩展为正方形并限制在图像内，返回 (y0, y1, x0, x1)"""
+    rows, cols = shape
+    x_min, y_min = region.min(axis=0)
+    x_max, y_max = region.max(axis=0)
+    side = max(x_max - x_min, y_max - y_min) * (1 + 2 * margin)
+    side = int(np.ceil(min(max(side, 1), rows, cols)))
+    cx, cy = (x_min + x_max) / 2, (y_min + y_max) / 2
+    x0 = int(np.clip(np.round(cx - side / 2), 0, cols - side))
+    y0 = int(np.clip(np.round(cy - side / 2), 0, rows - side))
+    return y0, y0 + side, x0, x0 + side
+
+def normalize_intensity(image, clip_low, clip_high):
+    """按百分位截断后做 z-score 标准化（原地）"""
+    low, high = np.percentile(image, [clip_low, clip_high])
+    np.clip(image, low, high, out=image)
+    image -= image.mean()
+    image /= image.std() + 1e-6
+    return image
+
+def needle_heatmap(points, size, sigma=NEEDLE_SIGMA):
+    """所有针位置的高斯热图取最大值
+
+    二维高斯可分离为行、列两个一维高斯的外积，广播得到 (N, H, W) 后沿 N 取最大；
+    中间数组按 HEATMAP_CHUNK_BYTES 分组，避免大图上占用过多内存。
+    """
+    heatmap = np.zeros((size, size), dtype=np.float32)
+    if not len(points):
+        return heatmap
+    grid = np.arange(size, dtype=np.float32)
+    gx = np.exp(-(grid[None, :] - points[:, 0:1]) ** 2 / (2 * sigma ** 2))
+    gy = np.exp(-(grid[None, :] - points[:, 1:2]) ** 2 / (2 * sigma ** 2))
+    chunk = max(1, HEATMAP_CHUNK_BYTES // (size * size * 4))
+    for start in range(0, len(points), chunk):
+        group = gy[start:start + chunk, :, None] * gx[start:start + chunk, None, :]
+        np.maximum(heatmap, group.max(axis=0), out=heatmap)
+    return heatmap
+
+def prepare_image(pixels, region):
+    """裁剪到前列腺区域、截断标准化并重采样到模型输入尺寸，返回 (图像 (H, W), 裁剪框 (y0, y1, x0, x1))
+
+    只依赖图像与区域，与针位置无关，可在不同针布局之间复用。
+    分块推理时大于模型输入尺寸的区域保持原分辨率，由滑动窗口推理。
+    """
+    config = preprocess_config()
+    y0, y1, x0, x1 = crop_box(pixels.shape, region, config['crop_margin'])
+    size = config['input_size']
+    if config['tiled']:
+        size = max(size, y1 - y0)
+
+    # 先裁剪再重采样，只处理区域附近的像素
+    interpolation = cv2.INTER_AREA if y1 - y0 >= size else cv2.INTER_LINEAR
+    image = cv2.resize(pixels[y0:y1, x0:x1], (size, size), interpolation=interpolation)
+    return normalize_intensity(image.astype(np.float32, copy=False), *config['clip']), (y0, y1, x0, x1)
+
+def model_inputs(image, crop, region, needles):
+    """由预处理后的图像加上区域掩码与针热图组成模型输入 (C, H, W)，坐标变换只做一次数组运算"""
+    y0, y1, x0, x1 = crop
+    size = image.shape[0]
+    # 原图坐标 -> 裁剪后的模型输入坐标
+    offset = np.array([x0, y0], dtype=np.float32)
+    scale = np.float32(size / (x1 - x0))
+
+    mask = np.zeros((size, size), dtype=np.float32)
+    cv2.fillPoly(mask, [np.round((region - offset) * scale).astype(np.int32)], 1.0)
+    heatmap = needle_heatmap((needles - offset) * scale, size)
+    return np.stack([image, mask, heatmap]).astype(np.float32, copy=False)
+
+class TiledInputs:
+    """分块推理的模型输入：只保存标准化后的单通道图像，区域掩码与针热图按窗口生成
+
+    不构建完整的 (C, H, W) 张量，也不为补零复制整幅输入；形状接口与数组一致。
+    """
+    def __init__(self, image, crop, region, needles):
+        y0, y1, x0, x1 = crop
+        offset = np.array([x0, y0], dtype=np.float32)
+        scale = np.float32(image.shape[0] / (x1 - x0))
+        self.image = image
+        self.region = (region - offset) * scale
+        self.needles = (needles - offset) * scale
+        self.shape = (3,) + image.shape
+
+    def window(self, y, x, size):
+        """左上角为 (y, x) 的 (C, size, size) 窗口，超出图像的部分补零"""
+        inputs = np.zeros((3, size, size), dtype=np.float32)
+        image = self.image[y:y + size, x:x + size]
+        rows, cols = image.shape
+        inputs[0, :rows, :cols] = image
+
+        shift = np.array([x, y], dtype=np.float32)
+        cv2.fillPoly(inputs[1], [np.round(self.region - shift).astype(np.int32)], 1.0)
+        # 只有窗口附近的针对热图有贡献
+        needles = self.needles - shift
+        reach = 4 * NEEDLE_SIGMA
+        needles = needles[np.all((needles > -reach) & (needles < size + reach), axis=1)]
+        inputs[2] = needle_heatmap(needles, size)
+        inputs[1:, rows:, :] = 0
+        inputs[1:, :, cols:] = 0
+        return inputs
+
+def preprocess(pixels, region, needles):
+    """完整的预处理，返回 (模型输入 (C, H, W), 裁剪框 (y0, y1, x0, x1))"""
+    image, crop = prepare_image(pixels, region)
+    return model_inputs(image, crop, region, needles), crop
+
+def canonical_params(region, needles):
+    """规范化区域与针位置：坐标保留两位小数，针的先后顺序不影响结果，因此排序"""
+    region = [[round(float(x), 2), round(float(y), 2)] for x, y in region]
+    needles = sorted([round(float(x), 2), round(float(y), 2)] for x, y in needles)
+    return region, needles
+
+def get_preprocess_dir():
+    preprocess_dir = current_app.config['PREPROCESS_CACHE_FOLDER']
+    os.makedirs(preprocess_dir, exist_ok=True)
+    return preprocess_dir
+
+def preprocess_key(image_digest, region):
+    """由图像内容、规范化区域与预处理配置计算缓存键；针位置不参与，换针布局时仍可命中"""
+    region, _ = canonical_params(region, [])
+    payload = json.dumps({
+        'image': image_digest,
+        'region': region,
+        'config': preprocess_config()
+    }, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def _cache_path(key):
+    return os.path.join(get_preprocess_dir(), key[:2], f'{key}.npz')
+
+def _read(path):
+    try:
+        with np.load(path) as data:
+            image, crop = data['image'], tuple(int(v) for v in data['crop'])
+    except (OSError, ValueError, KeyError):
+        return None
+    # 更新修改时间，淘汰时按最近使用排序
+    os.utime(path)
+    return image, crop
+
+def _write(path, image, crop):
+    """先写入内存再原子替换，并发写同一个键时不会读到半个文件"""
+    buffer = io.BytesIO()
+    np.savez(buffer, image=image, crop=np.asarray(crop, dtype=np.int64))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(buffer.getbuffer())
+    os.replace(tmp_path, path)
+
+    global _writes
+    with _writes_lock:
+        _writes += 1
+        due = _writes % PRUNE_INTERVAL == 0
+    if due:
+        prune_cache()
+
+def prune_cache(max_bytes=None):
+    """目录总大小超过上限时删除最久未使用的缓存文件，返回删除的文件数"""
+    max_bytes = current_app.config['PREPROCESS_CACHE_MAX_BYTES'] if max_bytes is None else max_bytes
+    entries = []
+    for root, _, files in os.walk(get_preprocess_dir()):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+def prepared_image(path, image_digest, region):
+    """读取磁盘缓存中标准化后的裁剪图像，未命中时解码、预处理后写入缓存
+
+    返回 (图像, 裁剪框, 原图尺寸 (rows, cols), 是否命中)。
+    """
+    cache_path = _cache_path(preprocess_key(image_digest, region))
+    cached = _read(cache_path) if os.path.exists(cache_path) else None
+    if cached is not None:
+        image, crop = cached
+        return image, crop[:4], crop[4:], True
+
+    pixels = load_pixels(path)
+    image, crop = prepare_image(pixels, region)
+    # 原图尺寸与裁剪框一起保存，命中时无需再解码
+    _write(cache_path, image, crop + pixels.shape)
+    return image, crop, pixels.shape, False
+
+def preprocess_item(path, image_digest, region, needles):
+    """预处理一个切片，返回 (模型输入, 裁剪框, 原图尺寸 (rows, cols), 是否命中缓存)
+
+    解码与标准化的结果按图像内容与区域缓存，针热图每次按请求的针位置生成，开销很小。
+    """
+    image, crop, shape, hit = prepared_image(path, image_digest, region)
+    if image.shape[0] > current_app.config['PREDICTION_INPUT_SIZE']:
+        # 大于模型输入尺寸的原分辨率区域按窗口生成输入，由滑动窗口推理
+        return TiledInputs(image, crop, region, needles), crop, shape, hit
+    return model_inputs(image, crop, region, needles), crop, shape, hit
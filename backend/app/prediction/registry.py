@@ -0,0 +1,280 @@
+import os
+import re
+import json
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from flask import current_app
+from app.mri.store import hash_file
+from app.prediction.engine import InferenceEngine
+from app.prediction.pool import InferencePool
+
+# 版本号只允许用作目录名的安全字符
+VERSION_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+# 版本目录中的模型文件名，各后端的导出文件按 artifact_path 放在同一目录
+MODEL_FILENAME = 'model.pt'
+META_FILENAME = 'meta.json'
+ACTIVE_FILENAME = 'ACTIVE'
+
+class RegistryError(Exception):
+    """模型仓库错误"""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+def get_registry_dir():
+    registry_dir = current_app.config['MODEL_REGISTRY_FOLDER']
+    os.makedirs(registry_dir, exist_ok=True)
+    return registry_dir
+
+def version_dir(version):
+    if not VERSION_PATTERN.match(version or ''):
+        raise RegistryError('版本号只能包含字母、数字、点、下划线和连字符')
+    return os.path.join(get_registry_dir(), version)
+
+def model_file(version):
+    return os.path.join(version_dir(version), MODEL_FILENAME)
+
+def read_meta(version):
+    try:
+        with open(os.path.join(version_dir(version), META_FILENAME), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def list_versions():
+    """已登记的版本，按登记时间排序"""
+    versions = []
+    for name in os.listdir(get_registry_dir()):
+        if VERSION_PATTERN.match(name) and os.path.isdir(os.path.join(get_registry_dir(), name)):
+            meta = read_meta(name)
+            if meta is not None:
+                versions.append(meta)
+    return sorted(versions, key=lambda meta: meta['created_at'])
+
+def register_model(source_path, version=None, notes=None):
+    """复制模型文件到新的版本目录，目录整体原子地出现；版本号默认取文件哈希前 16 位"""
+    digest = hash_file(source_path)
+    version = version or digest[:16]
+    target_dir = version_dir(version)
+    if os.path.exists(target_dir):
+        raise RegistryError(f'版本 {version} 已存在', 409)
+
+    meta = {
+        'version': version,
+        'sha256': digest,
+        'size': os.path.getsize(source_path),
+        'source': os.path.abspath(source_path),
+        'notes': notes,
+        'created_at': datetime.utcnow().isoformat()
+    }
+    tmp_dir = os.path.join(get_registry_dir(), f'.{version}.{uuid.uuid4().hex}.tmp')
+    os.makedirs(tmp_dir)
+    try:
+        shutil.copyfile(source_path, os.path.join(tmp_dir, MODEL_FILENAME))
+        with open(os.path.join(tmp_dir, META_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.rename(tmp_dir, target_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return meta
+
+def _active_path():
+    return os.path.join(get_registry_dir(), ACTIVE_FILENAME)
+
+def get_active_version():
+    try:
+        with open(_active_path(), encoding='utf-8') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def set_active_version(version):
+    """原子地更新激活版本，各工作进程轮询到变化后在后台完成替换"""
+    if read_meta(version) is None:
+        raise RegistryError(f'版本 {version} 不存在', 404)
+    path = _active_path()
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(version)
+    os.replace(tmp_path, path)
+    return version
+
+def active_model():
+    """当前应使用的 (模型路径, 版本)，仓库为空时使用配置中的 MODEL_PATH/MODEL_VERSION"""
+    version = get_active_version()
+    if version:
+        return model_file(version), version
+    return current_app.config['MODEL_PATH'], current_app.config['MODEL_VERSION']
+
+class ModelHandle:
+    """可热替换的推理后端，接口与推理引擎、进程池一致
+
+    激活新版本时在后台线程中加载并预热新模型，旧模型继续处理请求，
+    就绪后原子地切换引用；旧进程池在进行中的任务完成后关闭。
+    """
+    def __init__(self, app):
+        self.app = app
+        self.version = None
+        # 最近一次请求替换的版本，失败的版本不反复重试，直到激活版本再次变化
+        self._target = None
+        self._runner = None
+        # 正在被请求使用的后端及其使用数，替换下来但仍在使用的后端在最后一个请求结束时关闭
+        self._users = {}
+        self._retired = set()
+        self._lock = threading.Lock()
+        self._swapping = False
+        self._last_swap = None
+        self._next_check = 0.0
+
+        with app.app_context():
+            model_path, version = active_model()
+        self._runner = self._build(model_path, version)
+        self.version = self._target = version
+        app.logger.info(f"Inference runner {self._runner.model_version} loaded")
+
+    def _build(self, model_path, version):
+        config = self.app.config
+        if config['PREDICTION_POOL_WORKERS'] > 0:
+            runner = InferencePool(
+                model_path,
+                version,
+                config['PREDICTION_INPUT_SIZE'],
+                config['PREDICTION_POOL_WORKERS'],
+                config['PREDICTION_NUM_THREADS'],
+                config['PREDICTION_BACKEND']
+            )
+            return runner.wait_ready(config['MODEL_SWAP_TIMEOUT'])
+        return InferenceEngine(
+            model_path,
+            config['PREDICTION_INPUT_SIZE'],
+            config['PREDICTION_NUM_THREADS'],
+            version,
+            config['PREDICTION_BACKEND']
+        ).load()
+
+    @property
+    def runner(self):
+        self._check_active()
+        return self._runner
+
+    @property
+    def model_version(self):
+        return self.runner.model_version
+
+    @property
+    def input_size(self):
+        return self._runner.input_size
+
+    def submit_batch(self, inputs):
+        return self.runner.submit_batch(inputs)
+
+    @contextmanager
+    def acquire(self):
+        """在一次请求内固定当前后端：缓存键、推理与记录的版本出自同一模型，期间的替换不会关闭它"""
+        self._check_active()
+        with self._lock:
+            runner = self._runner
+            self._users[runner] = self._users.get(runner, 0) + 1
+        try:
+            yield runner
+        finally:
+            with self._lock:
+                self._users[runner] -= 1
+                retire = False
+                if not self._users[runner]:
+                    del self._users[runner]
+                    retire = runner in self._retired
+                    self._retired.discard(runner)
+            if retire:
+                self._retire(runner)
+
+    def _retire(self, runner):
+        """在后台关闭替换下来的进程池，不阻塞当前请求"""
+        if isinstance(runner, InferencePool):
+            threading.Thread(
+                target=runner.close, args=(self.app.config['PREDICTION_TIMEOUT'],),
+                name='model-retire', daemon=True
+            ).start()
+
+    def predict_batch(self, batch):
+        return self.runner.predict_batch(batch)
+
+    def _check_active(self):
+        """按间隔检查激活版本，其他进程（管理接口或命令行）切换版本后本进程也随之替换"""
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.app.config['MODEL_REGISTRY_POLL_INTERVAL']
+        with self.app.app_context():
+            version = get_active_version()
+        if version and version != self._target:
+            self.swap(version)
+
+    def swap(self, version):
+        """在后台加载指定版本，已有替换在进行时返回 False"""
+        with self._lock:
+            if self._swapping:
+                return False
+            self._swapping = True
+            self._target = version
+        threading.Thread(target=self._swap, args=(version,), name='model-swap', daemon=True).start()
+        return True
+
+    def _swap(self, version):
+        start = time.perf_counter()
+        try:
+            with self.app.app_context():
+                model_path = model_file(version)
+            runner = self._build(model_path, version)
+        except Exception as e:
+            self.app.logger.error(f"Error loading model version {version}: {str(e)}")
+            self._last_swap = {'version': version, 'status': 'failed', 'message': str(e)[:255]}
+            with self._lock:
+                self._swapping = False
+            return
+
+        with self._lock:
+            old, self._runner = self._runner, runner
+            in_use = old in self._users
+            if in_use:
+                self._retired.add(old)
+        self.version = version
+        self._last_swap = {
+            'version': version,
+            'status': 'succeeded',
+            'load_ms': round((time.perf_counter() - start) * 1000, 2),
+            'finished_at': datetime.utcnow().isoformat()
+        }
+        with self._lock:
+            self._swapping = False
+        self.app.logger.info(f"Inference runner swapped to {runner.model_version}")
+        if not in_use:
+            self._retire(old)
+
+    def stats(self):
+        stats = self._runner.stats()
+        stats['registry'] = {
+            'version': self.version,
+            'swapping': self._swapping,
+            'last_swap': self._last_swap
+        }
+        return stats
+
+_handle = None
+_handle_lock = threading.Lock()
+
+def get_runner():
+    """获取当前工作进程的推理后端（配置了工作进程数时为进程池，否则在当前进程内推理）"""
+    global _handle
+    if _handle is not None:
+        return _handle
+    with _handle_lock:
+        if _handle is None:
+            _handle = ModelHandle(current_app._get_current_object())
+        return _handle
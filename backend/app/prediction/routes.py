@@ -1,75 +1,320 @@
 import os
-from flask import Blueprint, request, jsonify, current_app
-from flask_jwt_extended import jwt_required
-from app.models import MRISequence, PredRecord, MRISeqItem
+import time
+from datetime import datetime, timedelta, timezone
+from flask import request, jsonify, current_app, Response, send_file, stream_with_context
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from app.models import MRISequence, PredRecord, MRISeqItem, PredJob, pred_doctor, pred_mri_item
 from app import db
+from app.prediction import bp
+from app.prediction.registry import RegistryError, get_runner, list_versions, get_active_version, set_active_version
+from app.prediction.batching import get_batcher
+from app.prediction.tiling import get_tiler
+from app.prediction.service import validate_geometry, resolve_item, run_prediction, prediction_to_dict, doctor_id_for
+from app.prediction.jobs import TERMINAL_STATUSES, submit_job, job_to_dict
+from app.prediction.batch import BatchError, plan_batch, run_batch
+from app.mri.routes import get_user_type
+from app.mri.render import RENDER_FORMATS
+from app.prediction.pagination import page_size, keyset_page
+from app.prediction.compare import compare_predictions as compare
+from app.prediction.geometry import GeometryError, plan_coverage
+from app.prediction.masks import MASK_EXTENSION, MASK_MIMETYPE, OVERLAY_ALPHA, mask_info, read_mask, render_mask, render_overlay
 import json
 
-bp = Blueprint('prediction', __name__)
+def validate_prediction_request(data):
+    """校验预测请求，返回 (序列, 区域, 针位置, 错误响应)"""
+    # 验证必要字段
+    if not data or not all(k in data for k in ['sequence_id', 'image_path', 'prostate_region', 'needle_positions']):
+        return None, None, None, (jsonify({'error': '缺少必要字段'}), 400)
+    
+    # 验证序列是否存在
+    sequence = MRISequence.query.get(data['sequence_id'])
+    if not sequence:
+        return None, None, None, (jsonify({'error': '序列不存在'}), 404)
+    
+    # 图像必须是该序列中的序列项，只读取序列项记录的存储文件，不接受任意路径
+    if not isinstance(data['image_path'], str):
+        return None, None, None, (jsonify({'error': '图像路径格式错误'}), 400)
+    item = resolve_item(sequence, data['image_path'])
+    if not item:
+        return None, None, None, (jsonify({'error': '图像不属于该序列'}), 404)
+    if not os.path.exists(item.file_path):
+        return None, None, None, (jsonify({'error': '图像文件不存在'}), 404)
+    
+    region, needles = validate_geometry(data['prostate_region'], data['needle_positions'])
+    if region is None:
+        return None, None, None, (jsonify({'error': '前列腺区域或穿刺针位置格式错误'}), 400)
+    
+    return sequence, region, needles, None
 
 @bp.route('', methods=['POST'])
 @jwt_required()
 def create_prediction():
     data = request.get_json()
     
-    # 验证必要字段
-    if not all(k in data for k in ['sequence_id', 'image_path', 'prostate_region', 'needle_positions']):
-        return jsonify({'error': '缺少必要字段'}), 400
+    sequence, region, needles, error = validate_prediction_request(data)
+    if error:
+        return error
     
-    # 验证序列是否存在
-    sequence = MRISequence.query.get(data['sequence_id'])
-    if not sequence:
-        return jsonify({'error': '序列不存在'}), 404
+    # 异步模式：立即返回任务ID，通过轮询或 SSE 获取进度与结果
+    if request.args.get('async', 'false').lower() in ['true', '1']:
+        try:
+            job = submit_job(data, get_jwt_identity())
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Error in create_prediction: {str(e)}")
+            return jsonify({'error': '任务提交失败，请稍后重试'}), 500
+        return jsonify({
+            'message': '预测任务已提交',
+            'job': job_to_dict(job)
+        }), 202
+    
+    try:
+        start = time.perf_counter()
+        prediction, cached = run_prediction(
+            sequence, data['image_path'], region, needles,
+            doctor_id=doctor_id_for(get_jwt_identity())
+        )
+        db.session.commit()
+        elapsed = round((time.perf_counter() - start) * 1000, 2)
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error in create_prediction: {str(e)}")
+        return jsonify({'error': '预测失败，请稍后重试'}), 500
+    
+    return jsonify({
+        'message': '预测完成',
+        'prediction': prediction_to_dict(prediction),
+        'cached': cached,
+        'latency_ms': elapsed
+    }), 200 if cached else 201
+
+@bp.route('/batch', methods=['POST'])
+@jwt_required()
+def create_batch_prediction():
+    """批量预测整个序列或一组序列项，每完成一个切片输出一行 NDJSON"""
+    data = request.get_json() or {}
     
-    # 验证图像是否存在
-    image_path = os.path.join(current_app.config['UPLOAD_FOLDER'], data['image_path'])
-    if not os.path.exists(image_path):
-        return jsonify({'error': '图像文件不存在'}), 404
+    try:
+        slices = plan_batch(data)
+    except BatchError as e:
+        return jsonify({'error': e.message}), e.status_code
     
-    # TODO: 调用预测模型
-    # 这里应该调用实际的预测模型，获取预测结果
-    # 为了演示，我们假设预测结果是保存在一个新的图像文件中
+    doctor_id = doctor_id_for(get_jwt_identity())
     
-    # 生成预测结果图像路径
-    result_filename = f"prediction_{sequence.seq_id}_{os.path.basename(data['image_path'])}"
-    result_path = os.path.join('predictions', result_filename)
-    full_result_path = os.path.join(current_app.config['UPLOAD_FOLDER'], result_path)
+    def lines():
+        try:
+            for line in run_batch(slices, doctor_id):
+                yield json.dumps(line, ensure_ascii=False) + '\n'
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Error in create_batch_prediction: {str(e)}")
+            yield json.dumps({'type': 'error', 'error': '批量预测失败'}, ensure_ascii=False) + '\n'
     
-    # 确保预测结果目录存在
-    os.makedirs(os.path.dirname(full_result_path), exist_ok=True)
+    response = Response(stream_with_context(lines()), mimetype='application/x-ndjson')
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@bp.route('/jobs/<job_id>', methods=['GET'])
+@jwt_required()
+def get_prediction_job(job_id):
+    """轮询异步预测任务"""
+    job = PredJob.query.get_or_404(job_id)
+    return jsonify(job_to_dict(job))
+
+@bp.route('/jobs/<job_id>/events', methods=['GET'])
+@jwt_required()
+def stream_prediction_job(job_id):
+    """以 server-sent events 推送任务进度，任务结束后发送最终结果并关闭连接"""
+    PredJob.query.get_or_404(job_id)
+    interval = current_app.config['PREDICTION_EVENT_INTERVAL']
     
-    # 创建预测记录
-    prediction = PredRecord(
-        result_name=result_path
-    )
+    def events():
+        last = None
+        idle = 0.0
+        while True:
+            # 每次都从数据库读取最新状态（任务可能由其他工作进程执行）
+            job = PredJob.query.get(job_id)
+            payload = job_to_dict(job)
+            finished = job.status in TERMINAL_STATUSES
+            # 结束本次读取的事务，否则 InnoDB 可重复读隔离级别下之后的查询一直看到同一个快照
+            db.session.rollback()
+            if payload != last:
+                event = 'done' if finished else 'progress'
+                yield f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+                last = payload
+                idle = 0.0
+                if event == 'done':
+                    return
+            elif idle >= 15:
+                # 心跳，防止代理因空闲断开连接
+                yield ': keep-alive\n\n'
+                idle = 0.0
+            time.sleep(interval)
+            idle += interval
     
-    db.session.add(prediction)
-    db.session.commit()
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@bp.route('/engine/stats', methods=['GET'])
+@jwt_required()
+def get_engine_stats():
+    """推理引擎的冷启动与稳态延迟统计，微批调度的批大小、排队与批次耗时，以及分块推理统计"""
+    return jsonify({
+        'engine': get_runner().stats(),
+        'batching': get_batcher().stats(),
+        'tiling': get_tiler().stats()
+    })
+
+@bp.route('/models', methods=['GET'])
+@jwt_required()
+def list_models():
+    """模型仓库中的版本、激活版本以及本工作进程正在使用的版本"""
+    runner = get_runner()
+    return jsonify({
+        'versions': list_versions(),
+        'active': get_active_version(),
+        'serving': runner.model_version,
+        'registry': runner.stats()['registry']
+    })
+
+@bp.route('/models/<version>/activate', methods=['POST'])
+@jwt_required()
+def activate_model(version):
+    """激活模型版本（仅管理员）：新模型在后台加载预热，旧模型继续服务直至切换"""
+    user_type, _ = get_user_type(get_jwt_identity())
+    if user_type != 'admin':
+        return jsonify({'error': '需要管理员权限'}), 403
+    
+    try:
+        set_active_version(version)
+    except RegistryError as e:
+        return jsonify({'error': e.message}), e.status_code
     
+    # 本进程立即开始替换，其他工作进程在下次轮询时跟进
+    get_runner().swap(version)
     return jsonify({
-        'message': '预测完成',
-        'prediction': {
-            'id': prediction.pred_id,
-            'result_name': prediction.result_name,
-            'pred_time': prediction.pred_time.isoformat()
-        }
-    }), 201
+        'message': '模型版本已激活，正在后台加载',
+        'active': version
+    }), 202
+
+def parse_date(value, end=False):
+    """解析 ISO 日期或日期时间；只给日期作为结束时间时包含当天
+
+    带时区偏移的时间换算为 UTC 并去掉时区，与数据库中的 UTC 时间比较。
+    """
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    except ValueError:
+        raise ValueError(f'日期格式错误: {value}')
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    if end and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+@bp.route('/history', methods=['GET'])
+@jwt_required()
+def get_prediction_history():
+    """当前医生的预测历史，按时间倒序游标分页（参数 limit、cursor、start、end）
+
+    管理员可通过 doctor_id 参数查看指定医生的历史。
+    """
+    user_type, user_id = get_user_type(get_jwt_identity())
+    doctor_id = request.args.get('doctor_id') if user_type == 'admin' else user_id
+    if not doctor_id:
+        return jsonify({'error': '缺少 doctor_id'}), 400
+    
+    try:
+        limit = page_size(request.args.get('limit', type=int))
+        start = parse_date(request.args.get('start'))
+        end = parse_date(request.args.get('end'), end=True)
+        
+        # 只查询覆盖索引 (doctor_id, pred_time, pred_id) 中的列
+        query = db.session.query(pred_doctor.c.pred_id, pred_doctor.c.pred_time).filter(
+            pred_doctor.c.doctor_id == doctor_id
+        )
+        if start:
+            query = query.filter(pred_doctor.c.pred_time >= start)
+        if end:
+            query = query.filter(pred_doctor.c.pred_time < end)
+        rows, next_cursor = keyset_page(
+            query,
+            request.args.get('cursor'),
+            limit,
+            columns=(pred_doctor.c.pred_time, pred_doctor.c.pred_id),
+            key=lambda row: (row.pred_time, row.pred_id)
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # 本页的记录与关联切片各一条 IN 查询
+    page_ids = [row.pred_id for row in rows]
+    predictions = {
+        prediction.pred_id: prediction
+        for prediction in PredRecord.query.filter(PredRecord.pred_id.in_(page_ids))
+    } if page_ids else {}
+    items = {}
+    if page_ids:
+        for pred_id, item_id, seq_id in db.session.query(
+            pred_mri_item.c.pred_id, pred_mri_item.c.item_id, pred_mri_item.c.seq_id
+        ).filter(pred_mri_item.c.pred_id.in_(page_ids)):
+            items.setdefault(pred_id, {'item_id': item_id, 'sequence_id': seq_id})
+    
+    return jsonify({
+        'predictions': [
+            dict(
+                prediction_to_dict(predictions[row.pred_id]),
+                requested_at=row.pred_time.isoformat(),
+                **items.get(row.pred_id, {'item_id': None, 'sequence_id': None})
+            )
+            for row in rows if row.pred_id in predictions
+        ],
+        'next_cursor': next_cursor
+    })
 
 @bp.route('/sequence/<int:sequence_id>', methods=['GET'])
 @jwt_required()
 def get_sequence_predictions(sequence_id):
+    """序列的预测记录，按 pred_time 倒序游标分页（参数 limit、cursor）
+
+    分页只扫描 pred_mri_item 的 (seq_id, pred_time, pred_id, item_id) 索引，无需排序，每页耗时与页码和序列大小无关。
+    同一预测记录可能关联序列中的多个切片（内容相同的切片），item_id 参与游标，跨页时不会漏掉。
+    """
     # 验证序列是否存在
-    sequence = MRISequence.query.get_or_404(sequence_id)
+    MRISequence.query.get_or_404(sequence_id)
     
-    # 获取序列的所有预测记录
-    predictions = PredRecord.query.join(MRISeqItem).filter(MRISeqItem.seq_id == sequence_id).all()
+    try:
+        limit = page_size(request.args.get('limit', type=int))
+        query = db.session.query(
+            pred_mri_item.c.pred_id, pred_mri_item.c.pred_time, pred_mri_item.c.item_id
+        ).filter(pred_mri_item.c.seq_id == sequence_id)
+        rows, next_cursor = keyset_page(
+            query,
+            request.args.get('cursor'),
+            limit,
+            columns=(pred_mri_item.c.pred_time, pred_mri_item.c.pred_id, pred_mri_item.c.item_id),
+            key=lambda row: (row.pred_time, row.pred_id, row.item_id)
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # 本页的预测记录一条 IN 查询
+    page_ids = [row.pred_id for row in rows]
+    predictions = {
+        prediction.pred_id: prediction
+        for prediction in PredRecord.query.filter(PredRecord.pred_id.in_(page_ids))
+    } if page_ids else {}
     
     return jsonify({
-        'predictions': [{
-            'id': pred.pred_id,
-            'result_name': pred.result_name,
-            'pred_time': pred.pred_time.isoformat()
-        } for pred in predictions]
+        'predictions': [
+            dict(prediction_to_dict(predictions[row.pred_id]), item_id=row.item_id)
+            for row in rows if row.pred_id in predictions
+        ],
+        'next_cursor': next_cursor
     })
 
 @bp.route('/<int:id>', methods=['GET'])
@@ -77,35 +322,154 @@ def get_sequence_predictions(sequence_id):
 def get_prediction(id):
     prediction = PredRecord.query.get_or_404(id)
     
-    return jsonify({
-        'id': prediction.pred_id,
-        'result_name': prediction.result_name,
-        'pred_time': prediction.pred_time.isoformat()
-    })
+    return jsonify(prediction_to_dict(prediction))
+
+def result_file(prediction):
+    """预测结果文件的绝对路径，文件不存在时返回 None"""
+    path = os.path.join(current_app.config['UPLOAD_FOLDER'], prediction.result_name)
+    return path if os.path.exists(path) else None
+
+@bp.route('/<int:id>/mask', methods=['GET'])
+@jwt_required()
+def get_prediction_mask(id):
+    """返回压缩的原始掩码（默认），或 format=png/webp 时渲染为 0/255 图像"""
+    prediction = PredRecord.query.get_or_404(id)
+    path = result_file(prediction)
+    if path is None:
+        return jsonify({'error': '预测结果文件不存在'}), 404
+    
+    output_format = request.args.get('format', 'raw')
+    if output_format != 'raw' and output_format not in RENDER_FORMATS:
+        return jsonify({'error': 'format 须为 raw、png 或 webp'}), 400
+    
+    if output_format == 'raw' and path.endswith(MASK_EXTENSION):
+        # 结果文件不会改变，直接发送并支持条件请求
+        response = send_file(path, mimetype=MASK_MIMETYPE, conditional=True, max_age=86400)
+        encoding, rows, cols = mask_info(path)
+        response.headers['X-Mask-Encoding'] = encoding
+        response.headers['X-Mask-Shape'] = f'{rows},{cols}'
+    else:
+        try:
+            encoded, mimetype = render_mask(read_mask(path), 'png' if output_format == 'raw' else output_format)
+        except Exception as e:
+            current_app.logger.error(f"Error in get_prediction_mask: {str(e)}")
+            return jsonify({'error': '掩码读取失败'}), 500
+        response = Response(encoded, mimetype=mimetype)
+        response.headers['Cache-Control'] = 'max-age=86400'
+    
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+@bp.route('/<int:id>/overlay', methods=['GET'])
+@jwt_required()
+def get_prediction_overlay(id):
+    """将预测掩码叠加到源切片上渲染，参数 level/window/alpha/format"""
+    prediction = PredRecord.query.get_or_404(id)
+    path = result_file(prediction)
+    if path is None:
+        return jsonify({'error': '预测结果文件不存在'}), 404
+    if not prediction.items:
+        return jsonify({'error': '预测记录没有关联的切片'}), 404
+    
+    level = request.args.get('level', type=float)
+    window = request.args.get('window', type=float)
+    alpha = request.args.get('alpha', OVERLAY_ALPHA, type=float)
+    output_format = request.args.get('format', 'png')
+    if output_format not in RENDER_FORMATS:
+        return jsonify({'error': 'format 须为 png 或 webp'}), 400
+    if (window is not None and window <= 0) or not 0 <= alpha <= 1:
+        return jsonify({'error': 'window 须大于 0，alpha 须在 0-1 之间'}), 400
+    
+    try:
+        encoded, mimetype = render_overlay(
+            prediction.items[0], read_mask(path), level, window, alpha, output_format=output_format
+        )
+    except Exception as e:
+        current_app.logger.error(f"Error in get_prediction_overlay: {str(e)}")
+        return jsonify({'error': '叠加图渲染失败'}), 500
+    
+    response = Response(encoded, mimetype=mimetype)
+    response.headers['Cache-Control'] = 'private, max-age=3600'
+    return response
+
+@bp.route('/coverage', methods=['POST'])
+@jwt_required()
+def compute_needle_coverage():
+    """计算针布局对前列腺区域的覆盖率与最近针距离图，可一次评估多个候选布局"""
+    data = request.get_json()
+    if not data or 'prostate_region' not in data or 'radius' not in data:
+        return jsonify({'error': '缺少必要字段'}), 400
+    
+    layouts = data.get('layouts')
+    if layouts is None:
+        if 'needle_positions' not in data:
+            return jsonify({'error': '缺少穿刺针位置'}), 400
+        layouts = [data['needle_positions']]
+    if not isinstance(layouts, list) or not layouts:
+        return jsonify({'error': 'layouts 必须为非空列表'}), 400
+    max_layouts = current_app.config['COVERAGE_MAX_LAYOUTS']
+    if len(layouts) > max_layouts:
+        return jsonify({'error': f'单次最多评估 {max_layouts} 个布局'}), 400
+    
+    parsed = [validate_geometry(data['prostate_region'], needles) for needles in layouts]
+    if any(region is None for region, _ in parsed):
+        return jsonify({'error': '前列腺区域或穿刺针位置格式错误'}), 400
+    
+    try:
+        radius = float(data['radius'])
+    except (TypeError, ValueError):
+        radius = -1
+    if radius <= 0:
+        return jsonify({'error': 'radius 须为正数'}), 400
+    
+    # 给出切片时使用其像素间距，距离与面积以 mm 计
+    spacing = None
+    if data.get('item_id') is not None:
+        item = MRISeqItem.query.get(data['item_id'])
+        if not item:
+            return jsonify({'error': '序列项不存在'}), 404
+        header = item.header
+        if header and header.pixel_spacing_row and header.pixel_spacing_col:
+            spacing = (header.pixel_spacing_row, header.pixel_spacing_col)
+    
+    try:
+        result = plan_coverage(
+            parsed[0][0],
+            [needles for _, needles in parsed],
+            radius,
+            spacing,
+            bool(data.get('include_maps')),
+            current_app.config['COVERAGE_MAX_MAP_PIXELS']
+        )
+    except GeometryError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify(result)
 
 @bp.route('/compare', methods=['POST'])
 @jwt_required()
 def compare_predictions():
+    """成对比较预测掩码：Dice、IoU、面积差与 Hausdorff 距离"""
     data = request.get_json()
     
     # 验证必要字段
-    if 'prediction_ids' not in data or not isinstance(data['prediction_ids'], list):
+    if not data or 'prediction_ids' not in data or not isinstance(data['prediction_ids'], list):
         return jsonify({'error': '缺少预测ID列表'}), 400
+    if not all(isinstance(pred_id, int) for pred_id in data['prediction_ids']):
+        return jsonify({'error': '预测ID必须为整数'}), 400
+    
+    max_predictions = current_app.config['COMPARE_MAX_PREDICTIONS']
+    if len(set(data['prediction_ids'])) > max_predictions:
+        return jsonify({'error': f'单次最多比较 {max_predictions} 个预测'}), 400
     
-    # 获取所有预测记录
-    predictions = []
-    for pred_id in data['prediction_ids']:
-        prediction = PredRecord.query.get(pred_id)
-        if prediction:
-            predictions.append({
-                'id': prediction.pred_id,
-                'result_name': prediction.result_name,
-                'pred_time': prediction.pred_time.isoformat()
-            })
-    
-    if not predictions:
+    try:
+        result, missing = compare(data['prediction_ids'])
+    except Exception as e:
+        current_app.logger.error(f"Error in compare_predictions: {str(e)}")
+        return jsonify({'error': '比较失败，请稍后重试'}), 500
+    
+    if result is None:
         return jsonify({'error': '没有找到有效的预测记录'}), 404
     
-    return jsonify({
-        'predictions': predictions
-    }) 
\ No newline at end of file
+    return jsonify(dict(result, missing=missing))
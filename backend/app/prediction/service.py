@@ -0,0 +1,169 @@
+import os
+import uuid
+from datetime import datetime
+import cv2
+import numpy as np
+from flask import current_app
+from app.models import MRISeqItem, PredRecord, pred_doctor, pred_mri_item
+from app import db
+from app.mri.store import hash_file
+from app.prediction.registry import get_runner
+from app.prediction.batching import get_batcher
+from app.prediction.cache import cache_key, invalidate_stale, lookup, store
+from app.prediction.preprocess import preprocess_item
+from app.prediction.tiling import get_tiler
+from app.prediction.masks import MASK_EXTENSION, write_mask
+
+# 原分辨率概率图按行分段二值化，每段的行数
+MASK_STRIP_ROWS = 256
+
+def validate_geometry(prostate_region, needle_positions):
+    """prostate_region 为多边形顶点 [[x, y], ...]，needle_positions 为针尖坐标 [[x, y], ...]（原图像素坐标）"""
+    try:
+        region = np.asarray(prostate_region, dtype=np.float32)
+        needles = np.asarray(needle_positions, dtype=np.float32).reshape(-1, 2)
+    except (TypeError, ValueError):
+        return None, None
+    if region.ndim != 2 or region.shape[1] != 2 or len(region) < 3:
+        return None, None
+    return region, needles
+
+def resolve_item(sequence, image_path):
+    """根据图像路径找到对应的序列项，只按完整路径精确匹配
+
+    image_path 相对于上传目录，可以是存储路径（file_path），也可以是序列目录中的同名链接；
+    同名但位于其他目录的文件不会匹配。路径在上传目录之外时返回 None。
+    """
+    upload_folder = os.path.realpath(current_app.config['UPLOAD_FOLDER'])
+    if os.path.commonpath([upload_folder, os.path.realpath(os.path.join(upload_folder, image_path))]) != upload_folder:
+        return None
+    full_path = os.path.normpath(os.path.join(current_app.config['UPLOAD_FOLDER'], image_path))
+    conditions = [MRISeqItem.file_path == full_path]
+    if os.path.dirname(full_path) == os.path.normpath(sequence.seq_dir):
+        conditions.append(MRISeqItem.item_name == os.path.basename(full_path))
+    return MRISeqItem.query.filter(
+        MRISeqItem.seq_id == sequence.seq_id,
+        db.or_(*conditions)
+    ).first()
+
+def save_mask(probabilities, crop, shape, result_path):
+    """恢复到裁剪框尺寸后按阈值二值化，放回原图尺寸的空白掩码中，以压缩格式保存
+
+    分块推理的结果已是裁剪框尺寸（可能是临时文件的内存映射），按行分段二值化，不整体复制。
+    """
+    threshold = current_app.config['PREDICTION_THRESHOLD']
+    y0, y1, x0, x1 = crop
+    mask = np.zeros(shape, dtype=np.uint8)
+    target = mask[y0:y1, x0:x1]
+    if probabilities.shape == target.shape:
+        for start in range(0, target.shape[0], MASK_STRIP_ROWS):
+            target[start:start + MASK_STRIP_ROWS] = probabilities[start:start + MASK_STRIP_ROWS] >= threshold
+    else:
+        probabilities = cv2.resize(probabilities, (x1 - x0, y1 - y0), interpolation=cv2.INTER_LINEAR)
+        target[...] = probabilities >= threshold
+    write_mask(mask, result_path)
+
+def result_location(seq_id, image_path):
+    """生成预测结果的相对路径与绝对路径"""
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    result_filename = f"prediction_{seq_id}_{uuid.uuid4().hex[:8]}_{stem}{MASK_EXTENSION}"
+    result_path = os.path.join('predictions', result_filename)
+    full_result_path = os.path.join(current_app.config['UPLOAD_FOLDER'], result_path)
+    os.makedirs(os.path.dirname(full_result_path), exist_ok=True)
+    return result_path, full_result_path
+
+def infer(inputs, runner):
+    """模型输入尺寸的输入交给微批调度器，原分辨率的大区域（TiledInputs）按滑动窗口分块推理，返回 (H, W) 概率图
+
+    runner 为 ModelHandle.acquire() 固定的推理后端，推理与记录的模型版本一致。
+    """
+    if inputs.shape[1:] == (runner.input_size, runner.input_size):
+        return get_batcher().predict(inputs, runner=runner)[0]
+    return get_tiler().predict(inputs, runner)[0]
+
+def prediction_to_dict(prediction):
+    return {
+        'id': prediction.pred_id,
+        'result_name': prediction.result_name,
+        'model_version': prediction.model_version,
+        'pred_time': prediction.pred_time.isoformat()
+    }
+
+def doctor_id_for(user_id):
+    """JWT 身份对应的医生ID，管理员返回 None"""
+    if not user_id or user_id.startswith('admin_'):
+        return None
+    return user_id
+
+def link_items(links):
+    """批量关联 [(pred_id, pred_time, item_id, seq_id)]，已有的关联忽略
+
+    命中其他序列切片产生的缓存结果时，当前切片也关联到该记录。pred_time 为预测记录的时间，
+    与序列ID一起冗余保存，按序列分页时只扫描 (seq_id, pred_time, pred_id) 索引。
+    """
+    rows = [
+        {'pred_id': pred_id, 'pred_time': pred_time, 'item_id': item_id, 'seq_id': seq_id}
+        for pred_id, pred_time, item_id, seq_id in sorted(set(links)) if item_id
+    ]
+    if rows:
+        db.session.execute(pred_mri_item.insert().prefix_with('IGNORE', dialect='mysql'), rows)
+
+def record_doctors(pairs):
+    """批量记录 [(pred_id, doctor_id)]
+
+    已有的关联（如重复提交或并发命中同一缓存结果）由 INSERT IGNORE 跳过，
+    不先查询再插入，并发请求不会因主键冲突而失败。
+    """
+    pairs = {(pred_id, doctor_id) for pred_id, doctor_id in pairs if doctor_id}
+    if not pairs:
+        return
+    now = datetime.utcnow()
+    db.session.execute(pred_doctor.insert().prefix_with('IGNORE', dialect='mysql'), [
+        {'pred_id': pred_id, 'doctor_id': doctor_id, 'pred_time': now}
+        for pred_id, doctor_id in sorted(pairs)
+    ])
+
+def run_prediction(sequence, image_path, region, needles, progress=None, doctor_id=None):
+    """运行推理并保存结果，返回 (PredRecord, 是否命中缓存)，记录已加入会话但尚未提交
+
+    progress(比例, 阶段) 用于异步任务汇报进度；doctor_id 为发起预测的医生，记录到 pred_doctor。
+    """
+    progress = progress or (lambda fraction, stage: None)
+    # 只读取序列项记录的存储文件，请求中的路径仅用于定位序列项
+    item = resolve_item(sequence, image_path)
+    if not item:
+        raise ValueError('图像不属于该序列')
+    full_image_path = item.file_path
+    image_digest = item.content_hash or hash_file(full_image_path)
+
+    # 整个请求固定同一个模型，推理期间发生热替换时缓存键、掩码与记录的版本仍然一致
+    with get_runner().acquire() as runner:
+        model_version = runner.model_version
+        # 相同图像内容、模型版本与参数的预测直接返回已有记录
+        invalidate_stale(model_version)
+        key = cache_key(image_digest, model_version, region, needles)
+        cached = lookup(key)
+        if cached is not None:
+            link_items([(cached.pred_id, cached.pred_time, item.item_id, item.seq_id)])
+            record_doctors([(cached.pred_id, doctor_id)])
+            progress(0.95, 'cached')
+            return cached, True
+
+        # 预处理结果按图像内容与预处理配置缓存在磁盘上，重复预测时跳过解码
+        inputs, crop, shape, _ = preprocess_item(full_image_path, image_digest, region, needles)
+        progress(0.2, 'preprocessed')
+
+        probabilities = infer(inputs, runner)
+        progress(0.8, 'inferred')
+
+    result_path, full_result_path = result_location(sequence.seq_id, item.item_name)
+    save_mask(probabilities, crop, shape, full_result_path)
+    progress(0.95, 'saved')
+
+    prediction = PredRecord(result_name=result_path, model_version=model_version)
+    db.session.add(prediction)
+    db.session.flush()  # 获取pred_id
+    link_items([(prediction.pred_id, prediction.pred_time, item.item_id, item.seq_id)])
+    store(key, prediction, model_version, os.path.getsize(full_result_path))
+    record_doctors([(prediction.pred_id, doctor_id)])
+    return prediction, False
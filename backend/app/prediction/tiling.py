@@ -0,0 +1,135 @@
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+import numpy as np
+from flask import current_app
+from app.prediction.engine import latency_summary
+from app.prediction.registry import get_runner
+
+# 统计时保留的最近请求数
+STATS_WINDOW = 1000
+# 前向计算中间激活相对于输入输出张量的估计倍数，用于由内存预算推算批大小
+ACTIVATION_FACTOR = 16
+# 融合权重的下限，保证图像边缘只被一个窗口覆盖的像素也有权重
+MIN_WEIGHT = 1e-3
+
+def tile_starts(length, tile, stride):
+    """窗口起点：按步长滑动，最后一个窗口贴齐末端"""
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+def blend_window(tile, overlap):
+    """融合权重：重叠区内按余弦从边缘升到 1，二维权重为两个一维权重的外积"""
+    ramp = np.ones(tile, dtype=np.float32)
+    if overlap > 0:
+        edge = 0.5 - 0.5 * np.cos(np.pi * (np.arange(overlap, dtype=np.float32) + 0.5) / overlap)
+        ramp[:overlap] = edge
+        ramp[-overlap:] = edge[::-1]
+    ramp = np.maximum(ramp, MIN_WEIGHT)
+    return np.outer(ramp, ramp)
+
+class TiledPredictor:
+    """滑动窗口推理：重叠窗口按批推理后加权融合
+
+    内存预算约束的是窗口批次（每批窗口数由预算推算）与累加缓冲区（超出预算的四分之一时
+    放在临时文件的内存映射中）。输入窗口由 TiledInputs 按需生成，不构建完整的输入张量；
+    仍与图像尺寸成正比的只有标准化后的单通道图像与最终的 uint8 掩码。
+    """
+    def __init__(self, runner, tile_size, overlap, memory_budget):
+        self.runner = runner
+        self.tile_size = tile_size
+        self.overlap = min(max(0, overlap), tile_size // 2)
+        self.stride = tile_size - self.overlap
+        self.memory_budget = memory_budget
+        self.window = blend_window(tile_size, self.overlap)
+        self._latencies = deque(maxlen=STATS_WINDOW)
+        self._tiles = 0
+        self._spilled = 0
+
+    def batch_size(self, channels):
+        """按预算的一半估算每批窗口数（输入、输出与中间激活）"""
+        per_tile = self.tile_size ** 2 * 4 * (channels + 1) * ACTIVATION_FACTOR
+        return max(1, int(self.memory_budget // 2 // per_tile))
+
+    def _buffer(self, shape):
+        """累加缓冲区，过大时放在匿名临时文件中，由操作系统按需换入换出"""
+        nbytes = int(np.prod(shape)) * 4
+        if nbytes * 2 <= self.memory_budget // 4:
+            return np.zeros(shape, dtype=np.float32)
+        self._spilled += 1
+        spill_dir = current_app.config['CACHE_FOLDER']
+        os.makedirs(spill_dir, exist_ok=True)
+        spill = tempfile.TemporaryFile(dir=spill_dir)
+        spill.truncate(nbytes)
+        return np.memmap(spill, dtype=np.float32, mode='r+', shape=shape)
+
+    def predict(self, inputs, runner=None):
+        """inputs 为 TiledInputs，返回 (1, H, W) 概率图；runner 为调用方固定的推理后端
+
+        缓冲区放在临时文件中时返回的是内存映射的视图，调用方应分段读取而不是整体复制。
+        """
+        runner = runner or self.runner
+        start = time.perf_counter()
+        channels, rows, cols = inputs.shape
+        tile = self.tile_size
+
+        # 小于窗口的维度由窗口补零，推理后再裁掉
+        height, width = max(rows, tile), max(cols, tile)
+
+        origins = [(y, x) for y in tile_starts(height, tile, self.stride) for x in tile_starts(width, tile, self.stride)]
+        accumulated = self._buffer((height, width))
+        weights = self._buffer((height, width))
+        batch_size = self.batch_size(channels)
+
+        for index in range(0, len(origins), batch_size):
+            batch = origins[index:index + batch_size]
+            tiles = [inputs.window(y, x, tile) for y, x in batch]
+            outputs = runner.submit_batch(tiles).result(current_app.config['PREDICTION_TIMEOUT'])
+            for (y, x), output in zip(batch, outputs):
+                accumulated[y:y + tile, x:x + tile] += output[0] * self.window
+                weights[y:y + tile, x:x + tile] += self.window
+            del tiles, outputs
+
+        np.divide(accumulated, weights, out=accumulated)
+        result = accumulated[np.newaxis, :rows, :cols]
+        del accumulated, weights
+
+        self._tiles += len(origins)
+        self._latencies.append((time.perf_counter() - start) * 1000)
+        return result
+
+    def stats(self):
+        return {
+            'tile_size': self.tile_size,
+            'overlap': self.overlap,
+            'memory_budget_mb': round(self.memory_budget / 1024 / 1024, 2),
+            'batch_size': self.batch_size(3),
+            'requests': len(self._latencies),
+            'tiles': self._tiles,
+            'spilled_buffers': self._spilled,
+            'latency_ms': latency_summary(list(self._latencies))
+        }
+
+_tiler = None
+_tiler_lock = threading.Lock()
+
+def get_tiler():
+    """获取当前工作进程的滑动窗口推理器单例，窗口大小即模型输入尺寸"""
+    global _tiler
+    if _tiler is not None:
+        return _tiler
+    with _tiler_lock:
+        if _tiler is None:
+            config = current_app.config
+            _tiler = TiledPredictor(
+                get_runner(),
+                config['PREDICTION_INPUT_SIZE'],
+                config['PREDICTION_TILE_OVERLAP'],
+                config['PREDICTION_MEMORY_BUDGET_MB'] * 1024 * 1024
+            )
+        return _tiler
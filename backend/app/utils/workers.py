@@ -0,0 +1,24 @@
+import os
+import socket
+
+def worker_id():
+    """当前进程的标识（主机名:进程号），记录在后台任务上以便重启后识别中断的任务"""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def is_orphaned(worker):
+    """执行任务的进程是否已不存在
+
+    只能判断本机的进程；其他主机上的任务视为仍在运行。未记录进程的旧任务视为已中断。
+    """
+    if not worker:
+        return True
+    host, _, pid = worker.rpartition(':')
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except (PermissionError, ValueError):
+        return False
+    return False
@@ -1,7 +1,10 @@
 import click
+from flask import current_app
 from flask.cli import with_appcontext
-from app.models import Administrator
+from app.models import Administrator, MRISeqItem
 from app import db
+from app.mri.store import collect_garbage
+from app.mri.upload import expire_sessions
 
 @click.command('create-admin')
 @click.argument('admin_id')
@@ -17,4 +20,101 @@ def create_admin(admin_id, password):
         click.echo(f'成功创建管理员账户 {admin_id}')
     except Exception as e:
         db.session.rollback()
-        click.echo(f'创建管理员账户失败: {str(e)}') 
\ No newline at end of file
+        click.echo(f'创建管理员账户失败: {str(e)}')
+
+@click.command('register-model')
+@click.argument('model_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--version', default=None, help='版本号，默认为模型文件哈希的前 16 位')
+@click.option('--notes', default=None, help='版本说明')
+@click.option('--activate', is_flag=True, help='登记后立即激活')
+@with_appcontext
+def register_model(model_path, version, notes, activate):
+    """将模型文件登记为模型仓库中的新版本"""
+    from app.prediction.registry import RegistryError, register_model as register, set_active_version
+    
+    try:
+        meta = register(model_path, version, notes)
+        if activate:
+            set_active_version(meta['version'])
+    except RegistryError as e:
+        raise click.ClickException(e.message)
+    click.echo(f"成功登记模型版本 {meta['version']}{'（已激活）' if activate else ''}")
+
+@click.command('activate-model')
+@click.argument('version')
+@with_appcontext
+def activate_model(version):
+    """激活模型版本，运行中的工作进程在后台加载新模型后无中断切换"""
+    from app.prediction.registry import RegistryError, set_active_version
+    
+    try:
+        set_active_version(version)
+    except RegistryError as e:
+        raise click.ClickException(e.message)
+    click.echo(f'已激活模型版本 {version}')
+
+@click.command('gc-blobs')
+@click.option('--grace', default=3600, help='宽限期（秒），更新的文件不会被删除')
+@with_appcontext
+def gc_blobs(grace):
+    """清理内容寻址存储中未被任何序列项引用的文件"""
+    def referenced(digests):
+        rows = db.session.query(MRISeqItem.content_hash).filter(
+            MRISeqItem.content_hash.in_(digests)
+        ).distinct().all()
+        return {row[0] for row in rows}
+    
+    removed = collect_garbage(referenced, grace_seconds=grace)
+    click.echo(f'已清理 {removed} 个未引用的文件')
+
+@click.command('gc-uploads')
+@click.option('--ttl', default=None, type=int, help='超过该秒数没有活动的会话被清理，默认为 UPLOAD_SESSION_TTL')
+@with_appcontext
+def gc_uploads(ttl):
+    """清理超时未完成的分块上传会话及其分块文件"""
+    removed = expire_sessions(ttl)
+    click.echo(f'已清理 {removed} 个过期的上传会话')
+
+@click.command('gc-pred-cache')
+@with_appcontext
+def gc_pred_cache():
+    """按 PREDICTION_CACHE_MAX_ENTRIES 与 PREDICTION_CACHE_MAX_BYTES 淘汰最久未命中的预测缓存条目"""
+    from app.prediction.cache import evict
+    
+    removed = evict()
+    db.session.commit()
+    click.echo(f'已淘汰 {removed} 个预测缓存条目')
+
+@click.command('export-model')
+@click.option('--backend', 'backends', multiple=True, default=['torchscript', 'onnx', 'int8'],
+              help='要导出的后端，可重复指定')
+@click.option('--atol', default=1e-3, help='TorchScript/ONNX 与 float 模型输出的最大允许偏差')
+@click.option('--int8-atol', default=5e-2, help='int8 量化模型输出的最大允许偏差')
+@click.option('--version', default=None, help='模型仓库中的版本，默认为激活版本（仓库为空时为 MODEL_PATH）')
+@with_appcontext
+def export_model(backends, atol, int8_atol, version):
+    """导出 TorchScript/ONNX/int8 推理模型并检查输出一致性"""
+    from app.prediction.engine import load_model
+    from app.prediction.backends import EXPORTERS, artifact_path, load_backend, parity_check
+    from app.prediction.registry import active_model, model_file
+    
+    # 导出文件与模型放在同一目录，激活该版本时按后端找到对应文件
+    model_path = model_file(version) if version else active_model()[0]
+    input_size = current_app.config['PREDICTION_INPUT_SIZE']
+    reference = load_model(model_path)
+    reference.eval()
+    
+    failed = False
+    for backend in backends:
+        path = EXPORTERS[backend](reference, input_size, artifact_path(model_path, backend))
+        result = parity_check(reference, load_backend(model_path, backend).eval(), input_size)
+        tolerance = int8_atol if backend == 'int8' else atol
+        passed = result['max_abs_diff'] <= tolerance
+        failed = failed or not passed
+        click.echo(
+            f"{backend}: {path} max_abs_diff={result['max_abs_diff']:.2e} "
+            f"mean_abs_diff={result['mean_abs_diff']:.2e} {'通过' if passed else '超出容差'}"
+        )
+    
+    if failed:
+        raise click.ClickException('存在输出偏差超出容差的后端，请勿在配置中启用')
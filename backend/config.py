@@ -30,6 +30,92 @@ class Config:
     UPLOAD_FOLDER = os.path.join(os.path.dirname(basedir), 'uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max-limit
     
+    # 序列项文件下载：浏览器缓存时间；部署在 nginx 等支持 X-Sendfile 的服务器后可开启
+    ITEM_FILE_MAX_AGE = int(os.environ.get('ITEM_FILE_MAX_AGE', 7 * 24 * 3600))
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', 'false').lower() in ['true', 'on', '1']
+    
+    # 分块上传配置（单个分块必须小于 MAX_CONTENT_LENGTH）
+    UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+    UPLOAD_SESSION_FOLDER = os.path.join(UPLOAD_FOLDER, '.sessions')
+    # 上传会话超过该秒数没有活动时连同分块文件一起清理
+    UPLOAD_SESSION_TTL = int(os.environ.get('UPLOAD_SESSION_TTL', 24 * 3600))
+    
+    # 内容寻址存储目录，相同内容的切片只保存一份
+    BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'blobs')
+    
+    # 派生数据缓存（体数据等），可随时删除后重建
+    CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, 'cache')
+    VOLUME_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'volumes')
+    
+    # 渲染缓存（每个工作进程）：解码后的像素数组与编码后的图像
+    PIXEL_CACHE_MAX_BYTES = int(os.environ.get('PIXEL_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+    RENDER_CACHE_MAX_BYTES = int(os.environ.get('RENDER_CACHE_MAX_BYTES', 128 * 1024 * 1024))
+    
+    # 预览金字塔（缩略图/中等/原始分辨率）
+    PREVIEW_FOLDER = os.path.join(CACHE_FOLDER, 'previews')
+    PREVIEW_WORKERS = int(os.environ.get('PREVIEW_WORKERS', 2))
+    
+    # 序列入库时并行写文件的线程数
+    INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 8))
+    # 解析DICOM头的进程数
+    DICOM_INDEX_WORKERS = int(os.environ.get('DICOM_INDEX_WORKERS', os.cpu_count() or 2))
+    
+    # 异步入库：暂存目录与同时处理的任务数（切片处理使用上面的进程池）
+    INGEST_STAGING_FOLDER = os.path.join(UPLOAD_FOLDER, '.staging')
+    INGEST_JOB_WORKERS = int(os.environ.get('INGEST_JOB_WORKERS', 2))
+    
+    # 预测模型配置（CPU 推理）
+    MODEL_PATH = os.environ.get('MODEL_PATH', os.path.join(basedir, 'models', 'model.pt'))
+    PREDICTION_INPUT_SIZE = int(os.environ.get('PREDICTION_INPUT_SIZE', 256))
+    PREDICTION_NUM_THREADS = int(os.environ.get('PREDICTION_NUM_THREADS', os.cpu_count() or 1))
+    PREDICTION_THRESHOLD = float(os.environ.get('PREDICTION_THRESHOLD', 0.5))
+    # 推理后端：torch/torchscript/onnx/int8，后三者需先运行 flask export-model 导出
+    PREDICTION_BACKEND = os.environ.get('PREDICTION_BACKEND', 'torch')
+    # 模型版本，参与结果缓存键；为空时使用模型文件内容的哈希
+    MODEL_VERSION = os.environ.get('MODEL_VERSION')
+    # 模型仓库：每个版本一个目录，ACTIVE 文件记录激活版本（仓库为空时使用 MODEL_PATH）
+    MODEL_REGISTRY_FOLDER = os.environ.get('MODEL_REGISTRY_FOLDER', os.path.join(basedir, 'models', 'registry'))
+    # 各工作进程检查激活版本的间隔（秒）与加载新模型的最长时间（秒）
+    MODEL_REGISTRY_POLL_INTERVAL = float(os.environ.get('MODEL_REGISTRY_POLL_INTERVAL', 5))
+    MODEL_SWAP_TIMEOUT = float(os.environ.get('MODEL_SWAP_TIMEOUT', 300))
+    # 预测结果缓存上限（条目数与结果文件总字节数）
+    PREDICTION_CACHE_MAX_ENTRIES = int(os.environ.get('PREDICTION_CACHE_MAX_ENTRIES', 10000))
+    PREDICTION_CACHE_MAX_BYTES = int(os.environ.get('PREDICTION_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+    # 微批调度：并发请求合并推理的最大批大小与最长等待时间
+    PREDICTION_MAX_BATCH_SIZE = int(os.environ.get('PREDICTION_MAX_BATCH_SIZE', 8))
+    PREDICTION_MAX_WAIT_MS = float(os.environ.get('PREDICTION_MAX_WAIT_MS', 10))
+    # 等待单个推理结果的最长时间（秒）
+    PREDICTION_TIMEOUT = float(os.environ.get('PREDICTION_TIMEOUT', 120))
+    # 推理进程数，0 表示在 Web 工作进程内推理；PREDICTION_NUM_THREADS 在各进程间平分
+    PREDICTION_POOL_WORKERS = int(os.environ.get('PREDICTION_POOL_WORKERS', 0))
+    # 异步预测任务：并发执行的任务数与 SSE 轮询间隔（秒）
+    PREDICTION_JOB_WORKERS = int(os.environ.get('PREDICTION_JOB_WORKERS', 4))
+    PREDICTION_EVENT_INTERVAL = float(os.environ.get('PREDICTION_EVENT_INTERVAL', 0.5))
+    # 批量预测：处理切片的线程数（应不小于微批大小以填满批次）与单次请求的最大切片数
+    PREDICTION_BATCH_WORKERS = int(os.environ.get('PREDICTION_BATCH_WORKERS', 16))
+    PREDICTION_BATCH_MAX_ITEMS = int(os.environ.get('PREDICTION_BATCH_MAX_ITEMS', 2000))
+    # 分块推理：大于模型输入尺寸的区域以原分辨率按重叠窗口推理，
+    # 每批窗口数与累加缓冲区受内存预算（MB）约束
+    PREDICTION_TILED = os.environ.get('PREDICTION_TILED', 'false').lower() in ['true', 'on', '1']
+    PREDICTION_TILE_OVERLAP = int(os.environ.get('PREDICTION_TILE_OVERLAP', 64))
+    PREDICTION_MEMORY_BUDGET_MB = int(os.environ.get('PREDICTION_MEMORY_BUDGET_MB', 512))
+    # 预处理：区域外接框的扩展比例、强度截断百分位，结果缓存在磁盘上
+    PREPROCESS_CROP_MARGIN = float(os.environ.get('PREPROCESS_CROP_MARGIN', 0.15))
+    PREPROCESS_CLIP_LOW = float(os.environ.get('PREPROCESS_CLIP_LOW', 0.5))
+    PREPROCESS_CLIP_HIGH = float(os.environ.get('PREPROCESS_CLIP_HIGH', 99.5))
+    PREPROCESS_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'preprocessed')
+    PREPROCESS_CACHE_MAX_BYTES = int(os.environ.get('PREPROCESS_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+    # 预测比较：单次最多比较的预测数、并行读取掩码的线程数与结果缓存上限（每个工作进程）
+    COMPARE_MAX_PREDICTIONS = int(os.environ.get('COMPARE_MAX_PREDICTIONS', 50))
+    COMPARE_WORKERS = int(os.environ.get('COMPARE_WORKERS', 8))
+    COMPARE_CACHE_MAX_BYTES = int(os.environ.get('COMPARE_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+    # 针覆盖计算：单次请求最多评估的候选布局数
+    COVERAGE_MAX_LAYOUTS = int(os.environ.get('COVERAGE_MAX_LAYOUTS', 100))
+    # 针覆盖计算：单次请求返回的距离图总像素数上限（各布局之和）
+    COVERAGE_MAX_MAP_PIXELS = int(os.environ.get('COVERAGE_MAX_MAP_PIXELS', 4 * 1024 * 1024))
+    # 启动时即加载并预热模型，否则在首次预测时加载
+    PREDICTION_PRELOAD = os.environ.get('PREDICTION_PRELOAD', 'false').lower() in ['true', 'on', '1']
+    
     # 邮件验证码配置
     VERIFICATION_CODE_EXPIRE = 900  # 15分钟过期
     VERIFICATION_CODE_RESEND_INTERVAL = 60  # 1分钟后可重新发送
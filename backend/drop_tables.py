@@ -23,8 +23,8 @@ cursor.execute('SET FOREIGN_KEY_CHECKS = 0')
 
 # 删除所有表
 tables = [
-    'administrators', 'doctors', 'mri_seq_items', 'mri_sequences',
-    'patients', 'pred_records', 'pred_doctor', 'pred_mri_item',
+    'administrators', 'doctors', 'mri_item_headers', 'ingest_jobs', 'mri_seq_items', 'mri_sequences',
+    'patients', 'pred_records', 'pred_jobs', 'pred_cache', 'pred_doctor', 'pred_mri_item',
     'sequence_item', 'patient_sequence', 'alembic_version'
 ]
 
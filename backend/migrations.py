@@ -1,5 +1,5 @@
 from app import create_app, db
-from app.models import Doctor, Administrator, MRISequence, MRISeqItem, Patient, PredRecord
+from app.models import Doctor, Administrator, MRISequence, MRISeqItem, MRIItemHeader, IngestJob, Patient, PredRecord, PredJob, PredCacheEntry
 
 app = create_app()
 
@@ -11,6 +11,10 @@ def make_shell_context():
         'Administrator': Administrator,
         'MRISequence': MRISequence,
         'MRISeqItem': MRISeqItem,
+        'MRIItemHeader': MRIItemHeader,
+        'IngestJob': IngestJob,
         'Patient': Patient,
-        'PredRecord': PredRecord
+        'PredRecord': PredRecord,
+        'PredJob': PredJob,
+        'PredCacheEntry': PredCacheEntry
     } 
\ No newline at end of file
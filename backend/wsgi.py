@@ -12,10 +12,16 @@ sys.path.insert(0, current_dir)
 logger.debug(f"Python path: {sys.path}")
 
 from app import create_app
-from commands import create_admin
+from commands import create_admin, register_model, activate_model, gc_blobs, gc_uploads, gc_pred_cache, export_model
 
 app = create_app()
 app.cli.add_command(create_admin)
+app.cli.add_command(register_model)
+app.cli.add_command(activate_model)
+app.cli.add_command(gc_blobs)
+app.cli.add_command(gc_uploads)
+app.cli.add_command(gc_pred_cache)
+app.cli.add_command(export_model)
 
 # 打印所有路由
 logger.debug("Registered routes:")